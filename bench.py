@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Optional, Dict, Any, List, Tuple
+
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+
+import main
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results')
+CITIES = [
+    (55.7558, 37.6173), (59.9343, 30.3351), (55.0084, 82.9357), (56.8389, 60.6057),
+    (55.7963, 49.1088), (56.2965, 43.9361), (53.1959, 50.1002), (54.9885, 73.3242),
+    (47.2357, 39.7015), (54.7388, 55.9721), (56.0153, 92.8932), (51.6608, 39.2003),
+]
+STICKER = {'file_id': 'sticker', 'file_unique_id': 'sticker', 'type': 'regular', 'width': 512, 'height': 512,
+           'is_animated': False, 'is_video': False}
+
+
+class FakeBotAPI(BaseRequest):
+    # Локальная замена Bot API: отвечает на любой метод успешным ответом без сети и считает вызовы.
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result: Any = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif endpoint.startswith('send'):
+            result = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                      'chat': {'id': int(parameters.get('chat_id', 0)), 'type': 'private'}}
+            if endpoint == 'sendSticker':
+                result['sticker'] = STICKER
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class UpdateFactory:
+    def __init__(self) -> None:
+        self.ids = itertools.count(1)
+
+    def message(self, user_id: int, **fields: Any) -> Dict[str, Any]:
+        message = {
+            'message_id': next(self.ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}', 'username': f'user{user_id}'},
+        }
+        message.update(fields)
+        return {'update_id': next(self.ids), 'message': message}
+
+    def text(self, user_id: int, text: str) -> Dict[str, Any]:
+        fields: Dict[str, Any] = {'text': text}
+        if text.startswith('/'):
+            fields['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.message(user_id, **fields)
+
+    def photo(self, user_id: int) -> Dict[str, Any]:
+        return self.message(user_id, photo=[
+            {'file_id': f'AgACthumb{user_id}', 'file_unique_id': f't{user_id}', 'width': 90, 'height': 120, 'file_size': 2000},
+            {'file_id': f'AgACmedium{user_id}', 'file_unique_id': f'm{user_id}', 'width': 480, 'height': 640, 'file_size': 40000},
+            {'file_id': f'AgACfull{user_id}', 'file_unique_id': f'f{user_id}', 'width': 960, 'height': 1280, 'file_size': 150000},
+        ])
+
+    def location(self, user_id: int, latitude: float, longitude: float) -> Dict[str, Any]:
+        return self.message(user_id, location={'latitude': latitude, 'longitude': longitude})
+
+
+def random_point(rng: random.Random) -> Tuple[float, float]:
+    latitude, longitude = rng.choice(CITIES)
+    return latitude + rng.gauss(0, 0.08), longitude + rng.gauss(0, 0.12)
+
+
+def seed_database(rows: int, likes_per_user: int, rng: random.Random) -> None:
+    conn = main.get_db_connection()
+    batch = []
+    for user_id in range(1, rows + 1):
+        latitude, longitude = random_point(rng)
+        batch.append((user_id, f'seed{user_id}', f'Seed{user_id}', rng.randint(18, 45), 'bio',
+                      f'AgACseed{user_id}', 'photo', latitude, longitude, main.geo_cell(latitude, longitude)))
+        if len(batch) == 50000 or user_id == rows:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO users (id, username, name, age, bio, photo_file_id, media_type, latitude, longitude, geo_cell) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch
+                )
+            batch = []
+    likes = ((user_id, rng.randint(1, rows)) for user_id in range(1, rows + 1) for _ in range(likes_per_user))
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO likes (user_id, liked_user_id) VALUES (?, ?)', likes)
+    conn.execute('ANALYZE')
+
+
+# Счетчик запросов текущего апдейта. run_db передает контекст задачи в поток БД, поэтому trace callback
+# видит счетчик того апдейта, чей запрос выполняется, даже когда апдейты обрабатываются параллельно.
+# Запросы фоновых задач (группового коммита, уведомлений) ни одному апдейту не засчитываются.
+update_statements: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar('update_statements', default=None)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statements: Dict[str, int] = defaultdict(int)
+        self.busy: Dict[str, float] = defaultdict(float)
+
+    def trace(self, statement: str) -> None:
+        counter = update_statements.get()
+        if counter is not None:
+            counter[0] += 1
+
+    def install(self) -> None:
+        main.get_db_connection().set_trace_callback(self.trace)
+
+    async def process(self, application, stage: str, data: Dict[str, Any]) -> None:
+        update = Update.de_json(data, application.bot)
+        counter = [0]
+        token = update_statements.set(counter)
+        started = time.perf_counter()
+        try:
+            # Через процессор приложения, как в боевом режиме: параллельно для разных пользователей, по порядку для одного.
+            await application.update_processor.process_update(update, application.process_update(update))
+        finally:
+            update_statements.reset(token)
+        elapsed = time.perf_counter() - started
+        self.latencies[stage].append(elapsed)
+        self.busy[stage] += elapsed
+        self.statements[stage] += counter[0]
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for stage, samples in self.latencies.items():
+            ordered = sorted(samples)
+
+            def percentile(p: float) -> float:
+                return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+
+            report[stage] = {
+                'updates': len(ordered),
+                'throughput': len(ordered) / self.busy[stage] if self.busy[stage] else 0.0,
+                'p50_ms': percentile(50),
+                'p95_ms': percentile(95),
+                'p99_ms': percentile(99),
+                'db_statements_per_update': self.statements[stage] / len(ordered),
+            }
+        return report
+
+
+async def simulate_user(application, recorder: Recorder, updates: UpdateFactory, user_id: int,
+                        swipes: int, rng: random.Random) -> None:
+    await recorder.process(application, 'start', updates.text(user_id, '/start'))
+    for text in (f'Bench{user_id}', str(rng.randint(18, 45)), 'bio'):
+        await recorder.process(application, 'profile', updates.text(user_id, text))
+    await recorder.process(application, 'profile', updates.photo(user_id))
+    await recorder.process(application, 'location', updates.location(user_id, *random_point(rng)))
+    await recorder.process(application, 'search', updates.text(user_id, 'Старт💕'))
+    for _ in range(swipes):
+        await recorder.process(application, 'swipe', updates.text(user_id, rng.choice(('❤️', '👎'))))
+
+
+async def simulate_match(application, recorder: Recorder, updates: UpdateFactory, first: int, second: int) -> None:
+    # Взаимный лайк между двумя симулированными пользователями: каждому подставляется анкета другого.
+    application.user_data[second]['current_profile_id'] = first
+    await recorder.process(application, 'swipe', updates.text(second, '❤️'))
+    application.user_data[first]['current_profile_id'] = second
+    await recorder.process(application, 'mutual', updates.text(first, '❤️'))
+    await recorder.process(application, 'open_chat', updates.text(first, f'/chat_{second}'))
+    await recorder.process(application, 'match_message', updates.text(first, 'Привет!'))
+
+
+def reset_state() -> None:
+    # Кэши и очереди модуля привязаны к предыдущей базе, между прогонами их нужно сбросить.
+    main.close_db_connections()
+    main.profile_cache.entries.clear()
+    main._seen_sets.clear()
+    main._feeds.clear()
+    main._feed_invalidated.clear()
+    main.notifier = main.Notifier()
+
+
+async def run_load(rows: int, args: argparse.Namespace) -> Dict[str, Any]:
+    reset_state()
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='dating-bench-')
+    main.DB_PATH = os.path.join(workdir, 'dating.db')
+    main.init_db()
+    seeding_started = time.perf_counter()
+    seed_database(rows, args.likes_per_user, rng)
+    seeding_time = time.perf_counter() - seeding_started
+
+    api = FakeBotAPI()
+    application = main.build_application('1:bench', request=api)
+    recorder = Recorder()
+    updates = UpdateFactory()
+    first_user = rows + 1
+    users = list(range(first_user, first_user + args.users))
+
+    async with application:
+        await application.start()
+        await application.post_init(application)
+        await main.run_db(recorder.install)
+
+        started = time.perf_counter()
+        for offset in range(0, len(users), args.concurrency):
+            group = users[offset:offset + args.concurrency]
+            await asyncio.gather(*(simulate_user(application, recorder, updates, user_id, args.swipes, rng) for user_id in group))
+        for first, second in zip(users[::2], users[1::2]):
+            await simulate_match(application, recorder, updates, first, second)
+        wall_time = time.perf_counter() - started
+
+        await application.stop()
+    await application.post_shutdown(application)
+
+    total_updates = sum(len(samples) for samples in recorder.latencies.values())
+    return {
+        'rows': rows,
+        'seeding_seconds': seeding_time,
+        'wall_seconds': wall_time,
+        'updates': total_updates,
+        'updates_per_second': total_updates / wall_time if wall_time else 0.0,
+        'api_calls': dict(api.calls),
+        'stages': recorder.report(),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or 'unknown'
+    except OSError:
+        return 'unknown'
+
+
+def latest_result(kind: str, parameters: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # Сравнивать имеет смысл только прогоны с теми же параметрами: другая конкурентность или число свайпов
+    # меняют p99 сильнее любого изменения в коде.
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    files = sorted(name for name in os.listdir(RESULTS_DIR) if name.startswith(kind + '-') and name.endswith('.json'))
+    for name in reversed(files):
+        with open(os.path.join(RESULTS_DIR, name), encoding='utf-8') as f:
+            result = json.load(f)
+        if result.get('parameters') == parameters:
+            return result
+    return None
+
+
+def save_result(kind: str, result: Dict[str, Any]) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-{result['revision']}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def print_load_report(result: Dict[str, Any], previous: Optional[Dict[str, Any]]) -> None:
+    previous_runs = {run['rows']: run for run in previous['runs']} if previous else {}
+    for run in result['runs']:
+        print(f"\nusers table: {run['rows']} rows (seeded in {run['seeding_seconds']:.1f}s), "
+              f"{run['updates']} updates, {run['updates_per_second']:.0f} updates/s")
+        print(f"{'stage':<14}{'updates':>9}{'upd/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'sql/upd':>9}{'p99 Δ':>9}")
+        before = previous_runs.get(run['rows'], {}).get('stages', {})
+        for stage, stats in run['stages'].items():
+            delta = ''
+            if stage in before and before[stage]['p99_ms']:
+                delta = f"{(stats['p99_ms'] / before[stage]['p99_ms'] - 1) * 100:+.0f}%"
+            print(f"{stage:<14}{stats['updates']:>9}{stats['throughput']:>10.0f}{stats['p50_ms']:>9.2f}"
+                  f"{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}{stats['db_statements_per_update']:>9.1f}{delta:>9}")
+        print('Bot API calls:', ', '.join(f'{name}={count}' for name, count in sorted(run['api_calls'].items())))
+    if previous:
+        print(f"\nΔ relative to {previous['revision']} ({previous['timestamp']})")
+
+
+async def bench_load(args: argparse.Namespace) -> None:
+    parameters = {'users': args.users, 'swipes': args.swipes, 'concurrency': args.concurrency,
+                  'likes_per_user': args.likes_per_user, 'seed': args.seed}
+    previous = latest_result('load', parameters)
+    runs = []
+    for rows in args.sizes:
+        runs.append(await run_load(rows, args))
+    result = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'parameters': parameters,
+        'runs': runs,
+    }
+    print_load_report(result, previous)
+    print('saved to', save_result('load', result))
+
+
+def time_best(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+async def bench_distance(args: argparse.Namespace) -> None:
+    parameters = {'k': args.k, 'repeat': args.repeat, 'seed': args.seed, 'numpy': main.np is not None}
+    previous = latest_result('distance', parameters)
+    previous_runs = {run['candidates']: run for run in previous['runs']} if previous else {}
+    rng = random.Random(args.seed)
+    latitude, longitude = CITIES[0]
+    runs = []
+    for count in args.sizes:
+        rows = []
+        for user_id in range(count):
+            lat, lon = latitude + rng.uniform(-0.6, 0.6), longitude + rng.uniform(-1.0, 1.0)
+            rows.append({'id': user_id, 'latitude': lat, 'longitude': lon, 'age': rng.randint(18, 60)})
+        latitudes = [row['latitude'] for row in rows]
+        longitudes = [row['longitude'] for row in rows]
+
+        def scalar() -> None:
+            ranked = []
+            for row in rows:
+                distance = main.calculate_distance(latitude, longitude, row['latitude'], row['longitude'])
+                if distance <= main.SEARCH_RADIUS_KM:
+                    ranked.append((row, distance))
+            ranked.sort(key=lambda item: item[1])
+
+        timings = {
+            'scalar_sort': time_best(scalar, args.repeat),
+            'batch_haversine': time_best(lambda: main.batch_distances(latitude, longitude, latitudes, longitudes), args.repeat),
+            'batch_equirect': time_best(lambda: main.batch_distances(latitude, longitude, latitudes, longitudes, True), args.repeat),
+            'rank_top_k': time_best(lambda: main.rank_candidates(latitude, longitude, rows, args.k), args.repeat),
+        }
+        haversine = main.batch_distances(latitude, longitude, latitudes, longitudes)
+        equirect = main.batch_distances(latitude, longitude, latitudes, longitudes, True)
+        max_error = max(abs(a - b) / a for a, b in zip(haversine, equirect) if a > 1)
+        runs.append({'candidates': count, 'k': args.k, 'max_equirect_error': max_error,
+                     'seconds': timings, 'per_candidate_us': {name: seconds / count * 1e6 for name, seconds in timings.items()}})
+
+    print('numpy', main.np.__version__ if main.np is not None else 'not installed')
+    for run in runs:
+        before = previous_runs.get(run['candidates'], {}).get('seconds', {})
+        print(f"\n{run['candidates']} candidates, top {run['k']}, max equirectangular error {run['max_equirect_error'] * 100:.3f}%")
+        print(f"{'method':<18}{'ms':>10}{'us/cand':>10}{'Δ':>9}")
+        for name, seconds in run['seconds'].items():
+            delta = f"{(seconds / before[name] - 1) * 100:+.0f}%" if before.get(name) else ''
+            print(f"{name:<18}{seconds * 1000:>10.2f}{run['per_candidate_us'][name]:>10.3f}{delta:>9}")
+    if previous:
+        print(f"\nΔ relative to {previous['revision']} ({previous['timestamp']})")
+    result = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'parameters': parameters,
+        'runs': runs,
+    }
+    print('saved to', save_result('distance', result))
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Офлайн-нагрузочный тест бота на локальной замене Bot API.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='прогнать симулированных пользователей через все обработчики')
+    load.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=[1000, 100000, 1000000],
+                      help='размеры таблицы users через запятую')
+    load.add_argument('--users', type=int, default=1000, help='число симулированных пользователей')
+    load.add_argument('--swipes', type=int, default=20, help='свайпов на пользователя')
+    load.add_argument('--concurrency', type=int, default=1, help='сколько пользователей обрабатывается одновременно')
+    load.add_argument('--likes-per-user', type=int, default=2, help='лайков на каждую засеянную анкету')
+    load.add_argument('--seed', type=int, default=1)
+    load.set_defaults(handler=bench_load)
+
+    distance = commands.add_parser('distance', help='сравнить поштучный и векторный расчёт расстояний')
+    distance.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=[1000, 10000, 100000],
+                          help='число кандидатов через запятую')
+    distance.add_argument('--k', type=int, default=main.FEED_BATCH_SIZE, help='сколько ближайших анкет отбирать')
+    distance.add_argument('--repeat', type=int, default=5, help='повторов на замер, берётся лучший')
+    distance.add_argument('--seed', type=int, default=1)
+    distance.set_defaults(handler=bench_distance)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    arguments = parse_args(sys.argv[1:])
+    asyncio.run(arguments.handler(arguments))
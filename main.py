@@ -1,9 +1,43 @@
 import logging
-from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes
+import json
+import heapq
+import os
+import re
+import sys
+import signal
+import multiprocessing
+from collections import Counter
+from datetime import datetime, timedelta
+from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, TelegramError
+from telegram.ext import Application, ApplicationBuilder, BaseUpdateProcessor, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes, BasePersistence, PersistenceInput
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
 import sqlite3
-from math import radians, sin, cos, sqrt, atan2
-from typing import Optional, Tuple, Dict, Any
+import random
+import time
+import asyncio
+import threading
+import functools
+import contextlib
+import contextvars
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+from math import radians, sin, cos, sqrt, atan2, floor, ceil, pi
+from typing import Optional, Tuple, Dict, Any, List, Container, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
 
 
 logging.basicConfig(
@@ -13,81 +47,3576 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-ADMIN_USER_ID = 0000000  
+ADMIN_USER_ID = 0000000  
+
+DB_PATH = 'dating.db'
+DB_PRAGMAS = (
+    # auto_vacuum действует, только если задан до создания файла, поэтому идет первым.
+    ('auto_vacuum', 'INCREMENTAL'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -32000),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+)
+DB_QUEUE_SIZE = 256
+LATENCY_SAMPLES = 2048
+LATENCY_REPORT_EVERY = 1000
+
+SEARCH_RADIUS_KM = 50.0
+GEO_CELL_DEG = 0.05
+GEO_LAT_CELLS = int(180 / GEO_CELL_DEG)
+GEO_LON_CELLS = int(360 / GEO_CELL_DEG)
+KM_PER_DEG = 111.195
+EQUIRECT_MAX_KM = 100.0
+AGE_WINDOW: Optional[int] = None
+
+FEED_BATCH_SIZE = 50
+FEED_LOW_WATER = 10
+FEED_MAX_USERS = 10000
+FEED_TTL = 600
+CANDIDATE_PAGE_SIZE = 200
+CANDIDATE_SCAN_LIMIT = 5000
+CANDIDATE_READ_LIMIT = 50000
+
+SEEN_MAX_USERS = 10000
+SEEN_TTL = 3600
+VIEW_COOLDOWN_HOURS = 24
+RESHOW_AFTER_DAYS: Optional[int] = None
+
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 300
+
+NOTIFY_GLOBAL_RATE = 25.0
+NOTIFY_GLOBAL_BURST = 30
+NOTIFY_CHAT_RATE = 1.0
+NOTIFY_CHAT_BURST = 3
+NOTIFY_COALESCE_SECONDS = 5.0
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_MAX_CHATS = 10000
+NOTIFY_SWEEP_INTERVAL = 60
+
+SESSION_FLUSH_INTERVAL = 5
+SESSION_MAX_USERS = 10000
+SESSION_TTL = 3600
+SESSION_EVICT_INTERVAL = 60
+SWIPE_DURABILITY = 'batched'
+SWIPE_FLUSH_INTERVAL = 0.005
+SWIPE_FLUSH_EVENTS = 256
+SWIPE_RETRY_MAX_DELAY = 5.0
+JOB_BATCH_SIZE = 500
+JOB_BATCH_PAUSE = 0.05
+JOB_POLL_INTERVAL = 30
+JOB_MAX_ATTEMPTS = 5
+LIKE_RETENTION_DAYS: Optional[int] = 365
+MESSAGE_ARCHIVE_DAYS: Optional[int] = 180
+VACUUM_PAGES = 1000
+OFF_PEAK_HOURS = (3, 6)
+MATCH_STICKER = "CAACAgUAAxkBAAIGUmeUGZkoFGnOIkwsbPkqK566XFeMAALpDQACyRUoVdu2RfDbVvPaNgQ"
+MATCHES_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 20
+MESSAGE_PREVIEW_CHARS = 40
+FEED_PHOTO_MIN_SIDE = 800
+STATS_DAYS = 7
+ACTIVE_USERS_KEEP_DAYS = 2
+STATS_METRICS = ('registrations', 'deletions', 'active_users', 'likes', 'dislikes', 'matches', 'messages')
+HEATMAP_CELL_DEG = 1.0
+HEATMAP_TOP = 15
+DIGEST_INTERVAL = 3600
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT: Optional[int] = 9108
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+PROFILER_INTERVAL = 0.005
+PROFILER_MAX_DEPTH = 40
+PROFILER_REPORT_LINES = 15
+
+BOT_TOKEN = os.environ.get('BOT_TOKEN', "000000000000000000000000000000000000000000000000000")
+BOT_API_URL = os.environ.get('BOT_API_URL')
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 64))
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', os.cpu_count() or 1))
+WEBHOOK_MAX_CONNECTIONS = 100
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_SHUTDOWN_TIMEOUT = 30
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+WORKER_QUEUES: List[Any] = []
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite')
+DATABASE_URL = os.environ.get('DATABASE_URL')
+PG_POOL_MIN_SIZE = 2
+PG_POOL_MAX_SIZE = 20
+PG_COMMAND_TIMEOUT = 10
+PG_JOB_LEASE = 600
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    # Счетчики, гистограммы и gauge в формате Prometheus. Пишутся и из event loop, и из потока БД,
+    # поэтому все изменения идут под одной блокировкой.
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.callbacks: Dict[str, Any] = {}
+
+    def inc(self, name: str, labels: Tuple = (), value: float = 1) -> None:
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name: str, value: float, labels: Tuple = ()) -> None:
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[name, labels] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(value)
+
+    def set_gauge(self, name: str, value: float, labels: Tuple = ()) -> None:
+        with self.lock:
+            self.gauges[name, labels] = value
+
+    def gauge_callback(self, name: str, callback) -> None:
+        self.callbacks[name] = callback
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: Tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self) -> str:
+        for name, callback in self.callbacks.items():
+            try:
+                self.set_gauge(name, callback())
+            except Exception as e:
+                logger.error(f"Ошибка при расчете метрики {name}: {e}")
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{self._labels(labels)} {value}')
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f'{name}{self._labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_PARAMETER_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_sql_fingerprints: Dict[str, str] = {}
+
+
+def sql_fingerprint(sql: str) -> str:
+    fingerprint = _sql_fingerprints.get(sql)
+    if fingerprint is None:
+        fingerprint = ' '.join(sql.split())
+        fingerprint = _SQL_LITERALS.sub('?', fingerprint)
+        fingerprint = _SQL_PARAMETER_LISTS.sub('(?+)', fingerprint)
+        if len(_sql_fingerprints) < 1000:
+            _sql_fingerprints[sql] = fingerprint
+    return fingerprint
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe('bot_sql_seconds', time.perf_counter() - started, (('query', sql_fingerprint(sql)),))
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            metrics.observe('bot_sql_seconds', time.perf_counter() - started, (('query', sql_fingerprint(sql)),))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # conn.execute() внутри sqlite3 создает обычный курсор, поэтому методы соединения тоже переопределены.
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class InstrumentedRequest(BaseRequest):
+    # Обертка над транспортом Bot API: считает вызовы, ошибки и время каждого метода.
+    def __init__(self, request: BaseRequest) -> None:
+        self.request = request
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+        labels = (('method', url.rsplit('/', 1)[-1]),)
+        started = time.perf_counter()
+        try:
+            code, payload = await self.request.do_request(
+                url=url, method=method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+            )
+        except Exception:
+            metrics.inc('bot_telegram_api_errors_total', labels)
+            raise
+        finally:
+            metrics.inc('bot_telegram_api_calls_total', labels)
+            metrics.observe('bot_telegram_api_seconds', time.perf_counter() - started, labels)
+        if code != 200:
+            metrics.inc('bot_telegram_api_errors_total', labels)
+        return code, payload
+
+
+class SamplingProfiler:
+    # Периодически снимает стек потока event loop из sys._current_frames() и считает одинаковые стеки.
+    def __init__(self) -> None:
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.samples: Counter = Counter()
+        self.total = 0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, thread_id: int) -> None:
+        self.samples.clear()
+        self.total = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, args=(thread_id,), name='profiler', daemon=True)
+        self.thread.start()
+
+    def _run(self, thread_id: int) -> None:
+        while not self.stopped.wait(PROFILER_INTERVAL):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < PROFILER_MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(stack)] += 1
+                self.total += 1
+
+    def stop(self) -> str:
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if not self.total:
+            return "Профилировщик не собрал ни одного сэмпла."
+        leaf = Counter()
+        inclusive = Counter()
+        for stack, count in self.samples.items():
+            leaf[stack[0]] += count
+            for frame in set(stack):
+                if '(main.py:' in frame:
+                    inclusive[frame.split(' (')[0]] += count
+        lines = [f"Сэмплов: {self.total} (интервал {PROFILER_INTERVAL * 1000:.0f} мс)", "", "Собственное время:"]
+        lines += [f"{count * 100 / self.total:5.1f}% {frame}" for frame, count in leaf.most_common(PROFILER_REPORT_LINES)]
+        lines += ["", "Включая вызовы (main.py):"]
+        lines += [f"{count * 100 / self.total:5.1f}% {name}" for name, count in inclusive.most_common(PROFILER_REPORT_LINES)]
+        return '\n'.join(lines)
+
+
+profiler = SamplingProfiler()
+
+
+_db_local = threading.local()
+_db_connections: List[sqlite3.Connection] = []
+_db_lock = threading.Lock()
+_db_generation = 0
+
+
+def open_db_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=InstrumentedConnection)
+    conn.row_factory = sqlite3.Row  
+    for name, value in DB_PRAGMAS:
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+
+def get_db_connection() -> sqlite3.Connection:
+    # Одно долгоживущее соединение на поток; `with conn:` только фиксирует транзакцию и не закрывает его.
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or getattr(_db_local, 'generation', None) != _db_generation:
+        conn = open_db_connection()
+        with _db_lock:
+            _db_connections.append(conn)
+            _db_local.conn = conn
+            _db_local.generation = _db_generation
+    return conn
+
+
+def close_db_connections() -> None:
+    global _db_generation
+    with _db_lock:
+        _db_generation += 1
+        for conn in _db_connections:
+            try:
+                conn.execute('PRAGMA optimize')
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при закрытии соединения с БД: {e}")
+        _db_connections.clear()
+
+
+_db_executor: Optional[ThreadPoolExecutor] = None
+_db_slots: Optional[asyncio.Semaphore] = None
+
+
+async def run_db(func, *args):
+    # Все запросы к SQLite выполняются в отдельном потоке БД, чтобы не блокировать event loop.
+    # Семафор ограничивает очередь: при перегрузке обработчики ждут здесь, а не копят задачи в памяти.
+    # Контекст задачи передается в поток БД, как в asyncio.to_thread, чтобы contextvars были видны и там.
+    global _db_executor, _db_slots
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+        _db_slots = asyncio.Semaphore(DB_QUEUE_SIZE)
+    started = time.perf_counter()
+    try:
+        async with _db_slots:
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(_db_executor, context.run, func, *args)
+    finally:
+        metrics.observe('bot_db_call_seconds', time.perf_counter() - started, (('function', func.__name__),))
+
+
+def shutdown_db_executor() -> None:
+    global _db_executor, _db_slots
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+        _db_slots = None
+
+
+_handler_latencies: Dict[str, deque] = {}
+_handled_updates = 0
+
+
+def latency_percentiles(name: str) -> Dict[str, float]:
+    samples = sorted(_handler_latencies.get(name, ()))
+    if not samples:
+        return {}
+    return {
+        f'p{p}': samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+        for p in (50, 95, 99)
+    }
+
+
+def timed(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        global _handled_updates
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        except Exception:
+            metrics.inc('bot_handler_errors_total', (('handler', handler.__name__),))
+            raise
+        finally:
+            name = handler.__name__
+            metrics.observe('bot_handler_seconds', time.perf_counter() - started, (('handler', name),))
+            _handler_latencies.setdefault(name, deque(maxlen=LATENCY_SAMPLES)).append(time.perf_counter() - started)
+            _handled_updates += 1
+            if _handled_updates % LATENCY_REPORT_EVERY == 0:
+                for name in _handler_latencies:
+                    stats = ', '.join(f'{key}={value:.1f}ms' for key, value in latency_percentiles(name).items())
+                    logger.info(f"Задержка {name}: {stats}")
+                logger.info(
+                    f"Кэш анкет: попаданий {profile_cache.hits}, промахов {profile_cache.misses}, "
+                    f"сэкономлено запросов на апдейт: {profile_cache.hits / _handled_updates:.2f}"
+                )
+    return wrapper
+
+
+async def monitor_loop_lag() -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL)
+        metrics.set_gauge('bot_event_loop_lag_seconds', lag)
+        metrics.observe('bot_event_loop_lag_seconds_histogram', lag)
+
+
+async def serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def register_metric_callbacks() -> None:
+    metrics.gauge_callback('bot_profile_cache_hits', lambda: profile_cache.hits)
+    metrics.gauge_callback('bot_profile_cache_misses', lambda: profile_cache.misses)
+    metrics.gauge_callback('bot_feeds_active', lambda: len(_feeds))
+    metrics.gauge_callback('bot_swipes_pending', lambda: swipes.pending)
+    metrics.gauge_callback('bot_notifications_pending', lambda: sum(len(queue) for queue in notifier.pending.values()))
+
+
+_background_tasks: List[asyncio.Task] = []
+_metrics_server: Optional[asyncio.AbstractServer] = None
+
+
+async def on_startup(application) -> None:
+    global _metrics_server
+    await notifier.start(application.bot)
+    await storage.start()
+    if WORKER_INDEX == 0:
+        await jobs.start()
+        _background_tasks.append(asyncio.create_task(send_digests()))
+    if isinstance(application.persistence, SQLitePersistence):
+        _background_tasks.append(asyncio.create_task(evict_idle_sessions(application)))
+    _background_tasks.append(asyncio.create_task(monitor_loop_lag()))
+    register_metric_callbacks()
+    if METRICS_PORT is not None:
+        try:
+            _metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+
+async def on_shutdown(application) -> None:
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+    if profiler.running:
+        profiler.stop()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await notifier.stop()
+    await jobs.stop()
+    await storage.stop()
+    shutdown_db_executor()
+    close_db_connections()
+
+
+def migrate_initial_schema(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        name TEXT,
+        age INTEGER,
+        bio TEXT,
+        photo_file_id TEXT,
+        latitude REAL,
+        longitude REAL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        liked_user_id INTEGER,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(liked_user_id) REFERENCES users(id)
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        matched_user_id INTEGER,
+        message TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(matched_user_id) REFERENCES users(id)
+    )
+    ''')
+
+
+def migrate_geo_cell(cursor: sqlite3.Cursor) -> None:
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'geo_cell' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN geo_cell INTEGER')
+    rows = cursor.execute('SELECT id, latitude, longitude FROM users WHERE geo_cell IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL').fetchall()
+    cursor.executemany('UPDATE users SET geo_cell = ? WHERE id = ?', [(geo_cell(row['latitude'], row['longitude']), row['id']) for row in rows])
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_geo_cell ON users(geo_cell)')
+
+
+def migrate_like_indexes(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    DELETE FROM likes WHERE id NOT IN (
+        SELECT MIN(id) FROM likes GROUP BY user_id, liked_user_id
+    )
+    ''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_likes_user_liked ON likes(user_id, liked_user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_liked_user ON likes(liked_user_id, user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_id, matched_user_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_matched_user ON messages(matched_user_id, user_id)')
+
+
+def migrate_views(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS views (
+        user_id INTEGER NOT NULL,
+        viewed_user_id INTEGER NOT NULL,
+        disliked INTEGER NOT NULL DEFAULT 0,
+        viewed_at INTEGER NOT NULL,
+        PRIMARY KEY (user_id, viewed_user_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_views_viewed_user ON views(viewed_user_id)')
+
+
+def migrate_outbox(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        not_before REAL NOT NULL
+    )
+    ''')
+
+
+def migrate_sessions(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+
+
+def migrate_matches(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS matches (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        last_message_id INTEGER,
+        last_message_at REAL
+    )
+    ''')
+    # Две строки на матч, по одной на участника: список матчей пользователя читается одним
+    # диапазоном индекса (user_id, activity_at, match_id) без UNION по двум колонкам.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS match_members (
+        user_id INTEGER NOT NULL,
+        peer_id INTEGER NOT NULL,
+        match_id INTEGER NOT NULL,
+        unread INTEGER NOT NULL DEFAULT 0,
+        activity_at REAL NOT NULL,
+        PRIMARY KEY (user_id, peer_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_match_members_activity ON match_members(user_id, activity_at, match_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_match_members_match ON match_members(match_id)')
+
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(messages)')]
+    if 'match_id' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN match_id INTEGER')
+    if 'sent_at' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN sent_at REAL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_match ON messages(match_id, id)')
+
+    now = time.time()
+    pairs = cursor.execute('''
+        SELECT a.user_id, a.liked_user_id FROM likes a
+        JOIN likes b ON b.user_id = a.liked_user_id AND b.liked_user_id = a.user_id
+        WHERE a.user_id < a.liked_user_id
+    ''').fetchall()
+    for first, second in pairs:
+        create_match(cursor, first, second, now)
+    cursor.execute('''
+        UPDATE messages SET match_id = (
+            SELECT match_id FROM match_members WHERE user_id = messages.user_id AND peer_id = messages.matched_user_id
+        ) WHERE match_id IS NULL
+    ''')
+    cursor.execute('''
+        UPDATE matches SET last_message_id = (SELECT MAX(id) FROM messages WHERE match_id = matches.id)
+        WHERE last_message_id IS NULL
+    ''')
+
+
+def migrate_jobs(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        run_after REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_run_after ON jobs(run_after)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS tombstones (
+        user_id INTEGER PRIMARY KEY,
+        deleted_at REAL NOT NULL,
+        like_cutoff INTEGER NOT NULL,
+        message_cutoff INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        matched_user_id INTEGER,
+        message TEXT,
+        match_id INTEGER,
+        sent_at REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_archive_match ON messages_archive(match_id, id)')
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(likes)')]
+    if 'liked_at' not in columns:
+        cursor.execute('ALTER TABLE likes ADD COLUMN liked_at REAL')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_likes_liked_at ON likes(liked_at)')
+
+
+def migrate_media(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        media_type TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        file_unique_id TEXT,
+        width INTEGER,
+        height INTEGER,
+        duration INTEGER,
+        file_size INTEGER,
+        sizes TEXT,
+        created_at REAL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_media_user ON media(user_id, position)')
+    columns = [row['name'] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'media_type' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN media_type TEXT')
+    if 'feed_file_id' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN feed_file_id TEXT')
+    # Для старых анкет тип известен только по префиксу file_id; новые анкеты сохраняют его при загрузке.
+    cursor.execute('''
+        UPDATE users SET media_type = CASE WHEN photo_file_id LIKE 'AgAC%' THEN 'photo' ELSE 'video' END
+        WHERE media_type IS NULL AND photo_file_id IS NOT NULL
+    ''')
+    cursor.execute('''
+        INSERT INTO media (user_id, position, media_type, file_id)
+        SELECT id, 0, media_type, photo_file_id FROM users
+        WHERE photo_file_id IS NOT NULL AND id NOT IN (SELECT user_id FROM media)
+    ''')
+
+
+def migrate_stats(cursor: sqlite3.Cursor) -> None:
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        value INTEGER NOT NULL,
+        PRIMARY KEY (day, metric)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS active_users (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (day, user_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS geo_stats (
+        lat_bucket INTEGER NOT NULL,
+        lon_bucket INTEGER NOT NULL,
+        registrations INTEGER NOT NULL,
+        PRIMARY KEY (lat_bucket, lon_bucket)
+    ) WITHOUT ROWID
+    ''')
+    # Единственный полный проход по таблицам: начальные значения счетчиков для уже существующих данных.
+    for name, query in (
+        ('registrations', 'SELECT COUNT(*) FROM users'),
+        ('likes', 'SELECT COUNT(*) FROM likes'),
+        ('matches', 'SELECT COUNT(*) FROM matches'),
+        ('messages', 'SELECT COUNT(*) FROM messages'),
+    ):
+        cursor.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, ?)', (name, cursor.execute(query).fetchone()[0]))
+    buckets = Counter(
+        heatmap_bucket(row['latitude'], row['longitude'])
+        for row in cursor.execute('SELECT latitude, longitude FROM users WHERE latitude IS NOT NULL AND longitude IS NOT NULL')
+    )
+    cursor.executemany(
+        'INSERT OR IGNORE INTO geo_stats (lat_bucket, lon_bucket, registrations) VALUES (?, ?, ?)',
+        [(lat_bucket, lon_bucket, count) for (lat_bucket, lon_bucket), count in buckets.items()]
+    )
+
+
+def migrate_inbox(cursor: sqlite3.Cursor) -> None:
+    # Входящие лайки без ответа: строка живет до матча, дизлайк только помечает ее dismissed,
+    # поэтому проверка взаимности — один поиск по первичному ключу.
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inbox (
+        user_id INTEGER NOT NULL,
+        liker_id INTEGER NOT NULL,
+        liked_at REAL NOT NULL,
+        dismissed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, liker_id)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inbox_pending ON inbox(user_id, dismissed, liked_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inbox_liker ON inbox(liker_id)')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS inbox_counts (
+        user_id INTEGER PRIMARY KEY,
+        pending INTEGER NOT NULL
+    )
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO inbox (user_id, liker_id, liked_at, dismissed)
+        SELECT l.liked_user_id, l.user_id, COALESCE(l.liked_at, 0), COALESCE(v.disliked, 0)
+        FROM likes l
+        LEFT JOIN views v ON v.user_id = l.liked_user_id AND v.viewed_user_id = l.user_id
+        WHERE NOT EXISTS (SELECT 1 FROM likes r WHERE r.user_id = l.liked_user_id AND r.liked_user_id = l.user_id)
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO inbox_counts (user_id, pending)
+        SELECT user_id, COUNT(*) FROM inbox WHERE dismissed = 0 GROUP BY user_id
+    ''')
+
+
+def migrate_message_sent_at(cursor: sqlite3.Cursor) -> None:
+    # У сообщений из старой схемы нет sent_at: им ставится время создания матча (оно не раньше самих сообщений),
+    # иначе архивация отправила бы их в архив все сразу. Индекс нужен архивации, чтобы не сканировать всю таблицу.
+    cursor.execute('''
+        UPDATE messages SET sent_at = COALESCE((SELECT created_at FROM matches WHERE id = messages.match_id), ?)
+        WHERE sent_at IS NULL
+    ''', (time.time(),))
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages(sent_at)')
+
+
+def migrate_inbox_liked_at(cursor: sqlite3.Cursor) -> None:
+    # Срок хранения лайков распространяется и на inbox: без индекса retention сканировала бы всю таблицу.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_inbox_liked_at ON inbox(liked_at)')
+
+
+# Миграции применяются строго по порядку; номер последней примененной хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка.
+MIGRATIONS = [
+    migrate_initial_schema,
+    migrate_geo_cell,
+    migrate_like_indexes,
+    migrate_views,
+    migrate_outbox,
+    migrate_sessions,
+    migrate_matches,
+    migrate_jobs,
+    migrate_media,
+    migrate_stats,
+    migrate_inbox,
+    migrate_message_sent_at,
+    migrate_inbox_liked_at,
+]
+
+
+def init_db():
+    conn = get_db_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        # Новая база создается сразу с auto_vacuum=INCREMENTAL (DB_PRAGMAS). Старую переводит только полный VACUUM,
+        # который переписывает весь файл, поэтому при запуске он не делается: это отдельная команда.
+        logger.warning("База создана без auto_vacuum=INCREMENTAL, задача vacuum не будет освобождать место. "
+                       "Переведите ее один раз командой `python main.py vacuum` при остановленном боте.")
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= len(MIGRATIONS):
+                conn.rollback()
+                return
+            migration = MIGRATIONS[version]
+            migration(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Схема БД обновлена до версии {version + 1} ({migration.__name__})")
+
+
+def convert_auto_vacuum() -> None:
+    conn = get_db_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        logger.info("База уже в режиме auto_vacuum=INCREMENTAL")
+        return
+    logger.info("Перевод базы на auto_vacuum=INCREMENTAL (полный VACUUM)...")
+    conn.execute('VACUUM')
+    logger.info(f"Готово, auto_vacuum = {conn.execute('PRAGMA auto_vacuum').fetchone()[0]}")
+
+
+def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    R = 6371.0  
+    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])  
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    distance = R * c 
+    return distance
+
+
+def equirectangular_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    # Разница долгот приводится к [-180, 180), иначе точки по разные стороны антимеридиана оказываются за полмира друг от друга.
+    x = ((radians(lon2 - lon1) + pi) % (2 * pi) - pi) * cos(radians((lat1 + lat2) / 2))
+    y = radians(lat2 - lat1)
+    return 6371.0 * sqrt(x * x + y * y)
+
+
+def batch_distances(latitude: float, longitude: float, latitudes: Sequence[float], longitudes: Sequence[float],
+                    fast: bool = False):
+    # Расстояния от одной точки до массива точек. С numpy считается векторно; fast=True включает
+    # равнопромежуточную проекцию, погрешность которой на расстояниях до EQUIRECT_MAX_KM меньше 0.5%.
+    if np is None:
+        scalar = equirectangular_distance if fast else calculate_distance
+        return [scalar(latitude, longitude, lat, lon) for lat, lon in zip(latitudes, longitudes)]
+
+    lat1 = radians(latitude)
+    lat2 = np.radians(np.asarray(latitudes, dtype=np.float64))
+    dlon = np.radians(np.asarray(longitudes, dtype=np.float64) - longitude)
+    dlat = lat2 - lat1
+    if fast:
+        x = ((dlon + pi) % (2 * pi) - pi) * np.cos((lat2 + lat1) / 2)
+        return 6371.0 * np.sqrt(x * x + dlat * dlat)
+    a = np.sin(dlat / 2) ** 2 + cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 6371.0 * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def rank_candidates(latitude: float, longitude: float, rows: Sequence[sqlite3.Row], k: Optional[int] = None,
+                    radius_km: float = SEARCH_RADIUS_KM, min_age: Optional[int] = None,
+                    max_age: Optional[int] = None) -> List[Tuple[sqlite3.Row, float]]:
+    if not rows:
+        return []
+    fast = radius_km <= EQUIRECT_MAX_KM
+    distances = batch_distances(latitude, longitude, [row['latitude'] for row in rows], [row['longitude'] for row in rows], fast)
+
+    if np is None:
+        ranked = [
+            (row, distance) for row, distance in zip(rows, distances)
+            if distance <= radius_km
+            and (min_age is None or row['age'] >= min_age)
+            and (max_age is None or row['age'] <= max_age)
+        ]
+        if k is not None and len(ranked) > k:
+            return heapq.nsmallest(k, ranked, key=lambda item: item[1])
+        return sorted(ranked, key=lambda item: item[1])
+
+    mask = distances <= radius_km
+    if min_age is not None or max_age is not None:
+        ages = np.fromiter((row['age'] for row in rows), dtype=np.float64, count=len(rows))
+        if min_age is not None:
+            mask &= ages >= min_age
+        if max_age is not None:
+            mask &= ages <= max_age
+    indexes = np.flatnonzero(mask)
+    if k is not None and len(indexes) > k:
+        indexes = indexes[np.argpartition(distances[indexes], k - 1)[:k]]
+    indexes = indexes[np.argsort(distances[indexes], kind='stable')]
+    return [(rows[index], float(distances[index])) for index in indexes]
+
+
+def geo_cell(latitude: float, longitude: float) -> int:
+    lat_index = min(int(floor((latitude + 90) / GEO_CELL_DEG)), GEO_LAT_CELLS - 1)
+    lon_index = int(floor((longitude + 180) / GEO_CELL_DEG)) % GEO_LON_CELLS
+    return lat_index * GEO_LON_CELLS + lon_index
+
+
+def geo_row_ranges(lat: int, first: int, last: int) -> List[Tuple[int, int]]:
+    # Отрезок строки широты [first, last] по индексам долготы как диапазоны geo_cell;
+    # отрезок через антимеридиан делится на два.
+    row = lat * GEO_LON_CELLS
+    start = first % GEO_LON_CELLS
+    end = start + last - first
+    if end < GEO_LON_CELLS:
+        return [(row + start, row + end)]
+    return [(row + start, row + GEO_LON_CELLS - 1), (row, row + end - GEO_LON_CELLS)]
+
+
+def geo_rings(latitude: float, longitude: float, radius_km: float):
+    # Кольца ячеек сетки вокруг точки: каждое следующее кольцо на одну ячейку дальше по широте,
+    # по долготе ширина кольца растянута на 1/cos(широты), чтобы покрыть тот же радиус в км.
+    # Кольцо отдается диапазонами geo_cell: в каждой строке широты новые ячейки кольца — один отрезок
+    # (новая строка) или два (по бокам уже просмотренной части), так что запрос идет на отрезок, а не на ячейку.
+    center = geo_cell(latitude, longitude)
+    lat_index, lon_index = divmod(center, GEO_LON_CELLS)
+    cell_km = GEO_CELL_DEG * KM_PER_DEG
+    lon_scale = 1 / max(cos(radians(latitude)), 0.05)
+    rings = ceil(radius_km / cell_km)
+    covered: Dict[int, int] = {}
+    for ring in range(rings + 1):
+        lon_span = min(ceil(ring * lon_scale), GEO_LON_CELLS // 2)
+        right = min(lon_span, GEO_LON_CELLS - 1 - lon_span)
+        ranges = []
+        for lat in range(max(lat_index - ring, 0), min(lat_index + ring, GEO_LAT_CELLS - 1) + 1):
+            previous = covered.get(lat)
+            if previous is None:
+                ranges += geo_row_ranges(lat, lon_index - lon_span, lon_index + right)
+            elif lon_span > previous:
+                ranges += geo_row_ranges(lat, lon_index - lon_span, lon_index - previous - 1)
+                if right > previous:
+                    ranges += geo_row_ranges(lat, lon_index + previous + 1, lon_index + right)
+            else:
+                continue
+            covered[lat] = lon_span
+        if ranges:
+            yield ranges
+
+
+def is_excluded(profile_id: int, exclude: Sequence[Container[int]]) -> bool:
+    return any(profile_id in container for container in exclude)
+
+
+def geo_range_pages(conn: sqlite3.Connection, low: int, high: int):
+    # Страницы анкет из диапазона ячеек по индексу (geo_cell, id). Если диапазон не влез в первую страницу,
+    # остаток читается со случайной точки до конца и затем по кругу до нее, иначе повторные поиски
+    # каждый раз начинали бы с младших id, которые пользователь уже пролистал.
+    rows = conn.execute(
+        'SELECT * FROM users WHERE geo_cell BETWEEN ? AND ? ORDER BY geo_cell, id LIMIT ?',
+        (low, high, CANDIDATE_PAGE_SIZE)
+    ).fetchall()
+    yield rows
+    if len(rows) < CANDIDATE_PAGE_SIZE:
+        return
+    start = (rows[-1]['geo_cell'], rows[-1]['id'])
+    max_id = conn.execute('SELECT MAX(id) FROM users').fetchone()[0]
+    pivot = max((random.randint(start[0], high), random.randint(0, max_id)), (start[0], start[1] + 1))
+    for after, before in (((pivot[0], pivot[1] - 1), (high + 1, 0)), (start, pivot)):
+        while True:
+            rows = conn.execute(
+                'SELECT * FROM users WHERE geo_cell BETWEEN ? AND ? AND (geo_cell, id) > (?, ?) AND (geo_cell, id) < (?, ?) '
+                'ORDER BY geo_cell, id LIMIT ?',
+                (low, high, *after, *before, CANDIDATE_PAGE_SIZE)
+            ).fetchall()
+            yield rows
+            if len(rows) < CANDIDATE_PAGE_SIZE:
+                break
+            after = (rows[-1]['geo_cell'], rows[-1]['id'])
+
+
+def find_nearby_profiles(conn: sqlite3.Connection, user_id: int, latitude: float, longitude: float,
+                         limit: int, exclude: Sequence[Container[int]] = (),
+                         radius_km: float = SEARCH_RADIUS_KM, min_age: Optional[int] = None,
+                         max_age: Optional[int] = None) -> List[Tuple[sqlite3.Row, float]]:
+    # Уже показанные анкеты отсеиваются в памяти и не расходуют CANDIDATE_SCAN_LIMIT: лимит считает
+    # только непросмотренные строки, иначе активный пользователь упирался бы в него, не найдя никого.
+    # Все прочитанные строки вместе с показанными ограничены CANDIDATE_READ_LIMIT, чтобы дозагрузка ленты
+    # у того, кто пролистал весь радиус, не читала его целиком каждый раз.
+    # Строки копятся по всем кольцам и ранжируются одним вызовом с k=limit; на границе кольца ранжирование
+    # пробуется, только когда строк уже набралось не меньше limit.
+    eligible = []
+    read = 0
+    for ranges in geo_rings(latitude, longitude, radius_km):
+        for low, high in ranges:
+            for rows in geo_range_pages(conn, low, high):
+                read += len(rows)
+                eligible += [row for row in rows if row['id'] != user_id and not is_excluded(row['id'], exclude)]
+                if len(eligible) >= CANDIDATE_SCAN_LIMIT or read >= CANDIDATE_READ_LIMIT:
+                    break
+            if len(eligible) >= CANDIDATE_SCAN_LIMIT or read >= CANDIDATE_READ_LIMIT:
+                break
+        if len(eligible) >= CANDIDATE_SCAN_LIMIT or read >= CANDIDATE_READ_LIMIT:
+            break
+        if len(eligible) >= limit:
+            candidates = rank_candidates(latitude, longitude, eligible, limit, radius_km, min_age, max_age)
+            if len(candidates) >= limit:
+                return candidates
+    return rank_candidates(latitude, longitude, eligible, limit, radius_km, min_age, max_age)
+
+
+def find_random_profiles(conn: sqlite3.Connection, user_id: int, limit: int,
+                         exclude: Sequence[Container[int]] = ()) -> List[sqlite3.Row]:
+    bounds = conn.execute('SELECT MIN(id), MAX(id) FROM users').fetchone()
+    if bounds[0] is None:
+        return []
+    pivot = random.randint(bounds[0], bounds[1])
+    rows = []
+    scanned = read = 0
+    for low, high in ((pivot, bounds[1]), (bounds[0], pivot - 1)):
+        while len(rows) < limit and scanned < CANDIDATE_SCAN_LIMIT and read < CANDIDATE_READ_LIMIT and low <= high:
+            page = conn.execute('SELECT * FROM users WHERE id >= ? AND id <= ? ORDER BY id LIMIT ?', (low, high, CANDIDATE_PAGE_SIZE)).fetchall()
+            eligible = [row for row in page if row['id'] != user_id and not is_excluded(row['id'], exclude)]
+            scanned += len(eligible)
+            read += len(page)
+            rows += eligible
+            if len(page) < CANDIDATE_PAGE_SIZE:
+                break
+            low = page[-1]['id'] + 1
+    return rows[:limit]
+
+
+def find_candidates(conn: sqlite3.Connection, user_id: int, limit: int,
+                    exclude: Sequence[Container[int]] = ()) -> List[Tuple[sqlite3.Row, Optional[float]]]:
+    viewer = fetch_profile(conn, user_id)
+    if viewer and viewer['latitude'] is not None and viewer['longitude'] is not None:
+        min_age = max_age = None
+        if AGE_WINDOW is not None and viewer['age'] is not None:
+            min_age, max_age = viewer['age'] - AGE_WINDOW, viewer['age'] + AGE_WINDOW
+        return find_nearby_profiles(conn, user_id, viewer['latitude'], viewer['longitude'], limit, exclude,
+                                    min_age=min_age, max_age=max_age)
+    return [(row, None) for row in find_random_profiles(conn, user_id, limit, exclude)]
+
+
+class SeenSet:
+    # Компактное множество id в стиле roaring bitmap: старшие 16 бит выбирают контейнер,
+    # младшие хранятся в отсортированном array('H'), а при заполнении контейнер становится битовой картой на 8 КБ.
+    ARRAY_LIMIT = 4096
+
+    def __init__(self) -> None:
+        self.containers: Dict[int, Any] = {}
+
+    def add(self, value: int) -> None:
+        high, low = value >> 16, value & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array('H', [low])
+        elif isinstance(container, bytearray):
+            container[low >> 3] |= 1 << (low & 7)
+        else:
+            index = bisect_left(container, low)
+            if index == len(container) or container[index] != low:
+                container.insert(index, low)
+                if len(container) > self.ARRAY_LIMIT:
+                    bitmap = bytearray(8192)
+                    for item in container:
+                        bitmap[item >> 3] |= 1 << (item & 7)
+                    self.containers[high] = bitmap
+
+    def __contains__(self, value: int) -> bool:
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
+        index = bisect_left(container, low)
+        return index < len(container) and container[index] == low
+
+
+# Множества просмотренных анкет живут только в потоке БД: все обращения к ним идут через run_db.
+_seen_sets: 'OrderedDict[int, Tuple[SeenSet, float]]' = OrderedDict()
+
+
+def get_seen_set(conn: sqlite3.Connection, user_id: int) -> SeenSet:
+    entry = _seen_sets.get(user_id)
+    if entry is not None and time.monotonic() - entry[1] <= SEEN_TTL:
+        _seen_sets.move_to_end(user_id)
+        return entry[0]
+
+    now = int(time.time())
+    view_cutoff = now - VIEW_COOLDOWN_HOURS * 3600
+    dislike_cutoff = now - RESHOW_AFTER_DAYS * 86400 if RESHOW_AFTER_DAYS is not None else 0
+    seen = SeenSet()
+    for row in conn.execute('SELECT liked_user_id FROM likes WHERE user_id = ?', (user_id,)):
+        seen.add(row[0])
+    for row in conn.execute(
+        'SELECT viewed_user_id FROM views WHERE user_id = ? AND viewed_at >= CASE WHEN disliked THEN ? ELSE ? END',
+        (user_id, dislike_cutoff, view_cutoff)
+    ):
+        seen.add(row[0])
+    swipe_buffer.replay(user_id, seen)
+
+    _seen_sets[user_id] = (seen, time.monotonic())
+    _seen_sets.move_to_end(user_id)
+    while len(_seen_sets) > SEEN_MAX_USERS:
+        _seen_sets.popitem(last=False)
+    return seen
+
+
+class ProfileFeed:
+    def __init__(self) -> None:
+        self.queue = deque()
+        self.queued = set()
+        self.likers = set()
+        self.refill_task: Optional[asyncio.Task] = None
+
+
+_feeds: 'OrderedDict[int, ProfileFeed]' = OrderedDict()
+_feed_invalidated: 'OrderedDict[int, float]' = OrderedDict()
+
+
+def get_feed(user_id: int) -> ProfileFeed:
+    feed = _feeds.get(user_id)
+    if feed is None:
+        feed = _feeds[user_id] = ProfileFeed()
+        while len(_feeds) > FEED_MAX_USERS:
+            _feeds.popitem(last=False)
+    else:
+        _feeds.move_to_end(user_id)
+        if feed.queue and time.monotonic() - feed.queue[0][3] > FEED_TTL:
+            feed.queue.clear()
+            feed.queued.clear()
+    return feed
+
+
+def drop_feed(user_id: int) -> None:
+    _feeds.pop(user_id, None)
+
+
+def invalidate_feed_profile(profile_id: int) -> None:
+    now = time.monotonic()
+    _feed_invalidated.pop(profile_id, None)
+    _feed_invalidated[profile_id] = now
+    while _feed_invalidated:
+        oldest_id, invalidated_at = next(iter(_feed_invalidated.items()))
+        if now - invalidated_at <= FEED_TTL:
+            break
+        del _feed_invalidated[oldest_id]
+
+
+def profile_changed(profile_id: int) -> None:
+    # Кэши анкет у каждого воркера свои: об изменении анкеты сообщается остальным воркерам,
+    # если очередь воркера переполнена, его кэш догонит изменение по TTL.
+    invalidate_feed_profile(profile_id)
+    for index in range(WORKER_COUNT):
+        if index != WORKER_INDEX and not send_to_worker(index, ('invalidate', profile_id)):
+            logger.warning(f"Очередь воркера {index} переполнена, кэш анкеты {profile_id} обновится по TTL")
+
+
+def load_feed_batch(user_id: int, queued: set) -> Tuple[List[Tuple[sqlite3.Row, Optional[float]]], List[Tuple[sqlite3.Row, Optional[float]]]]:
+    # Сначала те, кто уже лайкнул пользователя и ждет ответа, затем обычные кандидаты.
+    with get_db_connection() as conn:
+        seen = get_seen_set(conn, user_id)
+        likers = find_pending_likers(conn, user_id, FEED_BATCH_SIZE, (seen,))
+        liker_ids = {profile['id'] for profile, _ in likers}
+        candidates = []
+        if len(likers) < FEED_BATCH_SIZE:
+            candidates = find_candidates(conn, user_id, FEED_BATCH_SIZE - len(likers), (queued, seen, liker_ids))
+    return likers, candidates
+
+
+class ProfileCache:
+    # Read-through кэш строк users по id, включая отсутствующие анкеты (None).
+    # Как и множества просмотренных анкет, используется только из потока БД.
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: 'OrderedDict[int, Tuple[Optional[sqlite3.Row], float]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
+        entry = self.entries.get(user_id)
+        now = time.monotonic()
+        if entry is not None and now - entry[1] <= self.ttl:
+            self.hits += 1
+            self.entries.move_to_end(user_id)
+            return entry[0]
+        self.misses += 1
+        row = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        self.entries[user_id] = (row, now)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return row
+
+    def invalidate(self, user_id: int) -> None:
+        self.entries.pop(user_id, None)
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def forget_profile(user_id: int) -> None:
+    # Анкету изменил другой воркер: закэшированная здесь строка и множество просмотренных устарели.
+    profile_cache.invalidate(user_id)
+    _seen_sets.pop(user_id, None)
+
+
+def fetch_profile(conn: sqlite3.Connection, user_id: int) -> Optional[sqlite3.Row]:
+    return profile_cache.get(conn, user_id)
+
+
+def load_profile(user_id: int) -> Optional[sqlite3.Row]:
+    with get_db_connection() as conn:
+        return fetch_profile(conn, user_id)
+
+
+def extract_media(message) -> List[Dict[str, Any]]:
+    # Метаданные медиа из сообщения: для фото сохраняются все размеры, а для ленты заранее выбирается
+    # самый маленький размер не меньше FEED_PHOTO_MIN_SIDE, чтобы не гонять полноразмерный файл.
+    if message.photo:
+        sizes = sorted(message.photo, key=lambda size: size.width * size.height)
+        largest = sizes[-1]
+        feed = next((size for size in sizes if max(size.width, size.height) >= FEED_PHOTO_MIN_SIDE), largest)
+        return [{
+            'media_type': 'photo', 'file_id': largest.file_id, 'file_unique_id': largest.file_unique_id,
+            'width': largest.width, 'height': largest.height, 'duration': None, 'file_size': largest.file_size,
+            'feed_file_id': feed.file_id,
+            'sizes': [{'file_id': size.file_id, 'file_unique_id': size.file_unique_id, 'width': size.width,
+                       'height': size.height, 'file_size': size.file_size} for size in sizes],
+        }]
+    if message.video:
+        video = message.video
+        duration = video.duration.total_seconds() if isinstance(video.duration, timedelta) else video.duration
+        return [{
+            'media_type': 'video', 'file_id': video.file_id, 'file_unique_id': video.file_unique_id,
+            'width': video.width, 'height': video.height, 'duration': duration, 'file_size': video.file_size,
+            'feed_file_id': video.file_id, 'sizes': None,
+        }]
+    return []
+
+
+def replace_profile_media(conn, user_id: int, items: List[Dict[str, Any]]) -> None:
+    now = time.time()
+    conn.execute('DELETE FROM media WHERE user_id = ?', (user_id,))
+    conn.executemany('''
+        INSERT INTO media (user_id, position, media_type, file_id, file_unique_id, width, height, duration, file_size, sizes, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (user_id, position, item['media_type'], item['file_id'], item['file_unique_id'], item['width'], item['height'],
+         item['duration'], item['file_size'], json.dumps(item['sizes']) if item['sizes'] else None, now)
+        for position, item in enumerate(items)
+    ])
+    # Главное медиа дублируется в users, чтобы лента отправляла анкету из кэшированной строки без лишнего запроса.
+    primary = items[0]
+    conn.execute(
+        'UPDATE users SET photo_file_id = ?, media_type = ?, feed_file_id = ? WHERE id = ?',
+        (primary['file_id'], primary['media_type'], primary['feed_file_id'], user_id)
+    )
+
+
+def load_profile_media(user_id: int) -> List[sqlite3.Row]:
+    with get_db_connection() as conn:
+        return conn.execute('SELECT * FROM media WHERE user_id = ? ORDER BY position', (user_id,)).fetchall()
+
+
+def insert_profile(user_id: int, username: Optional[str], name: str, age: int, bio: str, media: List[Dict[str, Any]]) -> None:
+    with get_db_connection() as conn:
+        conn.execute('''
+            INSERT INTO users (id, username, name, age, bio)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, username, name, age, bio))
+        replace_profile_media(conn, user_id, media)
+        bump_stats(conn, registrations=1)
+    profile_cache.invalidate(user_id)
+
+
+def update_profile_media(user_id: int, media: List[Dict[str, Any]]) -> None:
+    with get_db_connection() as conn:
+        replace_profile_media(conn, user_id, media)
+    profile_cache.invalidate(user_id)
+
+
+def update_profile_location(user_id: int, latitude: float, longitude: float) -> bool:
+    with get_db_connection() as conn:
+        existing_location = fetch_profile(conn, user_id)
+        had_location = bool(existing_location and existing_location['latitude'] is not None and existing_location['longitude'] is not None)
+        conn.execute('UPDATE users SET latitude = ?, longitude = ?, geo_cell = ? WHERE id = ?', (latitude, longitude, geo_cell(latitude, longitude), user_id))
+        if existing_location and not had_location:
+            conn.execute('''
+                INSERT INTO geo_stats (lat_bucket, lon_bucket, registrations) VALUES (?, ?, 1)
+                ON CONFLICT(lat_bucket, lon_bucket) DO UPDATE SET registrations = registrations + 1
+            ''', heatmap_bucket(latitude, longitude))
+    profile_cache.invalidate(user_id)
+    return had_location
+
+
+def delete_profile(user_id: int) -> None:
+    # Синхронно удаляются только анкета и матчи (поиск по ключу); лайки, просмотры и сообщения
+    # старой анкеты чистит фоновая задача purge_user небольшими транзакциями. До её завершения
+    # tombstone помечает, какие строки относятся к удалённой анкете.
+    _seen_sets.pop(user_id, None)
+    with get_db_connection() as conn:
+        swipe_buffer.flush(conn)
+        conn.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.execute('DELETE FROM media WHERE user_id = ?', (user_id,))
+        match_ids = [row['match_id'] for row in conn.execute('SELECT match_id FROM match_members WHERE user_id = ?', (user_id,))]
+        conn.executemany('DELETE FROM match_members WHERE match_id = ?', [(match_id,) for match_id in match_ids])
+        conn.executemany('DELETE FROM matches WHERE id = ?', [(match_id,) for match_id in match_ids])
+        conn.execute('''
+            INSERT INTO tombstones (user_id, deleted_at, like_cutoff, message_cutoff)
+            VALUES (?, ?, (SELECT COALESCE(MAX(id), 0) FROM likes), (SELECT COALESCE(MAX(id), 0) FROM messages))
+            ON CONFLICT(user_id) DO UPDATE SET deleted_at = excluded.deleted_at,
+                like_cutoff = excluded.like_cutoff, message_cutoff = excluded.message_cutoff
+        ''', (user_id, time.time()))
+        enqueue_job(conn, 'purge_user', {'user_id': user_id})
+        conn.execute('DELETE FROM inbox_counts WHERE user_id = ?', (user_id,))
+        bump_stats(conn, deletions=1)
+    profile_cache.invalidate(user_id)
+
+
+class SwipeBuffer:
+    # Просмотры, дизлайки и лайки без взаимности копятся здесь и пишутся в БД одной транзакцией
+    # (flush_swipes). Еще не записанные лайки доступны через likes, поэтому проверка взаимности
+    # видит их сразу. Как и остальные кэши, используется только из потока БД.
+    def __init__(self) -> None:
+        self.views: Dict[Tuple[int, int], int] = {}
+        self.dislikes: Dict[Tuple[int, int], int] = {}
+        self.likes: Dict[Tuple[int, int], float] = {}
+        self.notices: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self.views) + len(self.dislikes) + len(self.likes)
+
+    def replay(self, user_id: int, seen: 'SeenSet') -> None:
+        for pending in (self.views, self.dislikes, self.likes):
+            for viewer, target in pending:
+                if viewer == user_id:
+                    seen.add(target)
+
+    def flush(self, conn) -> None:
+        if not self:
+            return
+        conn.executemany('''
+            INSERT INTO views (user_id, viewed_user_id, viewed_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id, viewed_user_id) DO UPDATE SET viewed_at = excluded.viewed_at
+        ''', [(user_id, target, viewed_at) for (user_id, target), viewed_at in self.views.items()])
+        conn.executemany('''
+            INSERT INTO views (user_id, viewed_user_id, disliked, viewed_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(user_id, viewed_user_id) DO UPDATE SET disliked = 1, viewed_at = excluded.viewed_at
+        ''', [(user_id, target, viewed_at) for (user_id, target), viewed_at in self.dislikes.items()])
+        inserted = conn.executemany(
+            'INSERT OR IGNORE INTO likes (user_id, liked_user_id, liked_at) VALUES (?, ?, ?)',
+            [(user_id, target, liked_at) for (user_id, target), liked_at in self.likes.items()]
+        ).rowcount
+        counts = Counter()
+        for (user_id, target), liked_at in self.likes.items():
+            row = conn.execute('''
+                INSERT INTO inbox (user_id, liker_id, liked_at, dismissed)
+                VALUES (?, ?, ?, COALESCE((SELECT disliked FROM views WHERE user_id = ? AND viewed_user_id = ?), 0))
+                ON CONFLICT(user_id, liker_id) DO NOTHING
+                RETURNING dismissed
+            ''', (target, user_id, liked_at, target, user_id)).fetchone()
+            if row is not None and not row['dismissed']:
+                counts[target] += 1
+        for user_id, target in self.dislikes:
+            if conn.execute('UPDATE inbox SET dismissed = 1 WHERE user_id = ? AND liker_id = ? AND dismissed = 0', (user_id, target)).rowcount:
+                counts[user_id] -= 1
+        update_inbox_counts(conn, counts)
+        matches = 0
+        if WORKER_COUNT > 1:
+            # Встречный лайк мог быть в буфере другого воркера: матч создается при записи. Как в record_like,
+            # входящие лайки пары снимаются из inbox, а уведомления о матче обоим пишутся в outbox той же
+            # транзакцией; SwipeWriter передает их воркерам-владельцам чатов.
+            counts = Counter()
+            for user_id, target in self.likes:
+                if conn.execute('SELECT 1 FROM likes WHERE user_id = ? AND liked_user_id = ?', (target, user_id)).fetchone() is not None:
+                    if conn.execute('SELECT 1 FROM match_members WHERE user_id = ? AND peer_id = ?', (user_id, target)).fetchone() is None:
+                        create_match(conn, user_id, target, time.time())
+                        matches += 1
+                        for row in conn.execute(
+                            'DELETE FROM inbox WHERE (user_id = ? AND liker_id = ?) OR (user_id = ? AND liker_id = ?) RETURNING user_id, dismissed',
+                            (user_id, target, target, user_id)
+                        ).fetchall():
+                            if not row['dismissed']:
+                                counts[row['user_id']] -= 1
+                        self.notify_match(conn, user_id, target)
+            update_inbox_counts(conn, counts)
+        bump_stats(conn, likes=max(inserted, 0), dislikes=len(self.dislikes), matches=matches)
+        metrics.inc('bot_swipe_flushes_total')
+        metrics.inc('bot_swipe_events_flushed_total', value=len(self))
+        self.views.clear()
+        self.dislikes.clear()
+        self.likes.clear()
+
+    def notify_match(self, conn, user_id: int, peer_id: int) -> None:
+        profiles = {profile_id: fetch_profile(conn, profile_id) for profile_id in (user_id, peer_id)}
+        if None in profiles.values():
+            return
+        now = time.time()
+        for chat_id, peer in ((user_id, peer_id), (peer_id, user_id)):
+            self.notices.append(insert_outbox(conn, chat_id, 'sticker', {'sticker': MATCH_STICKER}, now))
+            self.notices.append(insert_outbox(
+                conn, chat_id, 'text', {'text': match_notice(peer, profiles[peer]['username']), 'parse_mode': 'MarkdownV2'}, now
+            ))
+
+
+swipe_buffer = SwipeBuffer()
+
+
+def flush_swipes() -> List[Dict[str, Any]]:
+    # Возвращает уведомления, записанные в outbox этой и предыдущими записями буфера (например, из record_like).
+    with get_db_connection() as conn:
+        swipe_buffer.flush(conn)
+    notices, swipe_buffer.notices = swipe_buffer.notices, []
+    return notices
+
+
+def record_view(user_id: int, viewed_user_id: int) -> None:
+    with get_db_connection() as conn:
+        get_seen_set(conn, user_id).add(viewed_user_id)
+    swipe_buffer.views[(user_id, viewed_user_id)] = int(time.time())
+
+
+def record_dislike(user_id: int, disliked_user_id: int) -> None:
+    with get_db_connection() as conn:
+        get_seen_set(conn, user_id).add(disliked_user_id)
+    swipe_buffer.dislikes[(user_id, disliked_user_id)] = int(time.time())
+
+
+def update_inbox_counts(conn, counts: Dict[int, int]) -> None:
+    conn.executemany('''
+        INSERT INTO inbox_counts (user_id, pending) VALUES (?, MAX(?, 0))
+        ON CONFLICT(user_id) DO UPDATE SET pending = MAX(pending + ?, 0)
+    ''', [(user_id, delta, delta) for user_id, delta in counts.items() if delta])
+
+
+def record_like(user_id: int, liked_user_id: int) -> bool:
+    with get_db_connection() as conn:
+        get_seen_set(conn, user_id).add(liked_user_id)
+        cutoff, deleted_at = conn.execute(
+            'SELECT MAX(like_cutoff), MAX(deleted_at) FROM tombstones WHERE user_id IN (?, ?)', (user_id, liked_user_id)
+        ).fetchone()
+        # Взаимность проверяется по входящим лайкам пользователя: сначала еще не записанные, затем inbox.
+        # Входящий лайк уже ставшей матчем пары удален из inbox, поэтому существующий матч тоже считается взаимностью.
+        mutual_like = (liked_user_id, user_id) in swipe_buffer.likes or conn.execute(
+            'SELECT 1 FROM inbox WHERE user_id = ? AND liker_id = ? AND liked_at > ?', (user_id, liked_user_id, deleted_at or 0)
+        ).fetchone() is not None or conn.execute(
+            'SELECT 1 FROM match_members WHERE user_id = ? AND peer_id = ?', (user_id, liked_user_id)
+        ).fetchone() is not None
+        if not mutual_like and cutoff is None:
+            swipe_buffer.likes.setdefault((user_id, liked_user_id), time.time())
+            return False
+
+        # Взаимный лайк и лайки, задетые удалением анкеты, пишутся сразу вместе с накопленным буфером,
+        # чтобы матч существовал до ответа пользователю.
+        swipe_buffer.flush(conn)
+        if cutoff is not None:
+            # Лайки удалённой анкеты, которые ещё не дочистила purge_user, не должны давать матч новой анкете.
+            conn.execute(
+                'DELETE FROM likes WHERE id <= ? AND ((user_id = ? AND liked_user_id = ?) OR (user_id = ? AND liked_user_id = ?))',
+                (cutoff, user_id, liked_user_id, liked_user_id, user_id)
+            )
+            conn.execute(
+                'DELETE FROM inbox WHERE liked_at <= ? AND ((user_id = ? AND liker_id = ?) OR (user_id = ? AND liker_id = ?))',
+                (deleted_at, user_id, liked_user_id, liked_user_id, user_id)
+            )
+            for owner in (user_id, liked_user_id):
+                conn.execute('''
+                    INSERT OR REPLACE INTO inbox_counts (user_id, pending)
+                    SELECT ?, COUNT(*) FROM inbox WHERE user_id = ? AND dismissed = 0
+                ''', (owner, owner))
+        if not mutual_like:
+            swipe_buffer.likes.setdefault((user_id, liked_user_id), time.time())
+            swipe_buffer.flush(conn)
+            return False
+
+        inserted = conn.execute(
+            'INSERT OR IGNORE INTO likes (user_id, liked_user_id, liked_at) VALUES (?, ?, ?)', (user_id, liked_user_id, time.time())
+        ).rowcount
+        pending = conn.execute(
+            'DELETE FROM inbox WHERE user_id = ? AND liker_id = ? RETURNING dismissed', (user_id, liked_user_id)
+        ).fetchone()
+        if pending is not None and not pending['dismissed']:
+            update_inbox_counts(conn, {user_id: -1})
+        created = False
+        if conn.execute('SELECT 1 FROM match_members WHERE user_id = ? AND peer_id = ?', (user_id, liked_user_id)).fetchone() is None:
+            create_match(conn, user_id, liked_user_id, time.time())
+            created = True
+        bump_stats(conn, likes=inserted, matches=int(created))
+    return True
+
+
+def load_inbox_count(user_id: int) -> int:
+    with get_db_connection() as conn:
+        # Счетчик обновляется при записи буфера: если в нем есть свайпы, меняющие счетчик пользователя, пишем их сейчас.
+        if any(target == user_id for _, target in swipe_buffer.likes) or any(viewer == user_id for viewer, _ in swipe_buffer.dislikes):
+            swipe_buffer.flush(conn)
+        row = conn.execute('SELECT pending FROM inbox_counts WHERE user_id = ?', (user_id,)).fetchone()
+    return row['pending'] if row else 0
+
+
+def find_pending_likers(conn: sqlite3.Connection, user_id: int, limit: int,
+                        exclude: Sequence[Container[int]] = ()) -> List[Tuple[sqlite3.Row, Optional[float]]]:
+    viewer = fetch_profile(conn, user_id)
+    deleted_at = conn.execute('SELECT deleted_at FROM tombstones WHERE user_id = ?', (user_id,)).fetchone()
+    liker_ids = [liker_id for (liker_id, target) in swipe_buffer.likes if target == user_id]
+    liker_ids += [row['liker_id'] for row in conn.execute(
+        'SELECT liker_id FROM inbox WHERE user_id = ? AND dismissed = 0 AND liked_at > ? ORDER BY liked_at LIMIT ?',
+        (user_id, deleted_at['deleted_at'] if deleted_at else 0, limit * 2)
+    )]
+    likers = []
+    for liker_id in dict.fromkeys(liker_ids):
+        if len(likers) >= limit:
+            break
+        if is_excluded(liker_id, exclude):
+            continue
+        profile = fetch_profile(conn, liker_id)
+        if profile is None:
+            continue
+        likers.append((profile, profile_distance(viewer, profile)))
+    return likers
+
+
+def profile_distance(viewer: Optional[Any], profile: Any) -> Optional[float]:
+    if viewer and viewer['latitude'] is not None and profile['latitude'] is not None:
+        return calculate_distance(viewer['latitude'], viewer['longitude'], profile['latitude'], profile['longitude'])
+    return None
+
+
+def load_pending_liker(user_id: int, liker_id: int) -> Optional[Tuple[sqlite3.Row, Optional[float]]]:
+    # Один новый входящий лайк для ленты в памяти: без поиска кандидатов и без прохода по всему inbox.
+    with get_db_connection() as conn:
+        if liker_id in get_seen_set(conn, user_id):
+            return None
+        if (liker_id, user_id) not in swipe_buffer.likes and conn.execute(
+            'SELECT 1 FROM inbox WHERE user_id = ? AND liker_id = ? AND dismissed = 0', (user_id, liker_id)
+        ).fetchone() is None:
+            return None
+        profile = fetch_profile(conn, liker_id)
+        if profile is None:
+            return None
+        return profile, profile_distance(fetch_profile(conn, user_id), profile)
+
+
+class SwipeWriter:
+    # Групповая запись свайпов: буфер сбрасывается не реже чем раз в SWIPE_FLUSH_INTERVAL
+    # или сразу после SWIPE_FLUSH_EVENTS событий. SWIPE_DURABILITY = 'immediate' возвращает
+    # запись каждого свайпа отдельной транзакцией; в режиме 'batched' при падении процесса
+    # теряются свайпы за последние миллисекунды.
+    def __init__(self) -> None:
+        self.pending = 0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        for item in await run_db(flush_swipes):
+            notifier.route(item)
+
+    async def record(self, func, *args):
+        result = await run_db(func, *args)
+        if SWIPE_DURABILITY == 'immediate' or self.task is None:
+            await self.flush()
+        else:
+            self.pending += 1
+            if self.pending == 1 or self.pending >= SWIPE_FLUSH_EVENTS:
+                self.wakeup.set()
+        return result
+
+    async def _run(self) -> None:
+        failures = 0
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.pending < SWIPE_FLUSH_EVENTS:
+                await asyncio.sleep(SWIPE_FLUSH_INTERVAL)
+            pending, self.pending = self.pending, 0
+            try:
+                await self.flush()
+            except Exception as e:
+                # Буфер очищается только после успешной записи, поэтому свайпы не теряются: запись
+                # повторяется с растущей паузой, а задача не умирает от одной ошибки вроде database is locked.
+                failures += 1
+                metrics.inc('bot_swipe_flush_errors_total')
+                logger.error(f"Ошибка при записи свайпов (попытка {failures}): {e}")
+                await asyncio.sleep(min(SWIPE_FLUSH_INTERVAL * 2 ** failures, SWIPE_RETRY_MAX_DELAY))
+                self.pending += pending
+                self.wakeup.set()
+            else:
+                failures = 0
+
+
+swipes = SwipeWriter()
+
+
+def create_match(conn, user_id: int, peer_id: int, now: float) -> int:
+    row = conn.execute('SELECT match_id FROM match_members WHERE user_id = ? AND peer_id = ?', (user_id, peer_id)).fetchone()
+    if row is not None:
+        return row['match_id']
+    match_id = conn.execute('INSERT INTO matches (created_at) VALUES (?)', (now,)).lastrowid
+    conn.executemany(
+        'INSERT INTO match_members (user_id, peer_id, match_id, activity_at) VALUES (?, ?, ?, ?)',
+        [(user_id, peer_id, match_id, now), (peer_id, user_id, match_id, now)]
+    )
+    return match_id
+
+
+def load_match(user_id: int, peer_id: int) -> Optional[sqlite3.Row]:
+    with get_db_connection() as conn:
+        return conn.execute('''
+            SELECT m.match_id, m.peer_id, m.unread, u.name
+            FROM match_members m LEFT JOIN users u ON u.id = m.peer_id
+            WHERE m.user_id = ? AND m.peer_id = ?
+        ''', (user_id, peer_id)).fetchone()
+
+
+def load_matches(user_id: int, before: Optional[Tuple[float, int]], limit: int) -> List[sqlite3.Row]:
+    # Keyset-пагинация по (activity_at, match_id): каждая страница — один проход по индексу
+    # на limit строк плюс поиск по первичному ключу для имени и последнего сообщения.
+    activity_at, match_id = before if before else (float('inf'), 0)
+    with get_db_connection() as conn:
+        return conn.execute('''
+            SELECT m.match_id, m.peer_id, m.unread, m.activity_at, u.name,
+                   COALESCE(msg.user_id, arch.user_id) AS last_sender, COALESCE(msg.message, arch.message) AS last_message
+            FROM match_members m
+            JOIN matches c ON c.id = m.match_id
+            LEFT JOIN users u ON u.id = m.peer_id
+            LEFT JOIN messages msg ON msg.id = c.last_message_id
+            LEFT JOIN messages_archive arch ON msg.id IS NULL AND arch.id = c.last_message_id
+            WHERE m.user_id = ? AND (m.activity_at, m.match_id) < (?, ?)
+            ORDER BY m.activity_at DESC, m.match_id DESC
+            LIMIT ?
+        ''', (user_id, activity_at, match_id, limit)).fetchall()
+
+
+def load_history(match_id: int, before_id: Optional[int], limit: int) -> List[sqlite3.Row]:
+    before_id = before_id if before_id is not None else 2 ** 63 - 1
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            'SELECT id, user_id, message, sent_at FROM messages WHERE match_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (match_id, before_id, limit)
+        ).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute(
+                'SELECT id, user_id, message, sent_at FROM messages_archive WHERE match_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (match_id, rows[-1]['id'] if rows else before_id, limit - len(rows))
+            ).fetchall()
+    return rows[::-1]
+
+
+def mark_match_read(user_id: int, peer_id: int) -> None:
+    with get_db_connection() as conn:
+        conn.execute('UPDATE match_members SET unread = 0 WHERE user_id = ? AND peer_id = ? AND unread > 0', (user_id, peer_id))
+
+
+def load_usernames(*user_ids: int) -> List[Optional[str]]:
+    with get_db_connection() as conn:
+        profiles = [fetch_profile(conn, user_id) for user_id in user_ids]
+    return [profile['username'] if profile else None for profile in profiles]
+
+
+def insert_message(match_id: int, user_id: int, matched_user_id: int, text: str) -> int:
+    now = time.time()
+    with get_db_connection() as conn:
+        message_id = conn.execute(
+            'INSERT INTO messages (user_id, matched_user_id, message, match_id, sent_at) VALUES (?, ?, ?, ?, ?)',
+            (user_id, matched_user_id, text, match_id, now)
+        ).lastrowid
+        conn.execute('UPDATE matches SET last_message_id = ?, last_message_at = ? WHERE id = ?', (message_id, now, match_id))
+        conn.execute('UPDATE match_members SET activity_at = ? WHERE match_id = ?', (now, match_id))
+        conn.execute('UPDATE match_members SET unread = unread + 1 WHERE user_id = ? AND peer_id = ?', (matched_user_id, user_id))
+        bump_stats(conn, messages=1)
+    return message_id
+
+
+def heatmap_bucket(latitude: float, longitude: float) -> Tuple[int, int]:
+    return floor(latitude / HEATMAP_CELL_DEG), floor(longitude / HEATMAP_CELL_DEG)
+
+
+def bump_stats(conn, **amounts: int) -> None:
+    # Агрегаты обновляются в той же транзакции, что и само событие: дневная строка и общий счетчик.
+    # Отчеты администратора читают только их и не считают COUNT(*) по большим таблицам.
+    day = time.strftime('%Y-%m-%d')
+    amounts = [(metric, amount) for metric, amount in amounts.items() if amount]
+    conn.executemany('''
+        INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?)
+        ON CONFLICT(day, metric) DO UPDATE SET value = value + excluded.value
+    ''', [(day, metric, amount) for metric, amount in amounts])
+    conn.executemany('''
+        INSERT INTO counters (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    ''', amounts)
+
+
+def record_active_user(day: str, user_id: int) -> None:
+    with get_db_connection() as conn:
+        if conn.execute('INSERT OR IGNORE INTO active_users (day, user_id) VALUES (?, ?)', (day, user_id)).rowcount:
+            conn.execute('''
+                INSERT INTO daily_stats (day, metric, value) VALUES (?, 'active_users', 1)
+                ON CONFLICT(day, metric) DO UPDATE SET value = value + 1
+            ''', (day,))
+
+
+def load_stats(days: int) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+    first_day = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+    with get_db_connection() as conn:
+        daily: Dict[str, Dict[str, int]] = {}
+        for row in conn.execute('SELECT day, metric, value FROM daily_stats WHERE day >= ? ORDER BY day', (first_day,)):
+            daily.setdefault(row['day'], {})[row['metric']] = row['value']
+        totals = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM counters')}
+    return daily, totals
+
+
+def load_heatmap(limit: int) -> List[sqlite3.Row]:
+    with get_db_connection() as conn:
+        return conn.execute('SELECT * FROM geo_stats ORDER BY registrations DESC LIMIT ?', (limit,)).fetchall()
+
+
+def load_digest_snapshot() -> Tuple[Dict[str, int], Dict[Tuple[int, int], int]]:
+    with get_db_connection() as conn:
+        totals = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM counters')}
+        geo = {(row['lat_bucket'], row['lon_bucket']): row['registrations'] for row in conn.execute('SELECT * FROM geo_stats')}
+    return totals, geo
+
+
+class UserStore(ABC):
+    # Хранилище, через которое работают обработчики: анкеты, лента, лайки и переписка.
+    # Реализации — SQLite (по умолчанию) и PostgreSQL, выбираются через STORAGE_BACKEND.
+    # Строки возвращаются как sqlite3.Row или asyncpg.Record: обе поддерживают доступ row['column'].
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def usernames(self, *user_ids: int) -> List[Optional[str]]:
+        ...
+
+    @abstractmethod
+    async def create(self, user_id: int, username: Optional[str], name: str, age: int, bio: str,
+                     media: List[Dict[str, Any]]) -> None:
+        ...
+
+    @abstractmethod
+    async def update_media(self, user_id: int, media: List[Dict[str, Any]]) -> None:
+        ...
+
+    @abstractmethod
+    async def update_location(self, user_id: int, latitude: float, longitude: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def feed_batch(self, user_id: int, queued: set) -> Tuple[List[Tuple[Any, Optional[float]]], List[Tuple[Any, Optional[float]]]]:
+        ...
+
+    @abstractmethod
+    async def pending_liker(self, user_id: int, liker_id: int) -> Optional[Tuple[Any, Optional[float]]]:
+        ...
+
+
+class LikeStore(ABC):
+    @abstractmethod
+    async def view(self, user_id: int, viewed_user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def dislike(self, user_id: int, disliked_user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def like(self, user_id: int, liked_user_id: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def pending_count(self, user_id: int) -> int:
+        ...
+
+
+class MessageStore(ABC):
+    @abstractmethod
+    async def get_match(self, user_id: int, peer_id: int) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    async def list_matches(self, user_id: int, before: Optional[Tuple[float, int]], limit: int) -> List[Any]:
+        ...
+
+    @abstractmethod
+    async def history(self, match_id: int, before_id: Optional[int], limit: int) -> List[Any]:
+        ...
+
+    @abstractmethod
+    async def mark_read(self, user_id: int, peer_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def send(self, match_id: int, user_id: int, matched_user_id: int, text: str) -> int:
+        ...
+
+
+class StatsStore(ABC):
+    # Агрегаты для /stats, /heatmap и сводки администратору. Хранилища обновляют их сами
+    # в транзакциях событий (bump_stats), отсюда только чтение и учет активных пользователей.
+    @abstractmethod
+    async def record_active_user(self, day: str, user_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def daily(self, days: int) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+        ...
+
+    @abstractmethod
+    async def heatmap(self, limit: int) -> List[Any]:
+        ...
+
+    @abstractmethod
+    async def digest_snapshot(self) -> Tuple[Dict[str, int], Dict[Tuple[int, int], int]]:
+        ...
+
+
+class JobStore(ABC):
+    # Очередь фоновых задач (purge_user, retention, vacuum) живет в той же базе, что и данные,
+    # которые они чистят: задача ставится в одной транзакции с tombstone. Выполняет их JobRunner.
+    @property
+    @abstractmethod
+    def recurring(self) -> Tuple[str, ...]:
+        ...
+
+    @abstractmethod
+    async def next_job(self) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def step(self, job: Dict[str, Any]) -> bool:
+        ...
+
+    @abstractmethod
+    async def finish(self, job: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    async def reschedule(self, job: Dict[str, Any], attempts: int, run_after: float) -> None:
+        ...
+
+    @abstractmethod
+    async def ensure_recurring(self) -> None:
+        ...
+
+
+class Storage:
+    def __init__(self, users: UserStore, likes: LikeStore, messages: MessageStore, stats: StatsStore, jobs: JobStore) -> None:
+        self.users = users
+        self.likes = likes
+        self.messages = messages
+        self.stats = stats
+        self.jobs = jobs
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class SQLiteUserStore(UserStore):
+    async def get(self, user_id: int) -> Optional[sqlite3.Row]:
+        return await run_db(load_profile, user_id)
+
+    async def usernames(self, *user_ids: int) -> List[Optional[str]]:
+        return await run_db(load_usernames, *user_ids)
+
+    async def create(self, user_id: int, username: Optional[str], name: str, age: int, bio: str,
+                     media: List[Dict[str, Any]]) -> None:
+        await run_db(insert_profile, user_id, username, name, age, bio, media)
+
+    async def update_media(self, user_id: int, media: List[Dict[str, Any]]) -> None:
+        await run_db(update_profile_media, user_id, media)
+
+    async def update_location(self, user_id: int, latitude: float, longitude: float) -> bool:
+        return await run_db(update_profile_location, user_id, latitude, longitude)
+
+    async def delete(self, user_id: int) -> None:
+        await run_db(delete_profile, user_id)
+        jobs.wake()
+
+    async def feed_batch(self, user_id: int, queued: set) -> Tuple[List[Tuple[sqlite3.Row, Optional[float]]], List[Tuple[sqlite3.Row, Optional[float]]]]:
+        return await run_db(load_feed_batch, user_id, set(queued))
+
+    async def pending_liker(self, user_id: int, liker_id: int) -> Optional[Tuple[sqlite3.Row, Optional[float]]]:
+        return await run_db(load_pending_liker, user_id, liker_id)
+
+
+class SQLiteLikeStore(LikeStore):
+    async def view(self, user_id: int, viewed_user_id: int) -> None:
+        await swipes.record(record_view, user_id, viewed_user_id)
+
+    async def dislike(self, user_id: int, disliked_user_id: int) -> None:
+        await swipes.record(record_dislike, user_id, disliked_user_id)
+
+    async def like(self, user_id: int, liked_user_id: int) -> bool:
+        return await swipes.record(record_like, user_id, liked_user_id)
+
+    async def pending_count(self, user_id: int) -> int:
+        return await run_db(load_inbox_count, user_id)
+
+
+class SQLiteMessageStore(MessageStore):
+    async def get_match(self, user_id: int, peer_id: int) -> Optional[sqlite3.Row]:
+        return await run_db(load_match, user_id, peer_id)
+
+    async def list_matches(self, user_id: int, before: Optional[Tuple[float, int]], limit: int) -> List[sqlite3.Row]:
+        return await run_db(load_matches, user_id, before, limit)
+
+    async def history(self, match_id: int, before_id: Optional[int], limit: int) -> List[sqlite3.Row]:
+        return await run_db(load_history, match_id, before_id, limit)
+
+    async def mark_read(self, user_id: int, peer_id: int) -> None:
+        await run_db(mark_match_read, user_id, peer_id)
+
+    async def send(self, match_id: int, user_id: int, matched_user_id: int, text: str) -> int:
+        return await run_db(insert_message, match_id, user_id, matched_user_id, text)
+
+
+class SQLiteStatsStore(StatsStore):
+    async def record_active_user(self, day: str, user_id: int) -> None:
+        await run_db(record_active_user, day, user_id)
+
+    async def daily(self, days: int) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+        return await run_db(load_stats, days)
+
+    async def heatmap(self, limit: int) -> List[sqlite3.Row]:
+        return await run_db(load_heatmap, limit)
+
+    async def digest_snapshot(self) -> Tuple[Dict[str, int], Dict[Tuple[int, int], int]]:
+        return await run_db(load_digest_snapshot)
+
+
+class SQLiteJobStore(JobStore):
+    @property
+    def recurring(self) -> Tuple[str, ...]:
+        return RECURRING_JOBS
+
+    async def next_job(self) -> Optional[Dict[str, Any]]:
+        return await run_db(load_next_job)
+
+    async def step(self, job: Dict[str, Any]) -> bool:
+        return await run_db(run_job_step, job)
+
+    async def finish(self, job: Dict[str, Any]) -> None:
+        await run_db(finish_job, job)
+
+    async def reschedule(self, job: Dict[str, Any], attempts: int, run_after: float) -> None:
+        await run_db(reschedule_job, job, attempts, run_after)
+
+    async def ensure_recurring(self) -> None:
+        await run_db(ensure_recurring_jobs)
+
+
+class SQLiteStorage(Storage):
+    def __init__(self) -> None:
+        super().__init__(SQLiteUserStore(), SQLiteLikeStore(), SQLiteMessageStore(), SQLiteStatsStore(), SQLiteJobStore())
+
+    async def start(self) -> None:
+        await swipes.start()
+
+    async def stop(self) -> None:
+        await swipes.stop()
+
+
+async def pg_migrate_initial_schema(conn) -> None:
+    await conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id BIGINT PRIMARY KEY,
+        username TEXT,
+        name TEXT,
+        age INTEGER,
+        bio TEXT,
+        photo_file_id TEXT,
+        media_type TEXT,
+        feed_file_id TEXT,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_latitude ON users(latitude);
+
+    CREATE TABLE IF NOT EXISTS media (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        position INTEGER NOT NULL DEFAULT 0,
+        media_type TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        file_unique_id TEXT,
+        width INTEGER,
+        height INTEGER,
+        duration DOUBLE PRECISION,
+        file_size BIGINT,
+        sizes TEXT,
+        created_at DOUBLE PRECISION
+    );
+    CREATE INDEX IF NOT EXISTS idx_media_user ON media(user_id, position);
+
+    CREATE TABLE IF NOT EXISTS likes (
+        user_id BIGINT NOT NULL,
+        liked_user_id BIGINT NOT NULL,
+        liked_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, liked_user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_likes_liked_user ON likes(liked_user_id);
+
+    CREATE TABLE IF NOT EXISTS views (
+        user_id BIGINT NOT NULL,
+        viewed_user_id BIGINT NOT NULL,
+        disliked BOOLEAN NOT NULL DEFAULT FALSE,
+        viewed_at BIGINT NOT NULL,
+        PRIMARY KEY (user_id, viewed_user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_views_viewed_user ON views(viewed_user_id);
+
+    CREATE TABLE IF NOT EXISTS inbox (
+        user_id BIGINT NOT NULL,
+        liker_id BIGINT NOT NULL,
+        liked_at DOUBLE PRECISION NOT NULL,
+        dismissed BOOLEAN NOT NULL DEFAULT FALSE,
+        PRIMARY KEY (user_id, liker_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_inbox_pending ON inbox(user_id, liked_at) WHERE NOT dismissed;
+    CREATE INDEX IF NOT EXISTS idx_inbox_liker ON inbox(liker_id);
+
+    CREATE TABLE IF NOT EXISTS inbox_counts (
+        user_id BIGINT PRIMARY KEY,
+        pending INTEGER NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS matches (
+        id BIGSERIAL PRIMARY KEY,
+        created_at DOUBLE PRECISION NOT NULL,
+        last_message_id BIGINT,
+        last_message_at DOUBLE PRECISION
+    );
+
+    CREATE TABLE IF NOT EXISTS match_members (
+        user_id BIGINT NOT NULL,
+        peer_id BIGINT NOT NULL,
+        match_id BIGINT NOT NULL,
+        unread INTEGER NOT NULL DEFAULT 0,
+        activity_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, peer_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_match_members_activity ON match_members(user_id, activity_at, match_id);
+    CREATE INDEX IF NOT EXISTS idx_match_members_match ON match_members(match_id);
+
+    CREATE TABLE IF NOT EXISTS messages (
+        id BIGSERIAL PRIMARY KEY,
+        match_id BIGINT NOT NULL,
+        user_id BIGINT,
+        matched_user_id BIGINT,
+        message TEXT,
+        sent_at DOUBLE PRECISION
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_match ON messages(match_id, id);
+    ''')
+
+
+async def pg_migrate_postgis(conn) -> None:
+    # С PostGIS поиск рядом идет по GiST-индексу на geography (ST_DWithin и KNN-сортировка <->).
+    # Без расширения, например на локальном Postgres для проверок, остается поиск по рамке широты и гаверсинусу в SQL.
+    if not await conn.fetchval("SELECT count(*) > 0 FROM pg_available_extensions WHERE name = 'postgis'"):
+        logger.warning("PostGIS недоступен: поиск рядом будет работать без пространственного индекса")
+        return
+    await conn.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+    await conn.execute('ALTER TABLE users ADD COLUMN IF NOT EXISTS location geography(Point, 4326)')
+    await conn.execute('''
+        UPDATE users SET location = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)::geography
+        WHERE location IS NULL AND latitude IS NOT NULL AND longitude IS NOT NULL
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_users_location ON users USING GIST (location)')
+
+
+async def pg_migrate_jobs(conn) -> None:
+    await conn.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        run_after DOUBLE PRECISION NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_run_after ON jobs(run_after);
+
+    CREATE TABLE IF NOT EXISTS tombstones (
+        user_id BIGINT PRIMARY KEY,
+        deleted_at DOUBLE PRECISION NOT NULL,
+        match_ids BIGINT[] NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS messages_archive (
+        id BIGINT PRIMARY KEY,
+        match_id BIGINT NOT NULL,
+        user_id BIGINT,
+        matched_user_id BIGINT,
+        message TEXT,
+        sent_at DOUBLE PRECISION
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_archive_match ON messages_archive(match_id, id);
+    CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages(sent_at);
+    CREATE INDEX IF NOT EXISTS idx_likes_liked_at ON likes(liked_at);
+    ''')
+
+
+async def pg_migrate_stats(conn) -> None:
+    await conn.execute('''
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        value BIGINT NOT NULL,
+        PRIMARY KEY (day, metric)
+    );
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS active_users (
+        day TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        PRIMARY KEY (day, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS geo_stats (
+        lat_bucket INTEGER NOT NULL,
+        lon_bucket INTEGER NOT NULL,
+        registrations BIGINT NOT NULL,
+        PRIMARY KEY (lat_bucket, lon_bucket)
+    );
+    ''')
+    # Как в migrate_stats: начальные значения счетчиков для уже существующих данных.
+    for name, query in (
+        ('registrations', 'SELECT COUNT(*) FROM users'),
+        ('likes', 'SELECT COUNT(*) FROM likes'),
+        ('matches', 'SELECT COUNT(*) FROM matches'),
+        ('messages', 'SELECT COUNT(*) FROM messages'),
+    ):
+        await conn.execute('INSERT INTO counters (name, value) VALUES ($1, $2) ON CONFLICT DO NOTHING', name, await conn.fetchval(query))
+    buckets = Counter(
+        heatmap_bucket(row['latitude'], row['longitude'])
+        for row in await conn.fetch('SELECT latitude, longitude FROM users WHERE latitude IS NOT NULL AND longitude IS NOT NULL')
+    )
+    await conn.executemany(
+        'INSERT INTO geo_stats (lat_bucket, lon_bucket, registrations) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING',
+        [(lat_bucket, lon_bucket, count) for (lat_bucket, lon_bucket), count in buckets.items()]
+    )
+
+
+async def pg_migrate_inbox_liked_at(conn) -> None:
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_inbox_liked_at ON inbox(liked_at)')
+
+
+# Как и MIGRATIONS для SQLite: применяются по порядку, номер последней хранится в schema_version.
+PG_MIGRATIONS = [
+    pg_migrate_initial_schema,
+    pg_migrate_postgis,
+    pg_migrate_jobs,
+    pg_migrate_stats,
+    pg_migrate_inbox_liked_at,
+]
+PG_MIGRATION_LOCK = 0x6461746573
+PG_JOBS_LOCK = 0x6a6f6273
+
+
+async def migrate_postgres(conn) -> None:
+    async with conn.transaction():
+        # Воркеры и хосты стартуют одновременно: миграции выполняет тот, кто первым взял блокировку.
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', PG_MIGRATION_LOCK)
+        await conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+        version = await conn.fetchval('SELECT version FROM schema_version')
+        if version is None:
+            version = 0
+            await conn.execute('INSERT INTO schema_version (version) VALUES (0)')
+        for number in range(version, len(PG_MIGRATIONS)):
+            await PG_MIGRATIONS[number](conn)
+            await conn.execute('UPDATE schema_version SET version = $1', number + 1)
+            logger.info(f"Схема PostgreSQL обновлена до версии {number + 1} ({PG_MIGRATIONS[number].__name__})")
+
+
+# Условия "анкета еще не показана" для запросов ленты: $1 — зритель, $2 и $3 — границы
+# для дизлайков и просмотров, как в get_seen_set.
+PG_UNSEEN = '''
+    NOT EXISTS (SELECT 1 FROM likes l WHERE l.user_id = $1 AND l.liked_user_id = u.id)
+    AND NOT EXISTS (
+        SELECT 1 FROM views v WHERE v.user_id = $1 AND v.viewed_user_id = u.id
+        AND v.viewed_at >= CASE WHEN v.disliked THEN $2::bigint ELSE $3::bigint END
+    )
+'''
+
+
+async def pg_update_inbox_counts(conn, counts: Dict[int, int]) -> None:
+    await conn.executemany('''
+        INSERT INTO inbox_counts (user_id, pending) VALUES ($1, GREATEST($2::integer, 0))
+        ON CONFLICT (user_id) DO UPDATE SET pending = GREATEST(inbox_counts.pending + $2::integer, 0)
+    ''', [(user_id, delta) for user_id, delta in counts.items() if delta])
+
+
+async def pg_replace_profile_media(conn, user_id: int, items: List[Dict[str, Any]]) -> None:
+    now = time.time()
+    await conn.execute('DELETE FROM media WHERE user_id = $1', user_id)
+    await conn.executemany('''
+        INSERT INTO media (user_id, position, media_type, file_id, file_unique_id, width, height, duration, file_size, sizes, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    ''', [
+        (user_id, position, item['media_type'], item['file_id'], item['file_unique_id'], item['width'], item['height'],
+         item['duration'], item['file_size'], json.dumps(item['sizes']) if item['sizes'] else None, now)
+        for position, item in enumerate(items)
+    ])
+    primary = items[0]
+    await conn.execute(
+        'UPDATE users SET photo_file_id = $1, media_type = $2, feed_file_id = $3 WHERE id = $4',
+        primary['file_id'], primary['media_type'], primary['feed_file_id'], user_id
+    )
+
+
+async def pg_bump_stats(conn, **amounts: int) -> None:
+    # Как bump_stats: агрегаты в транзакции события. Строки блокируются в одном порядке, чтобы
+    # параллельные транзакции с несколькими метриками не ловили взаимную блокировку.
+    day = time.strftime('%Y-%m-%d')
+    amounts = sorted((metric, amount) for metric, amount in amounts.items() if amount)
+    await conn.executemany('''
+        INSERT INTO daily_stats (day, metric, value) VALUES ($1, $2, $3)
+        ON CONFLICT (day, metric) DO UPDATE SET value = daily_stats.value + excluded.value
+    ''', [(day, metric, amount) for metric, amount in amounts])
+    await conn.executemany('''
+        INSERT INTO counters (name, value) VALUES ($1, $2)
+        ON CONFLICT (name) DO UPDATE SET value = counters.value + excluded.value
+    ''', amounts)
+
+
+async def pg_enqueue_job(conn, kind: str, payload: Dict[str, Any], run_after: Optional[float] = None) -> int:
+    return await conn.fetchval(
+        'INSERT INTO jobs (kind, payload, run_after) VALUES ($1, $2, $3) RETURNING id',
+        kind, json.dumps(payload), run_after if run_after is not None else time.time()
+    )
+
+
+async def pg_delete_batch(conn, table: str, where: str, params: Tuple[Any, ...]) -> int:
+    status = await conn.execute(
+        f'DELETE FROM {table} WHERE ctid = ANY(ARRAY(SELECT ctid FROM {table} WHERE {where} LIMIT ${len(params) + 1}))',
+        *params, JOB_BATCH_SIZE
+    )
+    return int(status.split()[-1])
+
+
+async def pg_purge_user_step(conn, payload: Dict[str, Any]) -> bool:
+    # То же, что purge_user_step: входящие лайки других пользователей снимаются со счетчиков первыми,
+    # затем порциями по JOB_BATCH_SIZE чистится остальное. Переписка ищется по матчам из tombstone
+    # через индекс по match_id.
+    user_id = payload['user_id']
+    tombstone = await conn.fetchrow('SELECT * FROM tombstones WHERE user_id = $1', user_id)
+    if tombstone is None:
+        return True
+    deleted_at = tombstone['deleted_at']
+    outgoing = await conn.fetch('''
+        DELETE FROM inbox WHERE ctid = ANY(ARRAY(SELECT ctid FROM inbox WHERE liker_id = $1 AND liked_at <= $2 LIMIT $3))
+        RETURNING user_id, dismissed
+    ''', user_id, deleted_at, JOB_BATCH_SIZE)
+    if outgoing:
+        await pg_update_inbox_counts(conn, {row['user_id']: -1 for row in outgoing if not row['dismissed']})
+        return False
+    match_ids = list(tombstone['match_ids'])
+    for table, where, params in (
+        ('inbox', 'user_id = $1 AND liked_at <= $2', (user_id, deleted_at)),
+        ('views', 'user_id = $1 AND viewed_at <= $2', (user_id, int(deleted_at))),
+        ('views', 'viewed_user_id = $1 AND viewed_at <= $2', (user_id, int(deleted_at))),
+        ('likes', 'user_id = $1 AND liked_at <= $2', (user_id, deleted_at)),
+        ('likes', 'liked_user_id = $1 AND liked_at <= $2', (user_id, deleted_at)),
+        ('messages', 'match_id = ANY($1::bigint[])', (match_ids,)),
+        ('messages_archive', 'match_id = ANY($1::bigint[])', (match_ids,)),
+    ):
+        if await pg_delete_batch(conn, table, where, params):
+            return False
+    await conn.execute('DELETE FROM tombstones WHERE user_id = $1', user_id)
+    return True
+
+
+async def pg_retention_step(conn, payload: Dict[str, Any]) -> bool:
+    now = time.time()
+    active_cutoff = time.strftime('%Y-%m-%d', time.localtime(now - ACTIVE_USERS_KEEP_DAYS * 86400))
+    if await pg_delete_batch(conn, 'active_users', 'day < $1', (active_cutoff,)):
+        return False
+    if LIKE_RETENTION_DAYS is not None:
+        like_cutoff = now - LIKE_RETENTION_DAYS * 86400
+        expired = await conn.fetch('''
+            DELETE FROM inbox WHERE ctid = ANY(ARRAY(SELECT ctid FROM inbox WHERE liked_at < $1 LIMIT $2))
+            RETURNING user_id, dismissed
+        ''', like_cutoff, JOB_BATCH_SIZE)
+        if expired:
+            counts = Counter()
+            for row in expired:
+                if not row['dismissed']:
+                    counts[row['user_id']] -= 1
+            await pg_update_inbox_counts(conn, counts)
+            return False
+        if await pg_delete_batch(conn, 'likes', 'liked_at < $1', (like_cutoff,)):
+            return False
+    if MESSAGE_ARCHIVE_DAYS is not None:
+        status = await conn.execute('''
+            WITH moved AS (
+                DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE sent_at < $1 ORDER BY sent_at LIMIT $2)
+                RETURNING id, match_id, user_id, matched_user_id, message, sent_at
+            )
+            INSERT INTO messages_archive SELECT * FROM moved
+            ON CONFLICT (id) DO UPDATE SET message = excluded.message, sent_at = excluded.sent_at
+        ''', now - MESSAGE_ARCHIVE_DAYS * 86400, JOB_BATCH_SIZE)
+        if int(status.split()[-1]):
+            return False
+    return True
+
+
+# Задачи vacuum здесь нет: свободное место в PostgreSQL возвращает autovacuum.
+PG_JOB_HANDLERS = {
+    'purge_user': pg_purge_user_step,
+    'retention': pg_retention_step,
+}
+PG_RECURRING_JOBS = ('retention',)
+
+
+class PostgresUserStore(UserStore):
+    def __init__(self, storage: 'PostgresStorage') -> None:
+        self.storage = storage
+
+    async def get(self, user_id: int) -> Optional[Any]:
+        return await self.storage.query('load_profile', 'fetchrow', 'SELECT * FROM users WHERE id = $1', user_id)
+
+    async def usernames(self, *user_ids: int) -> List[Optional[str]]:
+        rows = await self.storage.query('load_usernames', 'fetch', 'SELECT id, username FROM users WHERE id = ANY($1::bigint[])', list(user_ids))
+        usernames = {row['id']: row['username'] for row in rows}
+        return [usernames.get(user_id) for user_id in user_ids]
+
+    async def create(self, user_id: int, username: Optional[str], name: str, age: int, bio: str,
+                     media: List[Dict[str, Any]]) -> None:
+        async with self.storage.transaction('insert_profile') as conn:
+            # Повторная регистрация раньше, чем purge_user дочистила старую анкету: остаток удаляется сразу,
+            # чтобы лайки и просмотры старой анкеты не относились к новой.
+            while not await pg_purge_user_step(conn, {'user_id': user_id}):
+                pass
+            await conn.execute(
+                'INSERT INTO users (id, username, name, age, bio) VALUES ($1, $2, $3, $4, $5)',
+                user_id, username, name, age, bio
+            )
+            await pg_replace_profile_media(conn, user_id, media)
+            await pg_bump_stats(conn, registrations=1)
+
+    async def update_media(self, user_id: int, media: List[Dict[str, Any]]) -> None:
+        async with self.storage.transaction('update_profile_media') as conn:
+            await pg_replace_profile_media(conn, user_id, media)
+
+    async def update_location(self, user_id: int, latitude: float, longitude: float) -> bool:
+        location = ', location = ST_SetSRID(ST_MakePoint($3, $2), 4326)::geography' if self.storage.postgis else ''
+        async with self.storage.transaction('update_profile_location') as conn:
+            had_location = await conn.fetchval(f'''
+                UPDATE users u SET latitude = $2, longitude = $3{location}
+                FROM (SELECT latitude, longitude FROM users WHERE id = $1) previous
+                WHERE u.id = $1
+                RETURNING previous.latitude IS NOT NULL AND previous.longitude IS NOT NULL
+            ''', user_id, latitude, longitude)
+            if had_location is False:
+                await conn.execute('''
+                    INSERT INTO geo_stats (lat_bucket, lon_bucket, registrations) VALUES ($1, $2, 1)
+                    ON CONFLICT (lat_bucket, lon_bucket) DO UPDATE SET registrations = geo_stats.registrations + 1
+                ''', *heatmap_bucket(latitude, longitude))
+        return bool(had_location)
+
+    async def delete(self, user_id: int) -> None:
+        # Как delete_profile: сразу удаляются анкета и матчи, лайки, просмотры и переписку
+        # дочищает задача purge_user небольшими транзакциями.
+        async with self.storage.transaction('delete_profile') as conn:
+            await conn.execute('DELETE FROM users WHERE id = $1', user_id)
+            await conn.execute('DELETE FROM media WHERE user_id = $1', user_id)
+            match_ids = [row['match_id'] for row in await conn.fetch('SELECT match_id FROM match_members WHERE user_id = $1', user_id)]
+            await conn.execute('DELETE FROM match_members WHERE match_id = ANY($1::bigint[])', match_ids)
+            await conn.execute('DELETE FROM matches WHERE id = ANY($1::bigint[])', match_ids)
+            await conn.execute('''
+                INSERT INTO tombstones (user_id, deleted_at, match_ids) VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE SET deleted_at = excluded.deleted_at,
+                    match_ids = tombstones.match_ids || excluded.match_ids
+            ''', user_id, time.time(), match_ids)
+            await pg_enqueue_job(conn, 'purge_user', {'user_id': user_id})
+            await conn.execute('DELETE FROM inbox_counts WHERE user_id = $1', user_id)
+            await pg_bump_stats(conn, deletions=1)
+        jobs.wake()
+
+    async def feed_batch(self, user_id: int, queued: set) -> Tuple[List[Tuple[Any, Optional[float]]], List[Tuple[Any, Optional[float]]]]:
+        # Фильтрация просмотренных и поиск по расстоянию выполняются на сервере: в процесс бота
+        # приходят только анкеты, которые попадут в ленту.
+        now = int(time.time())
+        view_cutoff = now - VIEW_COOLDOWN_HOURS * 3600
+        dislike_cutoff = now - RESHOW_AFTER_DAYS * 86400 if RESHOW_AFTER_DAYS is not None else 0
+        async with self.storage.connection('load_feed_batch') as conn:
+            viewer = await conn.fetchrow('SELECT * FROM users WHERE id = $1', user_id)
+            rows = await conn.fetch(f'''
+                SELECT u.* FROM inbox i JOIN users u ON u.id = i.liker_id
+                WHERE i.user_id = $1 AND NOT i.dismissed AND {PG_UNSEEN}
+                ORDER BY i.liked_at LIMIT $4
+            ''', user_id, dislike_cutoff, view_cutoff, FEED_BATCH_SIZE)
+            likers = [(row, profile_distance(viewer, row)) for row in rows]
+            exclude = list(queued) + [row['id'] for row in rows]
+            limit = FEED_BATCH_SIZE - len(likers)
+            candidates = []
+            if limit > 0 and viewer and viewer['latitude'] is not None and viewer['longitude'] is not None:
+                min_age = max_age = None
+                if AGE_WINDOW is not None and viewer['age'] is not None:
+                    min_age, max_age = viewer['age'] - AGE_WINDOW, viewer['age'] + AGE_WINDOW
+                candidates = await self._nearby(conn, (user_id, dislike_cutoff, view_cutoff, exclude, min_age, max_age, limit),
+                                                viewer['latitude'], viewer['longitude'])
+            elif limit > 0:
+                candidates = await self._random(conn, (user_id, dislike_cutoff, view_cutoff, exclude, limit))
+        return likers, candidates
+
+    async def pending_liker(self, user_id: int, liker_id: int) -> Optional[Tuple[Any, Optional[float]]]:
+        now = int(time.time())
+        view_cutoff = now - VIEW_COOLDOWN_HOURS * 3600
+        dislike_cutoff = now - RESHOW_AFTER_DAYS * 86400 if RESHOW_AFTER_DAYS is not None else 0
+        async with self.storage.connection('load_pending_liker') as conn:
+            profile = await conn.fetchrow(f'''
+                SELECT u.* FROM inbox i JOIN users u ON u.id = i.liker_id
+                WHERE i.user_id = $1 AND i.liker_id = $4 AND NOT i.dismissed AND {PG_UNSEEN}
+            ''', user_id, dislike_cutoff, view_cutoff, liker_id)
+            if profile is None:
+                return None
+            viewer = await conn.fetchrow('SELECT * FROM users WHERE id = $1', user_id)
+        return profile, profile_distance(viewer, profile)
+
+    async def _nearby(self, conn, params: Tuple, latitude: float, longitude: float) -> List[Tuple[Any, float]]:
+        filters = f'''
+            u.id <> $1 AND u.id <> ALL($4::bigint[])
+            AND ($5::integer IS NULL OR u.age >= $5) AND ($6::integer IS NULL OR u.age <= $6)
+            AND {PG_UNSEEN}
+        '''
+        if self.storage.postgis:
+            rows = await conn.fetch(f'''
+                SELECT u.*, ST_Distance(u.location, p.point) / 1000 AS distance
+                FROM users u, (SELECT ST_SetSRID(ST_MakePoint($9::float8, $8::float8), 4326)::geography AS point) p
+                WHERE ST_DWithin(u.location, p.point, $10::float8 * 1000) AND {filters}
+                ORDER BY u.location <-> p.point
+                LIMIT $7
+            ''', *params, latitude, longitude, SEARCH_RADIUS_KM)
+        else:
+            lat_span = SEARCH_RADIUS_KM / KM_PER_DEG
+            lon_span = min(lat_span / max(cos(radians(latitude)), 0.05), 180.0)
+            west = (longitude - lon_span + 180) % 360 - 180
+            east = (longitude + lon_span + 180) % 360 - 180
+            if lon_span >= 180:
+                west, east = -180.0, 180.0
+            rows = await conn.fetch(f'''
+                SELECT * FROM (
+                    SELECT u.*, 6371.0 * 2 * asin(sqrt(LEAST(1.0,
+                        power(sin(radians(u.latitude - $8::float8) / 2), 2)
+                        + cos(radians($8::float8)) * cos(radians(u.latitude)) * power(sin(radians(u.longitude - $9::float8) / 2), 2)
+                    ))) AS distance
+                    FROM users u
+                    WHERE u.latitude BETWEEN $8::float8 - $10::float8 AND $8::float8 + $10::float8
+                    AND CASE WHEN $11::float8 <= $12::float8 THEN u.longitude BETWEEN $11::float8 AND $12::float8
+                             ELSE u.longitude >= $11::float8 OR u.longitude <= $12::float8 END
+                    AND {filters}
+                ) nearby
+                WHERE distance <= $13::float8
+                ORDER BY distance
+                LIMIT $7
+            ''', *params, latitude, longitude, lat_span, west, east, SEARCH_RADIUS_KM)
+        return [(row, row['distance']) for row in rows]
+
+    async def _random(self, conn, params: Tuple) -> List[Tuple[Any, None]]:
+        bounds = await conn.fetchrow('SELECT MIN(id) AS low, MAX(id) AS high FROM users')
+        if bounds['low'] is None:
+            return []
+        pivot = random.randint(bounds['low'], bounds['high'])
+        query = f'''
+            SELECT u.* FROM users u
+            WHERE u.id >= $6 AND u.id <= $7 AND u.id <> $1 AND u.id <> ALL($4::bigint[]) AND {PG_UNSEEN}
+            ORDER BY u.id LIMIT $5
+        '''
+        rows = await conn.fetch(query, *params, pivot, bounds['high'])
+        if len(rows) < params[-1]:
+            rows += await conn.fetch(query, *params[:-1], params[-1] - len(rows), bounds['low'], pivot - 1)
+        return [(row, None) for row in rows]
+
+
+class PostgresLikeStore(LikeStore):
+    def __init__(self, storage: 'PostgresStorage') -> None:
+        self.storage = storage
+
+    async def view(self, user_id: int, viewed_user_id: int) -> None:
+        await self.storage.query('record_view', 'execute', '''
+            INSERT INTO views (user_id, viewed_user_id, viewed_at) VALUES ($1, $2, $3)
+            ON CONFLICT (user_id, viewed_user_id) DO UPDATE SET viewed_at = excluded.viewed_at
+        ''', user_id, viewed_user_id, int(time.time()))
+
+    async def dislike(self, user_id: int, disliked_user_id: int) -> None:
+        async with self.storage.transaction('record_dislike') as conn:
+            await conn.execute('''
+                INSERT INTO views (user_id, viewed_user_id, disliked, viewed_at) VALUES ($1, $2, TRUE, $3)
+                ON CONFLICT (user_id, viewed_user_id) DO UPDATE SET disliked = TRUE, viewed_at = excluded.viewed_at
+            ''', user_id, disliked_user_id, int(time.time()))
+            dismissed = await conn.fetchval(
+                'UPDATE inbox SET dismissed = TRUE WHERE user_id = $1 AND liker_id = $2 AND NOT dismissed RETURNING 1',
+                user_id, disliked_user_id
+            )
+            if dismissed:
+                await pg_update_inbox_counts(conn, {user_id: -1})
+            await pg_bump_stats(conn, dislikes=1)
+
+    async def like(self, user_id: int, liked_user_id: int) -> bool:
+        # Встречные лайки пары сериализуются advisory-блокировкой: без нее две параллельные транзакции
+        # не видят строки друг друга и обе записывают лайк без матча.
+        now = time.time()
+        async with self.storage.transaction('record_like') as conn:
+            await conn.execute(
+                "SELECT pg_advisory_xact_lock(hashtextextended(LEAST($1::bigint, $2::bigint) || ':' || GREATEST($1::bigint, $2::bigint), 0))",
+                user_id, liked_user_id
+            )
+            inserted = await conn.execute(
+                'INSERT INTO likes (user_id, liked_user_id, liked_at) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING',
+                user_id, liked_user_id, now
+            ) == 'INSERT 0 1'
+            pending = await conn.fetchrow('DELETE FROM inbox WHERE user_id = $1 AND liker_id = $2 RETURNING dismissed', user_id, liked_user_id)
+            matched = await conn.fetchval('SELECT 1 FROM match_members WHERE user_id = $1 AND peer_id = $2', user_id, liked_user_id)
+            if pending is None and matched is None:
+                pending_like = await conn.fetchrow('''
+                    INSERT INTO inbox (user_id, liker_id, liked_at, dismissed)
+                    VALUES ($1, $2, $3, COALESCE((SELECT disliked FROM views WHERE user_id = $1 AND viewed_user_id = $2), FALSE))
+                    ON CONFLICT DO NOTHING
+                    RETURNING dismissed
+                ''', liked_user_id, user_id, now)
+                if pending_like is not None and not pending_like['dismissed']:
+                    await pg_update_inbox_counts(conn, {liked_user_id: 1})
+                await pg_bump_stats(conn, likes=int(inserted))
+                return False
+            if pending is not None and not pending['dismissed']:
+                await pg_update_inbox_counts(conn, {user_id: -1})
+            if matched is None:
+                match_id = await conn.fetchval('INSERT INTO matches (created_at) VALUES ($1) RETURNING id', now)
+                await conn.executemany(
+                    'INSERT INTO match_members (user_id, peer_id, match_id, activity_at) VALUES ($1, $2, $3, $4)',
+                    [(user_id, liked_user_id, match_id, now), (liked_user_id, user_id, match_id, now)]
+                )
+            await pg_bump_stats(conn, likes=int(inserted), matches=int(matched is None))
+        return True
+
+    async def pending_count(self, user_id: int) -> int:
+        pending = await self.storage.query('load_inbox_count', 'fetchval', 'SELECT pending FROM inbox_counts WHERE user_id = $1', user_id)
+        return pending or 0
+
+
+class PostgresMessageStore(MessageStore):
+    def __init__(self, storage: 'PostgresStorage') -> None:
+        self.storage = storage
+
+    async def get_match(self, user_id: int, peer_id: int) -> Optional[Any]:
+        return await self.storage.query('load_match', 'fetchrow', '''
+            SELECT m.match_id, m.peer_id, m.unread, u.name
+            FROM match_members m LEFT JOIN users u ON u.id = m.peer_id
+            WHERE m.user_id = $1 AND m.peer_id = $2
+        ''', user_id, peer_id)
+
+    async def list_matches(self, user_id: int, before: Optional[Tuple[float, int]], limit: int) -> List[Any]:
+        activity_at, match_id = before if before else (float('inf'), 0)
+        return await self.storage.query('load_matches', 'fetch', '''
+            SELECT m.match_id, m.peer_id, m.unread, m.activity_at, u.name,
+                   COALESCE(msg.user_id, arch.user_id) AS last_sender, COALESCE(msg.message, arch.message) AS last_message
+            FROM match_members m
+            JOIN matches c ON c.id = m.match_id
+            LEFT JOIN users u ON u.id = m.peer_id
+            LEFT JOIN messages msg ON msg.id = c.last_message_id
+            LEFT JOIN messages_archive arch ON msg.id IS NULL AND arch.id = c.last_message_id
+            WHERE m.user_id = $1 AND (m.activity_at, m.match_id) < ($2::float8, $3::bigint)
+            ORDER BY m.activity_at DESC, m.match_id DESC
+            LIMIT $4
+        ''', user_id, activity_at, match_id, limit)
+
+    async def history(self, match_id: int, before_id: Optional[int], limit: int) -> List[Any]:
+        before_id = before_id if before_id is not None else 2 ** 63 - 1
+        async with self.storage.connection('load_history') as conn:
+            rows = await conn.fetch(
+                'SELECT id, user_id, message, sent_at FROM messages WHERE match_id = $1 AND id < $2 ORDER BY id DESC LIMIT $3',
+                match_id, before_id, limit
+            )
+            if len(rows) < limit:
+                rows += await conn.fetch(
+                    'SELECT id, user_id, message, sent_at FROM messages_archive WHERE match_id = $1 AND id < $2 ORDER BY id DESC LIMIT $3',
+                    match_id, rows[-1]['id'] if rows else before_id, limit - len(rows)
+                )
+        return rows[::-1]
+
+    async def mark_read(self, user_id: int, peer_id: int) -> None:
+        await self.storage.query(
+            'mark_match_read', 'execute',
+            'UPDATE match_members SET unread = 0 WHERE user_id = $1 AND peer_id = $2 AND unread > 0', user_id, peer_id
+        )
+
+    async def send(self, match_id: int, user_id: int, matched_user_id: int, text: str) -> int:
+        now = time.time()
+        async with self.storage.transaction('insert_message') as conn:
+            message_id = await conn.fetchval(
+                'INSERT INTO messages (match_id, user_id, matched_user_id, message, sent_at) VALUES ($1, $2, $3, $4, $5) RETURNING id',
+                match_id, user_id, matched_user_id, text, now
+            )
+            await conn.execute('UPDATE matches SET last_message_id = $1, last_message_at = $2 WHERE id = $3', message_id, now, match_id)
+            await conn.execute('UPDATE match_members SET activity_at = $1 WHERE match_id = $2', now, match_id)
+            await conn.execute('UPDATE match_members SET unread = unread + 1 WHERE user_id = $1 AND peer_id = $2', matched_user_id, user_id)
+            await pg_bump_stats(conn, messages=1)
+        return message_id
+
+
+class PostgresStatsStore(StatsStore):
+    def __init__(self, storage: 'PostgresStorage') -> None:
+        self.storage = storage
+
+    async def record_active_user(self, day: str, user_id: int) -> None:
+        async with self.storage.transaction('record_active_user') as conn:
+            if await conn.fetchval('INSERT INTO active_users (day, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING RETURNING 1', day, user_id):
+                await conn.execute('''
+                    INSERT INTO daily_stats (day, metric, value) VALUES ($1, 'active_users', 1)
+                    ON CONFLICT (day, metric) DO UPDATE SET value = daily_stats.value + 1
+                ''', day)
+
+    async def daily(self, days: int) -> Tuple[Dict[str, Dict[str, int]], Dict[str, int]]:
+        first_day = time.strftime('%Y-%m-%d', time.localtime(time.time() - (days - 1) * 86400))
+        async with self.storage.connection('load_stats') as conn:
+            daily: Dict[str, Dict[str, int]] = {}
+            for row in await conn.fetch('SELECT day, metric, value FROM daily_stats WHERE day >= $1 ORDER BY day', first_day):
+                daily.setdefault(row['day'], {})[row['metric']] = row['value']
+            totals = {row['name']: row['value'] for row in await conn.fetch('SELECT name, value FROM counters')}
+        return daily, totals
+
+    async def heatmap(self, limit: int) -> List[Any]:
+        return await self.storage.query('load_heatmap', 'fetch', 'SELECT * FROM geo_stats ORDER BY registrations DESC LIMIT $1', limit)
+
+    async def digest_snapshot(self) -> Tuple[Dict[str, int], Dict[Tuple[int, int], int]]:
+        async with self.storage.connection('load_digest_snapshot') as conn:
+            totals = {row['name']: row['value'] for row in await conn.fetch('SELECT name, value FROM counters')}
+            geo = {(row['lat_bucket'], row['lon_bucket']): row['registrations'] for row in await conn.fetch('SELECT * FROM geo_stats')}
+        return totals, geo
+
+
+class PostgresJobStore(JobStore):
+    def __init__(self, storage: 'PostgresStorage') -> None:
+        self.storage = storage
+
+    @property
+    def recurring(self) -> Tuple[str, ...]:
+        return PG_RECURRING_JOBS
+
+    async def next_job(self) -> Optional[Dict[str, Any]]:
+        # Воркер 0 есть на каждом хосте: подошедшая задача берется в аренду на PG_JOB_LEASE, чтобы ее
+        # не выполняли два хоста сразу. Если хост упал посреди задачи, после аренды ее подхватит другой.
+        now = time.time()
+        async with self.storage.transaction('load_next_job') as conn:
+            row = await conn.fetchrow('SELECT * FROM jobs ORDER BY run_after LIMIT 1 FOR UPDATE SKIP LOCKED')
+            if row is None:
+                return None
+            if row['run_after'] <= now:
+                await conn.execute('UPDATE jobs SET run_after = $1 WHERE id = $2', now + PG_JOB_LEASE, row['id'])
+        return {'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload']),
+                'attempts': row['attempts'], 'run_after': row['run_after']}
+
+    async def step(self, job: Dict[str, Any]) -> bool:
+        async with self.storage.transaction('run_job_step') as conn:
+            return await PG_JOB_HANDLERS[job['kind']](conn, job['payload'])
+
+    async def finish(self, job: Dict[str, Any]) -> None:
+        async with self.storage.transaction('finish_job') as conn:
+            # Задачу могли уже завершить на другом хосте после истечения аренды: повторяющуюся ставим заново только один раз.
+            if await conn.fetchval('DELETE FROM jobs WHERE id = $1 RETURNING 1', job['id']) and job['kind'] in self.recurring:
+                await pg_enqueue_job(conn, job['kind'], job['payload'], next_off_peak(time.time() + 3600 * (OFF_PEAK_HOURS[1] - OFF_PEAK_HOURS[0])))
+
+    async def reschedule(self, job: Dict[str, Any], attempts: int, run_after: float) -> None:
+        await self.storage.query('reschedule_job', 'execute', 'UPDATE jobs SET attempts = $1, run_after = $2 WHERE id = $3',
+                                 attempts, run_after, job['id'])
+
+    async def ensure_recurring(self) -> None:
+        async with self.storage.transaction('ensure_recurring_jobs') as conn:
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', PG_JOBS_LOCK)
+            for kind in self.recurring:
+                if await conn.fetchval('SELECT 1 FROM jobs WHERE kind = $1', kind) is None:
+                    await pg_enqueue_job(conn, kind, {}, next_off_peak(time.time()))
+
+
+class PostgresStorage(Storage):
+    # Анкеты, лайки, переписка, статистика и фоновые задачи в PostgreSQL через пул соединений asyncpg:
+    # запросы идут прямо из event loop без потока БД, а писать могут все воркеры и хосты одновременно.
+    # Очередь уведомлений и сессии остаются в локальной SQLite.
+    def __init__(self, dsn: Optional[str], **pool_options: Any) -> None:
+        super().__init__(PostgresUserStore(self), PostgresLikeStore(self), PostgresMessageStore(self),
+                         PostgresStatsStore(self), PostgresJobStore(self))
+        self.dsn = dsn
+        self.pool_options = pool_options
+        self.pool = None
+        self.postgis = False
+
+    async def start(self) -> None:
+        if asyncpg is None:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres нужен пакет asyncpg")
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE, command_timeout=PG_COMMAND_TIMEOUT, **self.pool_options
+        )
+        async with self.pool.acquire() as conn:
+            await migrate_postgres(conn)
+            self.postgis = await conn.fetchval('''
+                SELECT count(*) > 0 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'location'
+            ''')
+        metrics.gauge_callback('bot_pg_pool_size', self.pool.get_size)
+        metrics.gauge_callback('bot_pg_pool_idle', self.pool.get_idle_size)
+
+    async def stop(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @contextlib.asynccontextmanager
+    async def connection(self, name: str):
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                yield conn
+        finally:
+            metrics.observe('bot_db_call_seconds', time.perf_counter() - started, (('function', name),))
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, name: str):
+        async with self.connection(name) as conn:
+            async with conn.transaction():
+                yield conn
+
+    async def query(self, name: str, method: str, sql: str, *args: Any):
+        started = time.perf_counter()
+        try:
+            return await getattr(self.pool, method)(sql, *args)
+        finally:
+            metrics.observe('bot_db_call_seconds', time.perf_counter() - started, (('function', name),))
+
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == 'postgres':
+        return PostgresStorage(DATABASE_URL)
+    if STORAGE_BACKEND != 'sqlite':
+        raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return SQLiteStorage()
+
+
+storage = create_storage()
+
+
+async def refill_feed(user_id: int, feed: ProfileFeed) -> None:
+    likers, candidates = await storage.users.feed_batch(user_id, feed.queued)
+    now = time.monotonic()
+    # Пока шел запрос, очередь могла пополниться: кандидаты добавляются, только если она все еще ниже FEED_LOW_WATER.
+    if len(feed.queue) < FEED_LOW_WATER:
+        for profile, distance in candidates:
+            if profile['id'] not in feed.queued:
+                feed.queue.append((profile['id'], distance, profile, now))
+                feed.queued.add(profile['id'])
+    if likers:
+        liker_ids = {profile['id'] for profile, _ in likers}
+        if feed.queued & liker_ids:
+            feed.queue = deque(entry for entry in feed.queue if entry[0] not in liker_ids)
+        for profile, distance in reversed(likers):
+            feed.queue.appendleft((profile['id'], distance, profile, now))
+        feed.queued |= liker_ids
+        feed.likers |= liker_ids
+    trim_feed(feed)
+
+
+def trim_feed(feed: ProfileFeed) -> None:
+    # Лента не длиннее FEED_BATCH_SIZE. Лайкнувшие стоят в начале, поэтому отбрасываются обычные кандидаты
+    # с конца; они вернутся при следующей дозагрузке.
+    while len(feed.queue) > FEED_BATCH_SIZE:
+        profile_id = feed.queue.pop()[0]
+        feed.queued.discard(profile_id)
+        feed.likers.discard(profile_id)
+
+
+async def promote_liker(user_id: int, liker_id: int) -> None:
+    # Новый входящий лайк: если лента пользователя уже в памяти, лайкнувший встает в ее начало.
+    # Читается только его анкета, поиск кандидатов не запускается. Лента живет у воркера-владельца
+    # пользователя, поэтому лайк из другого воркера передается ему.
+    owner = chat_owner(user_id)
+    if owner != WORKER_INDEX:
+        send_to_worker(owner, ('promote', user_id, liker_id))
+        return
+    feed = _feeds.get(user_id)
+    if feed is None:
+        return
+    pending = await storage.users.pending_liker(user_id, liker_id)
+    if pending is None or _feeds.get(user_id) is not feed:
+        return
+    profile, distance = pending
+    if liker_id in feed.queued:
+        feed.queue = deque(entry for entry in feed.queue if entry[0] != liker_id)
+    feed.queue.appendleft((liker_id, distance, profile, time.monotonic()))
+    feed.queued.add(liker_id)
+    feed.likers.add(liker_id)
+    trim_feed(feed)
+
+
+def schedule_feed_refill(user_id: int, feed: ProfileFeed) -> asyncio.Task:
+    if feed.refill_task is None or feed.refill_task.done():
+        feed.refill_task = asyncio.create_task(refill_feed(user_id, feed))
+    return feed.refill_task
+
+
+async def next_feed_profile(user_id: int) -> Optional[Tuple[sqlite3.Row, Optional[float], bool]]:
+    feed = get_feed(user_id)
+    if not feed.queue:
+        await schedule_feed_refill(user_id, feed)
+
+    while feed.queue:
+        profile_id, distance, profile, queued_at = feed.queue.popleft()
+        feed.queued.discard(profile_id)
+        invalidated_at = _feed_invalidated.get(profile_id)
+        if invalidated_at is not None and invalidated_at >= queued_at:
+            profile = await storage.users.get(profile_id)
+            if profile is None:
+                continue
+        await storage.likes.view(user_id, profile_id)
+        liked_me = profile_id in feed.likers
+        feed.likers.discard(profile_id)
+        if len(feed.queue) < FEED_LOW_WATER:
+            schedule_feed_refill(user_id, feed)
+        return profile, distance, liked_me
+    return None
+
+
+async def has_feed_profiles(user_id: int) -> bool:
+    feed = get_feed(user_id)
+    if not feed.queue:
+        await schedule_feed_refill(user_id, feed)
+    return bool(feed.queue)
+
+
+def insert_outbox(conn, chat_id: int, kind: str, payload: Dict[str, Any], not_before: float) -> Dict[str, Any]:
+    item_id = conn.execute(
+        'INSERT INTO outbox (chat_id, kind, payload, not_before) VALUES (?, ?, ?, ?)',
+        (chat_id, kind, json.dumps(payload), not_before)
+    ).lastrowid
+    return {'id': item_id, 'chat_id': chat_id, 'kind': kind, 'payload': payload, 'attempts': 0, 'not_before': not_before}
+
+
+def spool_notification(chat_id: int, kind: str, payload: Dict[str, Any], not_before: float) -> Dict[str, Any]:
+    with get_db_connection() as conn:
+        return insert_outbox(conn, chat_id, kind, payload, not_before)
+
+
+def spooled_item(row: sqlite3.Row) -> Dict[str, Any]:
+    return {'id': row['id'], 'chat_id': row['chat_id'], 'kind': row['kind'], 'payload': json.loads(row['payload']),
+            'attempts': row['attempts'], 'not_before': row['not_before']}
+
+
+def load_spooled_notifications() -> List[Dict[str, Any]]:
+    # Уведомления чата держит в памяти и отправляет только воркер-владелец этого чата (chat_owner),
+    # поэтому после перезапуска воркер поднимает только свои чаты и никто другой их в это время не держит.
+    with get_db_connection() as conn:
+        rows = conn.execute('SELECT * FROM outbox WHERE chat_id % ? = ? ORDER BY id', (WORKER_COUNT, WORKER_INDEX)).fetchall()
+    return [spooled_item(row) for row in rows]
+
+
+def load_spooled_notification(item_id: int) -> Optional[Dict[str, Any]]:
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT * FROM outbox WHERE id = ?', (item_id,)).fetchone()
+    return spooled_item(row) if row is not None else None
+
+
+def delete_spooled_notifications(ids: List[int]) -> None:
+    with get_db_connection() as conn:
+        conn.executemany('DELETE FROM outbox WHERE id = ?', [(item_id,) for item_id in ids])
+
+
+def reschedule_spooled_notifications(ids: List[int], attempts: int, not_before: float) -> None:
+    with get_db_connection() as conn:
+        conn.executemany('UPDATE outbox SET attempts = ?, not_before = ? WHERE id = ?', [(attempts, not_before, item_id) for item_id in ids])
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class Notifier:
+    # Исходящие сообщения другим пользователям: очередь на каждый чат, общий и per-chat token bucket,
+    # склейка лайков в одно сообщение и повтор при RetryAfter/сетевых ошибках.
+    # Каждое сообщение сначала пишется в таблицу outbox и удаляется только после отправки,
+    # поэтому очередь переживает перезапуск. В режиме webhook сообщение в чужой чат передается
+    # воркеру-владельцу чата, так что per-chat лимит и очередь чата живут ровно в одном процессе.
+    def __init__(self) -> None:
+        self.bot: Optional[Bot] = None
+        self.pending: Dict[int, deque] = {}
+        self.spooled = set()
+        self.schedule: List[Tuple[float, int, int]] = []
+        self.sequence = 0
+        self.busy = set()
+        # Лимит Bot API общий для бота, поэтому в режиме webhook он делится между воркерами.
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE / WORKER_COUNT, max(1, NOTIFY_GLOBAL_BURST // WORKER_COUNT))
+        self.chat_buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sweeper: Optional[asyncio.Task] = None
+        self.sends = set()
+
+    async def start(self, bot: Bot) -> None:
+        self.bot = bot
+        for item in await run_db(load_spooled_notifications):
+            self._push(item)
+        self.task = asyncio.create_task(self._run())
+        if WORKER_COUNT > 1:
+            self.sweeper = asyncio.create_task(self._sweep())
 
+    async def stop(self) -> None:
+        for task in (self.task, self.sweeper):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.task = self.sweeper = None
+        if self.sends:
+            await asyncio.gather(*self.sends, return_exceptions=True)
 
-def get_db_connection():
-    conn = sqlite3.connect('dating.db', check_same_thread=False)
-    conn.row_factory = sqlite3.Row  
-    return conn
+    async def enqueue(self, chat_id: int, kind: str, payload: Optional[Dict[str, Any]] = None, delay: float = 0.0) -> None:
+        self.route(await run_db(spool_notification, chat_id, kind, payload or {}, time.time() + delay))
 
+    def route(self, item: Dict[str, Any]) -> None:
+        # Уже записанное в outbox уведомление: в свою очередь или воркеру-владельцу чата.
+        owner = chat_owner(item['chat_id'])
+        if owner == WORKER_INDEX:
+            if item['id'] not in self.spooled:
+                self._push(item)
+        elif not send_to_worker(owner, ('notify', item['id'])):
+            logger.warning(f"Очередь воркера {owner} переполнена, уведомление {item['id']} он подберет из outbox сам")
 
-def init_db():
+    async def adopt(self, item_id: int) -> None:
+        # Уведомление, записанное в outbox другим воркером для чата этого воркера.
+        if item_id in self.spooled:
+            return
+        item = await run_db(load_spooled_notification, item_id)
+        if item is not None and item['id'] not in self.spooled:
+            self._push(item)
+
+    async def _sweep(self) -> None:
+        # Страховка на случай, если сообщение от другого воркера не дошло (переполненная очередь).
+        while True:
+            await asyncio.sleep(NOTIFY_SWEEP_INTERVAL)
+            try:
+                for item in await run_db(load_spooled_notifications):
+                    if item['id'] not in self.spooled:
+                        self._push(item)
+            except Exception as e:
+                logger.error(f"Ошибка при чтении outbox: {e}")
+
+    async def send_text(self, chat_id: int, text: str, parse_mode: Optional[str] = None) -> None:
+        await self.enqueue(chat_id, 'text', {'text': text, 'parse_mode': parse_mode})
+
+    async def send_sticker(self, chat_id: int, sticker: str) -> None:
+        await self.enqueue(chat_id, 'sticker', {'sticker': sticker})
+
+    async def notify_like(self, chat_id: int) -> None:
+        await self.enqueue(chat_id, 'like', delay=NOTIFY_COALESCE_SECONDS)
+
+    def _push(self, item: Dict[str, Any]) -> None:
+        self.spooled.add(item['id'])
+        queue = self.pending.setdefault(item['chat_id'], deque())
+        queue.append(item)
+        if len(queue) == 1 and item['chat_id'] not in self.busy:
+            self._schedule(item['chat_id'], item['not_before'])
+
+    def _schedule(self, chat_id: int, when: float) -> None:
+        self.sequence += 1
+        heapq.heappush(self.schedule, (when, self.sequence, chat_id))
+        self.wakeup.set()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(NOTIFY_CHAT_RATE, NOTIFY_CHAT_BURST)
+            while len(self.chat_buckets) > NOTIFY_MAX_CHATS:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            if not self.schedule:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            when, _, chat_id = self.schedule[0]
+            wait = max(when - time.time(), self.global_bucket.delay())
+            if wait > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self.schedule)
+            if chat_id in self.busy or not self.pending.get(chat_id):
+                continue
+            chat_wait = self._chat_bucket(chat_id).delay()
+            if chat_wait > 0:
+                self._schedule(chat_id, time.time() + chat_wait)
+                continue
+
+            self.global_bucket.consume()
+            self._chat_bucket(chat_id).consume()
+            self.busy.add(chat_id)
+            send = asyncio.create_task(self._deliver(chat_id))
+            self.sends.add(send)
+            send.add_done_callback(self.sends.discard)
+
+    def _take_batch(self, chat_id: int) -> List[Dict[str, Any]]:
+        queue = self.pending[chat_id]
+        head = queue.popleft()
+        batch = [head]
+        if head['kind'] == 'like':
+            rest = deque()
+            while queue:
+                item = queue.popleft()
+                (batch if item['kind'] == 'like' else rest).append(item)
+            queue.extend(rest)
+        return batch
+
+    async def _deliver(self, chat_id: int) -> None:
+        batch = self._take_batch(chat_id)
+        try:
+            retry_at = await self._attempt(chat_id, batch)
+        except Exception as e:
+            # Не-Telegram ошибка (например, sqlite3.Error при работе с outbox): пачка возвращается в очередь
+            # с задержкой, иначе очередь этого чата больше никогда не была бы запланирована.
+            logger.exception(f"Сбой при отправке уведомления для {chat_id}: {e}")
+            attempts = batch[0]['attempts'] + 1
+            for item in batch:
+                item['attempts'] = attempts
+            retry_at = time.time() + 2 ** min(attempts, NOTIFY_MAX_ATTEMPTS)
+        finally:
+            self.busy.discard(chat_id)
+
+        queue = self.pending[chat_id]
+        if retry_at is not None:
+            queue.extendleft(reversed(batch))
+            for item in batch:
+                item['not_before'] = retry_at
+        else:
+            self.spooled.difference_update(item['id'] for item in batch)
+        if queue:
+            self._schedule(chat_id, max(queue[0]['not_before'], retry_at or 0))
+        else:
+            del self.pending[chat_id]
+
+    async def _attempt(self, chat_id: int, batch: List[Dict[str, Any]]) -> Optional[float]:
+        head = batch[0]
+        retry_at = None
+        try:
+            await self._send(chat_id, head['kind'], head['payload'], len(batch))
+            await run_db(delete_spooled_notifications, [item['id'] for item in batch])
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            retry_at = time.time() + retry_after
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Уведомление для {chat_id} отброшено: {e}")
+            await run_db(delete_spooled_notifications, [item['id'] for item in batch])
+        except TelegramError as e:
+            attempts = head['attempts'] + 1
+            if attempts >= NOTIFY_MAX_ATTEMPTS:
+                logger.error(f"Уведомление для {chat_id} отброшено после {attempts} попыток: {e}")
+                await run_db(delete_spooled_notifications, [item['id'] for item in batch])
+            else:
+                logger.error(f"Ошибка при отправке уведомления: {e}")
+                retry_at = time.time() + 2 ** attempts
+                for item in batch:
+                    item['attempts'] = attempts
+                await run_db(reschedule_spooled_notifications, [item['id'] for item in batch], attempts, retry_at)
+        return retry_at
+
+    async def _send(self, chat_id: int, kind: str, payload: Dict[str, Any], count: int) -> None:
+        if kind == 'like':
+            if count == 1:
+                text = "Кто-то лайкнул вашу анкету! Нажмите /search, чтобы узнать кто это😍."
+            else:
+                text = f"Вашу анкету лайкнули новые люди: {count}! Нажмите /search, чтобы узнать кто это😍."
+            await self.bot.send_message(chat_id, text)
+        elif kind == 'sticker':
+            await self.bot.send_sticker(chat_id=chat_id, sticker=payload['sticker'])
+        else:
+            await self.bot.send_message(chat_id, payload['text'], parse_mode=payload.get('parse_mode'))
+
+
+notifier = Notifier()
+
+
+def enqueue_job(conn, kind: str, payload: Dict[str, Any], run_after: Optional[float] = None) -> int:
+    return conn.execute(
+        'INSERT INTO jobs (kind, payload, run_after) VALUES (?, ?, ?)',
+        (kind, json.dumps(payload), run_after if run_after is not None else time.time())
+    ).lastrowid
+
+
+def next_off_peak(now: float) -> float:
+    current = datetime.fromtimestamp(now)
+    start = current.replace(hour=OFF_PEAK_HOURS[0], minute=0, second=0, microsecond=0)
+    end = current.replace(hour=OFF_PEAK_HOURS[1], minute=0, second=0, microsecond=0)
+    if start <= current < end:
+        return now
+    if current >= end:
+        start += timedelta(days=1)
+    return start.timestamp()
+
+
+def is_off_peak(now: float) -> bool:
+    return OFF_PEAK_HOURS[0] <= datetime.fromtimestamp(now).hour < OFF_PEAK_HOURS[1]
+
+
+def delete_batch(conn, table: str, where: str, params: Tuple[Any, ...], key: str = 'rowid') -> int:
+    return conn.execute(
+        f'DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {where} LIMIT ?)',
+        params + (JOB_BATCH_SIZE,)
+    ).rowcount
+
+
+def purge_user_step(conn, payload: Dict[str, Any]) -> bool:
+    user_id = payload['user_id']
+    tombstone = conn.execute('SELECT * FROM tombstones WHERE user_id = ?', (user_id,)).fetchone()
+    if tombstone is None:
+        return True
+    like_cutoff, message_cutoff, deleted_at = tombstone['like_cutoff'], tombstone['message_cutoff'], int(tombstone['deleted_at'])
+    outgoing = conn.execute(
+        'DELETE FROM inbox WHERE (user_id, liker_id) IN (SELECT user_id, liker_id FROM inbox WHERE liker_id = ? AND liked_at <= ? LIMIT ?) '
+        'RETURNING user_id, dismissed',
+        (user_id, tombstone['deleted_at'], JOB_BATCH_SIZE)
+    ).fetchall()
+    if outgoing:
+        update_inbox_counts(conn, {row['user_id']: -1 for row in outgoing if not row['dismissed']})
+        return False
+    # Каждый шаг удаляет не больше JOB_BATCH_SIZE строк из первой непустой группы, чтобы транзакция
+    # держала блокировку записи недолго. Все запросы идут по индексам с user_id в начале.
+    for table, where, params, key in (
+        ('inbox', 'user_id = ? AND liked_at <= ?', (user_id, tombstone['deleted_at']), 'user_id, liker_id'),
+        ('views', 'user_id = ? AND viewed_at <= ?', (user_id, deleted_at), 'user_id, viewed_user_id'),
+        ('views', 'viewed_user_id = ? AND viewed_at <= ?', (user_id, deleted_at), 'user_id, viewed_user_id'),
+        ('likes', 'user_id = ? AND id <= ?', (user_id, like_cutoff), 'id'),
+        ('likes', 'liked_user_id = ? AND id <= ?', (user_id, like_cutoff), 'id'),
+        ('messages', 'user_id = ? AND id <= ?', (user_id, message_cutoff), 'id'),
+        ('messages', 'matched_user_id = ? AND id <= ?', (user_id, message_cutoff), 'id'),
+    ):
+        if delete_batch(conn, table, where, params, key):
+            return False
+    conn.execute('DELETE FROM tombstones WHERE user_id = ?', (user_id,))
+    _seen_sets.pop(user_id, None)
+    return True
+
+
+def retention_step(conn, payload: Dict[str, Any]) -> bool:
+    now = time.time()
+    # active_users нужна только чтобы не посчитать пользователя дважды за текущий день; счетчики по дням уже в daily_stats.
+    active_cutoff = time.strftime('%Y-%m-%d', time.localtime(now - ACTIVE_USERS_KEEP_DAYS * 86400))
+    if delete_batch(conn, 'active_users', 'day < ?', (active_cutoff,), 'day, user_id'):
+        return False
+    if LIKE_RETENTION_DAYS is not None:
+        like_cutoff = now - LIKE_RETENTION_DAYS * 86400
+        # Входящий лайк без ответа истекает вместе с самим лайком и снимается со счетчика получателя.
+        expired = conn.execute(
+            'DELETE FROM inbox WHERE (user_id, liker_id) IN (SELECT user_id, liker_id FROM inbox WHERE liked_at < ? LIMIT ?) '
+            'RETURNING user_id, dismissed',
+            (like_cutoff, JOB_BATCH_SIZE)
+        ).fetchall()
+        if expired:
+            counts = Counter()
+            for row in expired:
+                if not row['dismissed']:
+                    counts[row['user_id']] -= 1
+            update_inbox_counts(conn, counts)
+            return False
+        if delete_batch(conn, 'likes', 'liked_at < ?', (like_cutoff,), 'id'):
+            return False
+    if MESSAGE_ARCHIVE_DAYS is not None:
+        ids = [row['id'] for row in conn.execute(
+            'SELECT id FROM messages WHERE sent_at < ? ORDER BY sent_at LIMIT ?',
+            (now - MESSAGE_ARCHIVE_DAYS * 86400, JOB_BATCH_SIZE)
+        )]
+        if ids:
+            placeholders = ','.join('?' * len(ids))
+            conn.execute(f'INSERT OR REPLACE INTO messages_archive SELECT id, user_id, matched_user_id, message, match_id, sent_at FROM messages WHERE id IN ({placeholders})', ids)
+            conn.execute(f'DELETE FROM messages WHERE id IN ({placeholders})', ids)
+            return False
+    return True
+
+
+def vacuum_step(conn, payload: Dict[str, Any]) -> bool:
+    # Свободные страницы возвращаются порциями по VACUUM_PAGES, и только в непиковые часы;
+    # на auto_vacuum=INCREMENTAL база переводится в init_db.
+    if not is_off_peak(time.time()):
+        return True
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return True
+    if conn.execute('PRAGMA freelist_count').fetchone()[0] == 0:
+        return True
+    # execute() делает только один шаг прагмы и освобождает одну страницу; executescript проходит ее до конца.
+    conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES})')
+    return False
+
+
+JOB_HANDLERS = {
+    'purge_user': purge_user_step,
+    'retention': retention_step,
+    'vacuum': vacuum_step,
+}
+RECURRING_JOBS = ('retention', 'vacuum')
+
+
+def load_next_job() -> Optional[Dict[str, Any]]:
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            name TEXT,
-            age INTEGER,
-            bio TEXT,
-            photo_file_id TEXT,
-            latitude REAL,
-            longitude REAL
-        )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            liked_user_id INTEGER,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(liked_user_id) REFERENCES users(id)
+        row = conn.execute('SELECT * FROM jobs ORDER BY run_after LIMIT 1').fetchone()
+    if row is None:
+        return None
+    return {'id': row['id'], 'kind': row['kind'], 'payload': json.loads(row['payload']),
+            'attempts': row['attempts'], 'run_after': row['run_after']}
+
+
+def run_job_step(job: Dict[str, Any]) -> bool:
+    with get_db_connection() as conn:
+        return JOB_HANDLERS[job['kind']](conn, job['payload'])
+
+
+def finish_job(job: Dict[str, Any]) -> None:
+    with get_db_connection() as conn:
+        conn.execute('DELETE FROM jobs WHERE id = ?', (job['id'],))
+        if job['kind'] in RECURRING_JOBS:
+            enqueue_job(conn, job['kind'], job['payload'], next_off_peak(time.time() + 3600 * (OFF_PEAK_HOURS[1] - OFF_PEAK_HOURS[0])))
+
+
+def reschedule_job(job: Dict[str, Any], attempts: int, run_after: float) -> None:
+    with get_db_connection() as conn:
+        conn.execute('UPDATE jobs SET attempts = ?, run_after = ? WHERE id = ?', (attempts, run_after, job['id']))
+
+
+def ensure_recurring_jobs() -> None:
+    with get_db_connection() as conn:
+        for kind in RECURRING_JOBS:
+            if conn.execute('SELECT 1 FROM jobs WHERE kind = ?', (kind,)).fetchone() is None:
+                enqueue_job(conn, kind, {}, next_off_peak(time.time()))
+
+
+class JobRunner:
+    # Фоновые задачи из таблицы jobs хранилища. Каждый шаг задачи — отдельная короткая транзакция,
+    # между шагами обработчики пользователей успевают пройти через тот же поток БД.
+    # В режиме webhook задачи выполняет только воркер 0.
+    def __init__(self) -> None:
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await storage.jobs.ensure_recurring()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def wake(self) -> None:
+        if WORKER_INDEX == 0:
+            self.wakeup.set()
+        else:
+            send_to_worker(0, ('wake_jobs',))
+
+    async def _run(self) -> None:
+        while True:
+            job = await storage.jobs.next_job()
+            wait = JOB_POLL_INTERVAL if job is None else min(job['run_after'] - time.time(), JOB_POLL_INTERVAL)
+            if wait > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: Dict[str, Any]) -> None:
+        started = time.monotonic()
+        steps = 0
+        try:
+            while not await storage.jobs.step(job):
+                steps += 1
+                await asyncio.sleep(JOB_BATCH_PAUSE)
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            if attempts >= JOB_MAX_ATTEMPTS and job['kind'] not in storage.jobs.recurring:
+                logger.error(f"Задача {job['kind']} {job['payload']} отброшена после {attempts} попыток: {e}")
+                await storage.jobs.finish(job)
+            else:
+                logger.error(f"Ошибка в задаче {job['kind']} {job['payload']}: {e}")
+                await storage.jobs.reschedule(job, attempts, time.time() + 60 * 2 ** min(attempts, 6))
+            return
+        await storage.jobs.finish(job)
+        logger.info(f"Задача {job['kind']} {job['payload']} выполнена за {time.monotonic() - started:.1f}с, шагов: {steps + 1}")
+
+
+jobs = JobRunner()
+
+
+def load_session(user_id: int) -> Optional[Dict[str, Any]]:
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+    return json.loads(row['data']) if row else None
+
+
+def save_sessions(sessions: Dict[int, Optional[Dict[str, Any]]]) -> None:
+    now = time.time()
+    with get_db_connection() as conn:
+        conn.executemany(
+            'INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at',
+            [(user_id, json.dumps(data), now) for user_id, data in sessions.items() if data is not None]
         )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            matched_user_id INTEGER,
-            message TEXT,
-            FOREIGN KEY(user_id) REFERENCES users(id),
-            FOREIGN KEY(matched_user_id) REFERENCES users(id)
+        conn.executemany('DELETE FROM sessions WHERE user_id = ?', [(user_id,) for user_id, data in sessions.items() if data is None])
+
+
+class SQLitePersistence(BasePersistence):
+    # Хранит context.user_data в таблице sessions. В памяти держатся только активные пользователи:
+    # данные подгружаются при первом апдейте пользователя (refresh_user_data), изменения копятся
+    # и пишутся одной транзакцией, а простаивающие сессии выгружаются evict_idle_sessions.
+    def __init__(self) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=SESSION_FLUSH_INTERVAL
         )
-        ''')
-        conn.commit()
+        self.sessions: 'OrderedDict[int, float]' = OrderedDict()
+        self.dirty: Dict[int, Optional[Dict[str, Any]]] = {}
+        self.evicting = set()
+        self.write_task: Optional[asyncio.Task] = None
 
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        return {}
 
-def calculate_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
-    R = 6371.0  
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])  
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = R * c 
-    return distance
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]) -> None:
+        if user_id not in self.sessions:
+            stored = self.dirty.get(user_id)
+            if stored is None:
+                stored = await run_db(load_session, user_id)
+            if stored and not user_data:
+                user_data.update(stored)
+        self.sessions[user_id] = time.monotonic()
+        self.sessions.move_to_end(user_id)
 
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]) -> None:
+        self.dirty[user_id] = data
+        self._schedule_write()
 
-async def send_location_to_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int, latitude: float, longitude: float) -> None:
-    try:
-        await context.bot.send_message(
-            chat_id=ADMIN_USER_ID,
-            text=f"Новый пользователь зарегистрирован! ID: {user_id}, Локация: https://www.google.com/maps?q={latitude},{longitude}"
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления администратору: {e}")
+    async def drop_user_data(self, user_id: int) -> None:
+        # Отметку выгрузки снимает только её собственный drop: если пользователь вернулся раньше,
+        # чем он дошел сюда, сессия уже снова загружена и удалять её из БД нельзя.
+        if user_id in self.evicting:
+            self.evicting.discard(user_id)
+            return
+        self.sessions.pop(user_id, None)
+        self.dirty[user_id] = None
+        self._schedule_write()
+
+    def _schedule_write(self) -> None:
+        if self.write_task is None or self.write_task.done():
+            self.write_task = asyncio.create_task(self._write())
+
+    async def _write(self) -> None:
+        # Application.update_persistence вызывает update_user_data для всех измененных пользователей разом;
+        # одна итерация цикла событий дает собрать их в одну пачку.
+        await asyncio.sleep(0)
+        while self.dirty:
+            batch, self.dirty = self.dirty, {}
+            try:
+                await run_db(save_sessions, batch)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при сохранении сессий: {e}")
+                self.dirty = {**batch, **self.dirty}
+                return
+
+    def expired_sessions(self) -> List[int]:
+        now = time.monotonic()
+        # Выгружать можно только тех, чьи изменения уже точно дошли до update_user_data.
+        min_idle = 2 * SESSION_FLUSH_INTERVAL
+        expired = []
+        overflow = len(self.sessions) - SESSION_MAX_USERS
+        for user_id, last_seen in self.sessions.items():
+            idle = now - last_seen
+            if idle > SESSION_TTL or (overflow > len(expired) and idle > min_idle):
+                expired.append(user_id)
+            elif overflow <= len(expired):
+                break
+        for user_id in expired:
+            del self.sessions[user_id]
+            self.evicting.add(user_id)
+        return expired
+
+    async def flush(self) -> None:
+        if self.write_task is not None:
+            await self.write_task
+        if self.dirty:
+            await self._write()
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any, new_state: Any) -> None:
+        pass
+
+
+async def evict_idle_sessions(application) -> None:
+    while True:
+        await asyncio.sleep(SESSION_EVICT_INTERVAL)
+        expired = application.persistence.expired_sessions()
+        for user_id in expired:
+            application.drop_user_data(user_id)
+        if expired:
+            await application.update_persistence()
+
+
+_active_day = ''
+_active_seen = set()
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Уникальные активные пользователи за день; в БД идет только первый апдейт пользователя за день.
+    global _active_day
+    if update.effective_user is None:
+        return
+    day = time.strftime('%Y-%m-%d')
+    if day != _active_day:
+        _active_day = day
+        _active_seen.clear()
+    if update.effective_user.id not in _active_seen:
+        _active_seen.add(update.effective_user.id)
+        await storage.stats.record_active_user(day, update.effective_user.id)
+
+
+def format_bucket(lat_bucket: int, lon_bucket: int) -> str:
+    latitude = (lat_bucket + 0.5) * HEATMAP_CELL_DEG
+    longitude = (lon_bucket + 0.5) * HEATMAP_CELL_DEG
+    return f"{lat_bucket * HEATMAP_CELL_DEG:g}…{(lat_bucket + 1) * HEATMAP_CELL_DEG:g}, {lon_bucket * HEATMAP_CELL_DEG:g}…{(lon_bucket + 1) * HEATMAP_CELL_DEG:g} https://www.google.com/maps?q={latitude:g},{longitude:g}"
+
+
+def format_digest(before: Tuple[Dict[str, int], Dict[Tuple[int, int], int]], after: Tuple[Dict[str, int], Dict[Tuple[int, int], int]]) -> Optional[str]:
+    totals = {metric: after[0].get(metric, 0) - before[0].get(metric, 0) for metric in STATS_METRICS}
+    regions = Counter({bucket: count - before[1].get(bucket, 0) for bucket, count in after[1].items()})
+    if not totals['registrations'] and not +regions:
+        return None
+    lines = [
+        f"Сводка за {DIGEST_INTERVAL // 60} мин: новых анкет {totals['registrations']}, удалено {totals['deletions']}, "
+        f"лайков {totals['likes']}, матчей {totals['matches']}, сообщений {totals['messages']}."
+    ]
+    for (lat_bucket, lon_bucket), count in (+regions).most_common(5):
+        lines.append(f"+{count}: {format_bucket(lat_bucket, lon_bucket)}")
+    return "\n".join(lines)
+
+
+async def send_digests() -> None:
+    # Вместо сообщения администратору на каждую регистрацию раз в DIGEST_INTERVAL уходит одна сводка.
+    snapshot = await storage.stats.digest_snapshot()
+    while True:
+        await asyncio.sleep(DIGEST_INTERVAL)
+        current = await storage.stats.digest_snapshot()
+        text = format_digest(snapshot, current)
+        snapshot = current
+        if text:
+            await notifier.send_text(ADMIN_USER_ID, text)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+    user = await storage.users.get(user_id)
 
    
     context.user_data['started'] = True
@@ -110,10 +3639,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Пожалуйста, начните с команды /start.")
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+    user = await storage.users.get(user_id)
 
     if not user:
         await handle_profile_creation(update, context, text)
@@ -167,12 +3693,9 @@ async def handle_user_interaction(update: Update, context: ContextTypes.DEFAULT_
 
 async def reset_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM users WHERE id = ?', (user_id,))
-        cursor.execute('DELETE FROM likes WHERE user_id = ? OR liked_user_id = ?', (user_id, user_id))
-        cursor.execute('DELETE FROM messages WHERE user_id = ? OR matched_user_id = ?', (user_id, user_id))
-        conn.commit()
+    await storage.users.delete(user_id)
+    drop_feed(user_id)
+    profile_changed(user_id)
     context.user_data.clear()
     await update.message.reply_text("Ваша анкета удалена. Давайте создадим новую анкету. Напишите свое имя:")
 
@@ -193,14 +3716,19 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media
     else:
         await save_new_profile(update, context, media_type)
 
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_media(update, context, 'photo')
+
+
+async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await handle_media(update, context, 'video')
+
 async def update_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str) -> None:
     user_id = update.message.from_user.id
-    media_file_id = update.message.photo[-1].file_id if media_type == 'photo' else update.message.video.file_id
+    media = extract_media(update.message)
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET photo_file_id = ? WHERE id = ?', (media_file_id, user_id))
-        conn.commit()
+    await storage.users.update_media(user_id, media)
+    profile_changed(user_id)
 
     await update.message.reply_text("Фото/видео успешно обновлено!")
     context.user_data['editing_photo'] = False
@@ -208,15 +3736,10 @@ async def update_media(update: Update, context: ContextTypes.DEFAULT_TYPE, media
 async def save_new_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, media_type: str) -> None:
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    media_file_id = update.message.photo[-1].file_id if media_type == 'photo' else update.message.video.file_id
+    media = extract_media(update.message)
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO users (id, username, name, age, bio, photo_file_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, context.user_data['name'], context.user_data['age'], context.user_data['bio'], media_file_id))
-        conn.commit()
+    await storage.users.create(user_id, username, context.user_data['name'], context.user_data['age'], context.user_data['bio'], media)
+    profile_changed(user_id)
 
     location_keyboard = ReplyKeyboardMarkup(
         [[KeyboardButton("Отправить местоположение", request_location=True)]],
@@ -237,20 +3760,8 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Пожалуйста, начните с команды /start.")
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT latitude, longitude FROM users WHERE id = ?', (user_id,))
-        existing_location = cursor.fetchone()
-
-        if existing_location and existing_location[0] is not None and existing_location[1] is not None:
-            
-            pass
-        else:
-            
-            await send_location_to_admin(context, user_id, latitude, longitude)
-
-        cursor.execute('UPDATE users SET latitude = ?, longitude = ? WHERE id = ?', (latitude, longitude, user_id))
-        conn.commit()
+    await storage.users.update_location(user_id, latitude, longitude)
+    profile_changed(user_id)
 
     start_keyboard = ReplyKeyboardMarkup(
         [
@@ -271,13 +3782,11 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Пожалуйста, начните с команды /start.")
         return
 
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id != ? AND id NOT IN (SELECT liked_user_id FROM likes WHERE user_id = ?) ORDER BY RANDOM() LIMIT 1', (user_id, user_id))
-        profile = cursor.fetchone()
-
-    if profile:
-        await update.message.reply_text("Ищем анкеты...", reply_markup=ReplyKeyboardRemove())
+    context.user_data.pop('matched_user_id', None)
+    if await has_feed_profiles(user_id):
+        pending_likes = await storage.likes.pending_count(user_id)
+        text = f"Вас лайкнули: {pending_likes}. Эти анкеты покажем первыми 💌" if pending_likes else "Ищем анкеты..."
+        await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
         await show_next_profile(update, context, user_id)
     else:
         start_keyboard = ReplyKeyboardMarkup(
@@ -288,23 +3797,23 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Анкет больше нет. Нажмите 'Старт💕', чтобы проверить снова.", reply_markup=start_keyboard)
 
 
+async def reply_profile_media(message, profile: sqlite3.Row, caption: str, reply_markup, feed: bool = False) -> None:
+    # Тип медиа сохраняется при загрузке, поэтому метод отправки выбирается без угадывания по file_id.
+    file_id = profile['feed_file_id'] if feed and profile['feed_file_id'] else profile['photo_file_id']
+    if profile['media_type'] == 'video':
+        await message.reply_video(file_id, caption=caption, reply_markup=reply_markup)
+    else:
+        await message.reply_photo(file_id, caption=caption, reply_markup=reply_markup)
+
+
 async def show_next_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id != ? AND id NOT IN (SELECT liked_user_id FROM likes WHERE user_id = ?) ORDER BY RANDOM() LIMIT 1', (user_id, user_id))
-        profile = cursor.fetchone()
+    candidate = await next_feed_profile(user_id)
 
-    if profile:
+    if candidate:
+        profile, distance, liked_me = candidate
         try:
-            cursor.execute('SELECT latitude, longitude FROM users WHERE id = ?', (user_id,))
-            current_user_location = cursor.fetchone()
-
             distance_text = "📍 Расстояние неизвестно"
-            if current_user_location and current_user_location[0] and current_user_location[1]:
-                distance = calculate_distance(
-                    current_user_location[0], current_user_location[1],
-                    profile['latitude'], profile['longitude']
-                )
+            if distance is not None:
                 distance_text = f"📍 {round(distance, 1)} км"
 
             keyboard = ReplyKeyboardMarkup(
@@ -313,18 +3822,12 @@ async def show_next_profile(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 one_time_keyboard=True
             )
 
-            if profile['photo_file_id'].startswith("AgAC"):
-                await update.message.reply_photo(
-                    profile['photo_file_id'],
-                    caption=f"{profile['name']}, {profile['age']}\n{profile['bio']}\n{distance_text}",
-                    reply_markup=keyboard
-                )
-            else:
-                await update.message.reply_video(
-                    profile['photo_file_id'],
-                    caption=f"{profile['name']}, {profile['age']}\n{profile['bio']}\n{distance_text}",
-                    reply_markup=keyboard
-                )
+            await reply_profile_media(
+                update.message, profile,
+                caption=f"{'💌 Вы понравились этому человеку!' + chr(10) if liked_me else ''}{profile['name']}, {profile['age']}\n{profile['bio']}\n{distance_text}",
+                reply_markup=keyboard,
+                feed=True
+            )
 
             context.user_data['current_profile_id'] = profile['id']
         except Exception as e:
@@ -345,63 +3848,40 @@ async def handle_like_dislike(update: Update, context: ContextTypes.DEFAULT_TYPE
     liked_user_id = context.user_data.get('current_profile_id')
 
     if liked_user_id:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            if text == "❤️":
-                cursor.execute('INSERT INTO likes (user_id, liked_user_id) VALUES (?, ?)', (user_id, liked_user_id))
-                conn.commit()
+        if text == "❤️":
+            mutual_like = await storage.likes.like(user_id, liked_user_id)
 
-                cursor.execute('SELECT * FROM likes WHERE user_id = ? AND liked_user_id = ?', (liked_user_id, user_id))
-                mutual_like = cursor.fetchone()
-
-                if mutual_like:
-                    await handle_mutual_like(update, context, user_id, liked_user_id)
-                else:
-                    await update.message.reply_text("Лайк отправлен!")
-                    await show_next_profile(update, context, user_id)
+            if mutual_like:
+                await handle_mutual_like(update, context, user_id, liked_user_id)
+            else:
+                await update.message.reply_text("Лайк отправлен!")
+                await show_next_profile(update, context, user_id)
+                await promote_liker(liked_user_id, user_id)
 
-                try:
-                    await context.bot.send_message(liked_user_id, "Кто-то лайкнул вашу анкету! Нажмите /search, чтобы узнать кто это😍.")
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления: {e}")
+            await notifier.notify_like(liked_user_id)
 
-            elif text == "👎":
-                await update.message.reply_text("Дизлайк отправлен!")
-                await show_next_profile(update, context, user_id)
+        elif text == "👎":
+            await storage.likes.dislike(user_id, liked_user_id)
+            await update.message.reply_text("Дизлайк отправлен!")
+            await show_next_profile(update, context, user_id)
     else:
         await update.message.reply_text("Используйте команду /search для поиска анкет.")
 
-async def handle_mutual_like(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, liked_user_id: int) -> None:
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT username FROM users WHERE id = ?', (liked_user_id,))
-        liked_user_username = cursor.fetchone()[0]
-        cursor.execute('SELECT username FROM users WHERE id = ?', (user_id,))
-        current_user_username = cursor.fetchone()[0]
+def match_notice(peer_id: int, peer_username: Optional[str]) -> str:
+    link = f"https://t.me/{peer_username}" if peer_username else f"tg://user?id={peer_id}"
+    return f'У вас взаимный лайк\\! [Нажмите здесь, чтобы написать]({link}) или напишите в боте: /chat\\_{peer_id}'
 
-        user_link = f"https://t.me/{liked_user_username}" if liked_user_username else f"tg://user?id={liked_user_id}"
-        current_user_link = f"https://t.me/{current_user_username}" if current_user_username else f"tg://user?id={user_id}"
 
-        await update.message.reply_sticker(sticker="CAACAgUAAxkBAAIGUmeUGZkoFGnOIkwsbPkqK566XFeMAALpDQACyRUoVdu2RfDbVvPaNgQ")
-        await update.message.reply_text(
-            f'У вас взаимный лайк\\! [Нажмите здесь, чтобы написать]({user_link})',
-            parse_mode='MarkdownV2'
-        )
+async def handle_mutual_like(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, liked_user_id: int) -> None:
+    liked_user_username, current_user_username = await storage.users.usernames(liked_user_id, user_id)
 
-        try:
-            await context.bot.send_sticker(
-                chat_id=liked_user_id,
-                sticker="CAACAgUAAxkBAAIGUmeUGZkoFGnOIkwsbPkqK566XFeMAALpDQACyRUoVdu2RfDbVvPaNgQ"
-            )
-            await context.bot.send_message(
-                liked_user_id,
-                f'У вас взаимный лайк\\! [Нажмите здесь, чтобы написать]({current_user_link})',
-                parse_mode='MarkdownV2'
-            )
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления: {e}")
+    await update.message.reply_sticker(sticker=MATCH_STICKER)
+    await update.message.reply_text(match_notice(liked_user_id, liked_user_username), parse_mode='MarkdownV2')
 
-        await search(update, context)
+    await notifier.send_sticker(liked_user_id, MATCH_STICKER)
+    await notifier.send_text(liked_user_id, match_notice(user_id, current_user_username), parse_mode='MarkdownV2')
+
+    await search(update, context)
 
 
 async def handle_match_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -410,22 +3890,142 @@ async def handle_match_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
     if 'matched_user_id' in context.user_data:
         matched_user_id = context.user_data['matched_user_id']
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('INSERT INTO messages (user_id, matched_user_id, message) VALUES (?, ?, ?)', (user_id, matched_user_id, text))
-            conn.commit()
+        match = await storage.messages.get_match(user_id, matched_user_id)
+        if match is None:
+            del context.user_data['matched_user_id']
+            await update.message.reply_text("Этот матч больше недоступен. Список матчей: /matches")
+            return
+        await storage.messages.send(match['match_id'], user_id, matched_user_id, text)
 
-        try:
-            await context.bot.send_message(matched_user_id, f"Вам пришло сообщение от пользователя: {text}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения: {e}")
+        await notifier.send_text(matched_user_id, f"Вам пришло сообщение от пользователя: {text}\nОтветить: /chat_{user_id}")
 
         await update.message.reply_text("Ваше сообщение отправлено!")
-        del context.user_data['matched_user_id']
     else:
         await update.message.reply_text("Используйте команду /search для поиска анкет.")
 
 
+def format_history(rows: List[sqlite3.Row], user_id: int, name: Optional[str]) -> str:
+    lines = []
+    for row in rows:
+        author = "Вы" if row['user_id'] == user_id else (name or "Собеседник")
+        sent_at = time.strftime('%d.%m %H:%M', time.localtime(row['sent_at'])) if row['sent_at'] else ''
+        lines.append(f"{sent_at} {author}: {row['message']}".strip())
+    return "\n".join(lines)
+
+
+async def show_matches(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    before = context.user_data.pop('matches_cursor', None) if context.args and context.args[0] == 'next' else None
+    rows = await storage.messages.list_matches(user_id, tuple(before) if before else None, MATCHES_PAGE_SIZE)
+
+    if not rows:
+        await update.message.reply_text("Больше матчей нет." if before else "У вас пока нет взаимных лайков. Нажмите /search, чтобы смотреть анкеты.")
+        return
+
+    lines = []
+    for row in rows:
+        line = f"/chat_{row['peer_id']} {row['name'] or 'Анкета удалена'}"
+        if row['unread']:
+            line += f" (непрочитанных: {row['unread']})"
+        if row['last_message'] is not None:
+            preview = row['last_message'][:MESSAGE_PREVIEW_CHARS]
+            line += f"\n    {'Вы: ' if row['last_sender'] == user_id else ''}{preview}"
+        lines.append(line)
+    if len(rows) == MATCHES_PAGE_SIZE:
+        context.user_data['matches_cursor'] = [rows[-1]['activity_at'], rows[-1]['match_id']]
+        lines.append("\nСледующая страница: /matches next")
+    await update.message.reply_text("Ваши матчи:\n" + "\n".join(lines))
+
+
+async def open_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    peer_id = int(update.message.text.split('@')[0][len('/chat_'):])
+    match = await storage.messages.get_match(user_id, peer_id)
+
+    if match is None:
+        await update.message.reply_text("Такого матча нет. Список матчей: /matches")
+        return
+
+    context.user_data['matched_user_id'] = peer_id
+    rows = await storage.messages.history(match['match_id'], None, HISTORY_PAGE_SIZE)
+    if match['unread']:
+        await storage.messages.mark_read(user_id, peer_id)
+    context.user_data['history_before'] = rows[0]['id'] if len(rows) == HISTORY_PAGE_SIZE else None
+
+    header = f"Переписка с {match['name'] or 'собеседником'}."
+    if not rows:
+        await update.message.reply_text(f"{header} Сообщений пока нет — напишите первым!")
+        return
+    footer = "\n\nБолее ранние сообщения: /history" if context.user_data['history_before'] else ""
+    await update.message.reply_text(f"{header}\n\n{format_history(rows, user_id, match['name'])}{footer}")
+
+
+async def show_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    peer_id = context.user_data.get('matched_user_id')
+    before_id = context.user_data.get('history_before')
+    match = await storage.messages.get_match(user_id, peer_id) if peer_id else None
+
+    if match is None or before_id is None:
+        await update.message.reply_text("Более ранних сообщений нет. Список матчей: /matches")
+        return
+
+    rows = await storage.messages.history(match['match_id'], before_id, HISTORY_PAGE_SIZE)
+    context.user_data['history_before'] = rows[0]['id'] if len(rows) == HISTORY_PAGE_SIZE else None
+    footer = "\n\nЕщё раньше: /history" if context.user_data['history_before'] else ""
+    await update.message.reply_text(f"{format_history(rows, user_id, match['name'])}{footer}")
+
+
+async def toggle_profiler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_USER_ID:
+        return
+
+    if profiler.running:
+        await update.message.reply_text(profiler.stop()[:4000])
+    else:
+        profiler.start(threading.get_ident())
+        await update.message.reply_text("Профилировщик запущен. Отправьте /profile еще раз, чтобы остановить его и получить отчет.")
+
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_USER_ID:
+        return
+
+    daily, totals = await storage.stats.daily(STATS_DAYS)
+    lines = [f"{'день':<6}{'рег':>6}{'актив':>7}{'лайки':>7}{'матчи':>7}{'сообщ':>7}"]
+    for day, values in daily.items():
+        lines.append(f"{day[5:]:<6}{values.get('registrations', 0):>6}{values.get('active_users', 0):>7}"
+                     f"{values.get('likes', 0):>7}{values.get('matches', 0):>7}{values.get('messages', 0):>7}")
+    likes = sum(values.get('likes', 0) for values in daily.values())
+    matches = sum(values.get('matches', 0) for values in daily.values())
+    match_rate = f"{matches / likes * 100:.1f}%" if likes else "—"
+    profiles = totals.get('registrations', 0) - totals.get('deletions', 0)
+    await update.message.reply_text(
+        "<pre>" + "\n".join(lines) + "</pre>\n"
+        f"Лайков в день: {likes / STATS_DAYS:.1f}, доля лайков, ставших матчем: {match_rate}\n"
+        f"Всего анкет: {profiles}, лайков: {totals.get('likes', 0)}, матчей: {totals.get('matches', 0)}, сообщений: {totals.get('messages', 0)}",
+        parse_mode='HTML'
+    )
+
+
+async def show_heatmap(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.message.from_user.id != ADMIN_USER_ID:
+        return
+
+    rows = await storage.stats.heatmap(HEATMAP_TOP)
+    if not rows:
+        await update.message.reply_text("Регистраций с геолокацией пока нет.")
+        return
+    total = sum(row['registrations'] for row in rows)
+    width = max(row['registrations'] for row in rows)
+    lines = [
+        f"{'█' * max(1, round(row['registrations'] / width * 10)):<10} {row['registrations']} ({row['registrations'] / total * 100:.0f}%) "
+        f"{format_bucket(row['lat_bucket'], row['lon_bucket'])}"
+        for row in rows
+    ]
+    await update.message.reply_text(f"Регистрации по квадратам {HEATMAP_CELL_DEG:g}°×{HEATMAP_CELL_DEG:g}°:\n" + "\n".join(lines), disable_web_page_preview=True)
+
+
 async def show_sleep_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     keyboard = ReplyKeyboardMarkup(
         [
@@ -442,10 +4042,7 @@ async def show_sleep_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def show_my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-        profile = cursor.fetchone()
+    profile = await storage.users.get(user_id)
 
     if profile:
         keyboard = ReplyKeyboardMarkup(
@@ -459,44 +4056,261 @@ async def show_my_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             one_time_keyboard=True
         )
 
-        if profile['photo_file_id'].startswith("AgAC"):
-            await update.message.reply_photo(
-                profile['photo_file_id'],
-                caption=f"{profile['name']}, {profile['age']}\n{profile['bio']}",
-                reply_markup=keyboard
-            )
-        else:
-            await update.message.reply_video(
-                profile['photo_file_id'],
-                caption=f"{profile['name']}, {profile['age']}\n{profile['bio']}",
-                reply_markup=keyboard
-            )
+        await reply_profile_media(
+            update.message, profile,
+            caption=f"{profile['name']}, {profile['age']}\n{profile['bio']}",
+            reply_markup=keyboard
+        )
     else:
         await update.message.reply_text("Ваша анкета не найдена. Используйте команду /start для создания анкеты.")
 
 
-def main() -> None:
-    init_db()
-    application = ApplicationBuilder().token("000000000000000000000000000000000000000000000000000").build()
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются одновременно, апдейты одного пользователя — по порядку.
+    # Очередь пользователя (asyncio.Lock, FIFO) берется раньше общего лимита: семафор базового класса
+    # не гарантирует порядок ожидающих, а пользователь с пачкой апдейтов занимал бы все слоты, просто ожидая себя.
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(sys.maxsize)
+        self.limit = asyncio.Semaphore(max_concurrent_updates)
+        self.users: Dict[int, List[Any]] = {}
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("search", search))
-    application.add_handler(CommandHandler("create_profile", create_profile))  # Оставляем, если нужно
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    application.add_handler(MessageHandler(filters.PHOTO, lambda update, context: handle_media(update, context, 'photo')))
-    application.add_handler(MessageHandler(filters.VIDEO, lambda update, context: handle_media(update, context, 'video')))
-    application.add_handler(MessageHandler(filters.LOCATION, handle_location))
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self.limit:
+                await coroutine
+            return
+        entry = self.users.get(user.id)
+        if entry is None:
+            entry = self.users[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self.limit:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.users[user.id]
 
-    application.run_polling()
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .persistence(SQLitePersistence())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .concurrent_updates(UserOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    )
+    if request is None:
+        builder = builder.request(InstrumentedRequest(HTTPXRequest(connection_pool_size=256))).get_updates_request(InstrumentedRequest(HTTPXRequest()))
+    else:
+        builder = builder.request(InstrumentedRequest(request)).get_updates_request(InstrumentedRequest(request))
+    if BOT_API_URL:
+        builder = builder.base_url(f'{BOT_API_URL}/bot').base_file_url(f'{BOT_API_URL}/file/bot')
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", timed(start)))
+    application.add_handler(CommandHandler("search", timed(search)))
+    application.add_handler(CommandHandler("create_profile", timed(create_profile)))  # Оставляем, если нужно
+    application.add_handler(CommandHandler("profile", timed(toggle_profiler)))
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+    application.add_handler(CommandHandler("stats", timed(show_stats)))
+    application.add_handler(CommandHandler("heatmap", timed(show_heatmap)))
+    application.add_handler(CommandHandler("matches", timed(show_matches)))
+    application.add_handler(CommandHandler("history", timed(show_history)))
+    application.add_handler(MessageHandler(filters.Regex(r'^/chat_\d+(@\w+)?$'), timed(open_conversation)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(handle_message)))
+    application.add_handler(MessageHandler(filters.PHOTO, timed(handle_photo)))
+    application.add_handler(MessageHandler(filters.VIDEO, timed(handle_video)))
+    application.add_handler(MessageHandler(filters.LOCATION, timed(handle_location)))
+    return application
+
+
+def update_shard(data: Dict[str, Any], workers: int) -> int:
+    # Все апдейты одного пользователя попадают в один воркер, чтобы обрабатываться по порядку.
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if isinstance(sender, dict) and isinstance(sender.get('id'), int):
+                return sender['id'] % workers
+    return data.get('update_id', 0) % workers
 
-if __name__ == '__main__':
-    main()
 
+def chat_owner(chat_id: int) -> int:
+    # Воркер, который получает апдейты этого пользователя (см. update_shard) и отправляет ему уведомления.
+    return chat_id % WORKER_COUNT
 
-pip install --upgrade apscheduler
 
+def send_to_worker(index: int, message: Tuple[Any, ...]) -> bool:
+    # Служебное сообщение другому воркеру через его очередь апдейтов.
+    try:
+        WORKER_QUEUES[index].put_nowait(message)
+        return True
+    except Full:
+        return False
+
+
+def configure_worker(index: int, count: int, queues: List[Any]) -> None:
+    global WORKER_INDEX, WORKER_COUNT, WORKER_QUEUES, METRICS_PORT, notifier
+    WORKER_INDEX, WORKER_COUNT, WORKER_QUEUES = index, count, queues
+    if METRICS_PORT is not None:
+        METRICS_PORT += index
+    notifier = Notifier()
+
+
+async def handle_worker_message(message: Tuple[Any, ...]) -> None:
+    if message[0] == 'notify':
+        await notifier.adopt(message[1])
+    elif message[0] == 'wake_jobs':
+        jobs.wake()
+    elif message[0] == 'invalidate':
+        invalidate_feed_profile(message[1])
+        await run_db(forget_profile, message[1])
+    elif message[0] == 'promote':
+        await promote_liker(message[1], message[2])
+
+
+async def process_worker_updates(application: Application, updates) -> None:
+    loop = asyncio.get_running_loop()
+    async with application:
+        await application.start()
+        await application.post_init(application)
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            if isinstance(data, tuple):
+                await handle_worker_message(data)
+                continue
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+    await application.post_shutdown(application)
+
+
+def run_worker(index: int, count: int, token: str, queues: List[Any]) -> None:
+    # Ctrl+C получает вся группа процессов; воркер завершается по сигналу от основного процесса,
+    # дообработав уже принятые апдейты.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_worker(index, count, queues)
+    asyncio.run(process_worker_updates(build_application(token), queues[index]))
+
+
+def start_worker(context, index: int, count: int, token: str, queues: List[Any]) -> multiprocessing.Process:
+    # Воркер получает очереди всех воркеров: через них уведомления передаются владельцу чата,
+    # а пробуждение фоновых задач — воркеру 0.
+    process = context.Process(target=run_worker, args=(index, count, token, queues), name=f'worker-{index}', daemon=False)
+    process.start()
+    return process
+
+
+async def read_http_request(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes]:
+    request_line = await asyncio.wait_for(reader.readline(), 5)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), 5)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode('latin-1').split()
+    method, path = (parts[0], parts[1].split('?')[0]) if len(parts) >= 2 else ('', '')
+    length = int(headers.get('content-length') or 0)
+    body = b''
+    if 0 < length <= WEBHOOK_MAX_BODY:
+        body = await asyncio.wait_for(reader.readexactly(length), 5)
+    return method, path, headers, body
+
+
+async def serve_webhook_request(queues: List[Any], reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        method, path, headers, body = await read_http_request(reader)
+        if method != 'POST' or path != WEBHOOK_PATH:
+            status = '404 Not Found'
+        elif WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            status = '403 Forbidden'
+        else:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                status = '400 Bad Request'
+            else:
+                try:
+                    queues[update_shard(data, len(queues))].put_nowait(data)
+                    status = '200 OK'
+                except Full:
+                    # Telegram повторит доставку апдейта позже, пока воркер разбирает очередь.
+                    status = '503 Service Unavailable'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_webhook(token: str, context, queues: List[Any], processes: List[multiprocessing.Process]) -> None:
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    server = await asyncio.start_server(functools.partial(serve_webhook_request, queues), WEBHOOK_HOST, WEBHOOK_PORT)
+    if WEBHOOK_URL:
+        async with Bot(token) as bot:
+            await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {len(processes)}")
+    async with server:
+        while not stop.is_set():
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                    processes[index] = start_worker(context, index, len(processes), token, queues)
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+
+def run_webhook(token: str, workers: int) -> None:
+    # Основной процесс только принимает апдейты и раскладывает их по воркерам; у каждого воркера свой
+    # Application, свои кэши и соединение с общей базой (WAL + busy_timeout разводят запись между процессами).
+    init_db()
+    close_db_connections()
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes = [start_worker(context, index, workers, token, queues) for index in range(workers)]
+    try:
+        asyncio.run(serve_webhook(token, context, queues, processes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for updates in queues:
+            try:
+                updates.put(None, timeout=1)
+            except Full:
+                pass
+        for process in processes:
+            process.join(WEBHOOK_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
 
-pip install apscheduler==3.6.3
 
+def main() -> None:
+    if sys.argv[1:2] == ['webhook']:
+        run_webhook(BOT_TOKEN, int(sys.argv[2]) if len(sys.argv) > 2 else WEBHOOK_WORKERS)
+        return
+    if sys.argv[1:2] == ['vacuum']:
+        convert_auto_vacuum()
+        return
+    init_db()
+    application = build_application(BOT_TOKEN)
+    application.run_polling()
 
-pip install pytz
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import main
+
+
+def test_seen_rows_count_toward_read_limit(tmp_path, monkeypatch):
+    # Пользователь уже видел всех вокруг: поиск не должен читать весь радиус на каждой дозагрузке.
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'dating.db'))
+    monkeypatch.setattr(main, 'CANDIDATE_PAGE_SIZE', 100)
+    monkeypatch.setattr(main, 'CANDIDATE_READ_LIMIT', 300)
+    main.profile_cache.entries.clear()
+    main.init_db()
+    try:
+        with main.get_db_connection() as conn:
+            people = [(user_id, 55.75 + user_id * 1e-5, 37.61) for user_id in range(1, 1001)]
+            conn.executemany(
+                "INSERT INTO users (id, name, age, bio, latitude, longitude, geo_cell) VALUES (?, 'Name', 25, '', ?, ?, ?)",
+                [(user_id, latitude, longitude, main.geo_cell(latitude, longitude)) for user_id, latitude, longitude in people]
+            )
+        read = []
+        pages = main.geo_range_pages
+
+        def counted_pages(conn, low, high):
+            for rows in pages(conn, low, high):
+                read.append(len(rows))
+                yield rows
+
+        monkeypatch.setattr(main, 'geo_range_pages', counted_pages)
+        seen = set(range(1, 1001))
+        with main.get_db_connection() as conn:
+            assert main.find_nearby_profiles(conn, 0, 55.75, 37.61, 10, (seen,)) == []
+            assert 300 <= sum(read) < 300 + main.CANDIDATE_PAGE_SIZE, 'чтение останавливается на CANDIDATE_READ_LIMIT'
+    finally:
+        main.close_db_connections()
@@ -0,0 +1,40 @@
+import sqlite3
+
+import pytest
+
+import main
+
+
+def test_equirectangular_wraps_antimeridian():
+    expected = main.calculate_distance(0.0, 179.99, 0.0, -179.99)
+    assert expected == pytest.approx(2.22, abs=0.01)
+    assert main.equirectangular_distance(0.0, 179.99, 0.0, -179.99) == pytest.approx(expected, rel=0.005)
+    assert main.equirectangular_distance(0.0, -179.99, 0.0, 179.99) == pytest.approx(expected, rel=0.005)
+
+
+@pytest.mark.skipif(main.np is None, reason='numpy не установлен')
+def test_batch_distances_fast_wraps_antimeridian():
+    latitudes = [0.0, 10.0, -10.0]
+    longitudes = [-179.99, -179.5, 179.5]
+    fast = main.batch_distances(0.0, 179.99, latitudes, longitudes, fast=True)
+    exact = main.batch_distances(0.0, 179.99, latitudes, longitudes)
+    for distance, expected in zip(fast, exact):
+        assert distance == pytest.approx(expected, rel=0.005)
+    assert max(fast) < 1200
+
+
+def test_nearby_across_antimeridian():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    for migration in main.MIGRATIONS:
+        migration(cursor)
+    profiles = [(1, 0.0, 179.99), (2, 0.0, -179.99), (3, 0.05, -179.9), (4, 0.0, 170.0)]
+    for user_id, latitude, longitude in profiles:
+        conn.execute(
+            'INSERT INTO users (id, username, name, age, latitude, longitude, geo_cell) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (user_id, f'user{user_id}', f'Name{user_id}', 25, latitude, longitude, main.geo_cell(latitude, longitude))
+        )
+    found = main.find_nearby_profiles(conn, 1, 0.0, 179.99, 10, radius_km=30)
+    assert [row['id'] for row, _ in found] == [2, 3]
+    assert found[0][1] == pytest.approx(2.22, abs=0.05)
@@ -0,0 +1,74 @@
+import asyncio
+import queue
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import main
+
+
+class FeedUsers:
+    def __init__(self) -> None:
+        self.batches = 0
+        self.next_id = 1000
+
+    async def feed_batch(self, user_id, queued):
+        self.batches += 1
+        candidates = [({'id': self.next_id + index}, 1.0) for index in range(main.FEED_BATCH_SIZE)]
+        self.next_id += main.FEED_BATCH_SIZE
+        return [], candidates
+
+    async def pending_liker(self, user_id, liker_id):
+        return {'id': liker_id}, 0.5
+
+
+def test_incoming_likes_keep_feed_bounded(monkeypatch):
+    async def scenario():
+        users = FeedUsers()
+        monkeypatch.setattr(main, 'storage', SimpleNamespace(users=users))
+        monkeypatch.setattr(main, '_feeds', OrderedDict())
+        feed = main.get_feed(1)
+        await main.refill_feed(1, feed)
+        for liker_id in range(1, 41):
+            await main.promote_liker(1, liker_id)
+        await main.promote_liker(1, 40)
+
+        assert users.batches == 1, 'входящий лайк не запускает поиск кандидатов'
+        assert len(feed.queue) == main.FEED_BATCH_SIZE
+        assert [entry[0] for entry in list(feed.queue)[:40]] == list(range(40, 0, -1)), 'лайкнувшие первыми, без повторов'
+        assert feed.queued == {entry[0] for entry in feed.queue}
+        assert feed.likers == set(range(1, 41))
+
+        await main.refill_feed(1, feed)
+        assert len(feed.queue) == main.FEED_BATCH_SIZE, 'кандидаты не добавляются, пока очередь выше FEED_LOW_WATER'
+
+    asyncio.run(scenario())
+
+
+def test_other_workers_follow_profile_changes(monkeypatch):
+    # Воркер 0 меняет анкету 3 и получает лайк для пользователя 5, которым владеет воркер 1.
+    async def scenario():
+        users = FeedUsers()
+        queues = [queue.Queue(), queue.Queue()]
+        monkeypatch.setattr(main, 'storage', SimpleNamespace(users=users))
+        monkeypatch.setattr(main, '_feeds', OrderedDict())
+        monkeypatch.setattr(main, '_feed_invalidated', OrderedDict())
+        monkeypatch.setattr(main, 'WORKER_COUNT', 2)
+        monkeypatch.setattr(main, 'WORKER_QUEUES', queues)
+
+        main.profile_changed(3)
+        await main.promote_liker(5, 8)
+        assert queues[0].empty() and not main._feeds
+        assert [queues[1].get_nowait(), queues[1].get_nowait()] == [('invalidate', 3), ('promote', 5, 8)]
+
+        monkeypatch.setattr(main, 'WORKER_INDEX', 1)
+        main.profile_cache.entries[3] = (None, time.monotonic())
+        main._seen_sets[3] = (main.SeenSet(), time.monotonic())
+        feed = main.get_feed(5)
+        await main.handle_worker_message(('invalidate', 3))
+        await main.handle_worker_message(('promote', 5, 8))
+        assert 3 not in main.profile_cache.entries and 3 not in main._seen_sets
+        assert 3 in main._feed_invalidated
+        assert feed.queue[0][0] == 8 and feed.likers == {8}
+
+    asyncio.run(scenario())
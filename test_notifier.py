@@ -0,0 +1,38 @@
+import asyncio
+import sqlite3
+import time
+
+import main
+
+
+def test_deliver_requeues_after_unexpected_error(monkeypatch):
+    async def scenario():
+        notifier = main.Notifier()
+        sent = []
+
+        async def send(chat_id, kind, payload, count):
+            if not sent:
+                sent.append(None)
+                raise sqlite3.OperationalError('database is locked')
+            sent.append(payload['text'])
+
+        async def run_db(func, *args):
+            return None
+
+        monkeypatch.setattr(notifier, '_send', send)
+        monkeypatch.setattr(main, 'run_db', run_db)
+        notifier._push({'id': 1, 'chat_id': 7, 'kind': 'text', 'payload': {'text': 'hi'}, 'attempts': 0, 'not_before': 0})
+        notifier.busy.add(7)
+        await notifier._deliver(7)
+
+        assert 7 not in notifier.busy
+        assert notifier.pending[7][0]['attempts'] == 1
+        when, _, chat_id = notifier.schedule[-1]
+        assert chat_id == 7 and when > time.time()
+
+        notifier.busy.add(7)
+        await notifier._deliver(7)
+        assert sent == [None, 'hi']
+        assert 7 not in notifier.pending
+
+    asyncio.run(scenario())
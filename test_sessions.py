@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+
+
+def test_session_survives_eviction_when_user_returns(tmp_path, monkeypatch):
+    # Пользователь прислал апдейт между выгрузкой сессии и drop_user_data из update_persistence.
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'dating.db'))
+    monkeypatch.setattr(main, 'SESSION_TTL', -1)
+    main.init_db()
+    main.save_sessions({1: {'name': 'Анна'}})
+
+    async def scenario():
+        persistence = main.SQLitePersistence()
+        await persistence.refresh_user_data(1, {})
+        assert persistence.expired_sessions() == [1]
+
+        user_data = {}
+        await persistence.refresh_user_data(1, user_data)
+        await persistence.drop_user_data(1)
+        await persistence.flush()
+        assert user_data == {'name': 'Анна'}
+        assert 1 in persistence.sessions and not persistence.evicting
+        assert main.load_session(1) == {'name': 'Анна'}
+
+        await persistence.drop_user_data(1)
+        await persistence.flush()
+        return 1 in persistence.sessions
+
+    assert not asyncio.run(scenario())
+    assert main.load_session(1) is None, 'обычный drop_user_data по-прежнему удаляет сессию'
@@ -0,0 +1,396 @@
+import asyncio
+import functools
+import os
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import pytest
+
+import main
+
+
+# Проверки, что хранилища SQLite и PostgreSQL ведут себя одинаково. PostgreSQL берется из DATABASE_URL,
+# иначе поднимается встроенный из пакета pgserver; без asyncpg или сервера проверки PostgreSQL пропускаются.
+CENTER = (55.7558, 37.6173)
+ELSEWHERE = [(59.9343, 30.3351), (56.8389, 60.6057)]
+
+
+def profile_media(file_id: str, media_type: str = 'photo') -> List[Dict[str, Any]]:
+    return [{'media_type': media_type, 'file_id': file_id, 'file_unique_id': file_id, 'width': 1280, 'height': 960,
+             'duration': 12 if media_type == 'video' else None, 'file_size': 100000, 'feed_file_id': f'{file_id}-feed',
+             'sizes': [{'file_id': f'{file_id}-feed', 'file_unique_id': file_id, 'width': 800, 'height': 600, 'file_size': 50000}]}]
+
+
+async def register(storage, user_id: int, location: Optional[Tuple[float, float]] = None, age: int = 25) -> None:
+    await storage.users.create(user_id, f'user{user_id}', f'Name{user_id}', age, 'bio', profile_media(f'photo{user_id}'))
+    if location is not None:
+        await storage.users.update_location(user_id, *location)
+
+
+def offset(km: float) -> Tuple[float, float]:
+    return CENTER[0] + km / main.KM_PER_DEG, CENTER[1]
+
+
+async def feed_ids(storage, user_id: int, queued: Optional[Set[int]] = None) -> Tuple[List[int], List[int]]:
+    likers, candidates = await storage.users.feed_batch(user_id, queued or set())
+    return [profile['id'] for profile, _ in likers], [profile['id'] for profile, _ in candidates]
+
+
+async def check_profiles(storage, settle) -> None:
+    await register(storage, 1)
+    profile = await storage.users.get(1)
+    assert profile is not None and profile['name'] == 'Name1' and profile['age'] == 25
+    assert profile['media_type'] == 'photo' and profile['feed_file_id'] == 'photo1-feed', 'главное медиа копируется в анкету'
+    assert profile['latitude'] is None
+    assert await storage.users.update_location(1, *ELSEWHERE[0]) is False, 'первая геолокация: had_location = False'
+    assert await storage.users.update_location(1, *ELSEWHERE[1]) is True, 'повторная геолокация: had_location = True'
+    profile = await storage.users.get(1)
+    assert (profile['latitude'], profile['longitude']) == ELSEWHERE[1]
+    await storage.users.update_media(1, profile_media('video1', 'video'))
+    profile = await storage.users.get(1)
+    assert profile['media_type'] == 'video' and profile['photo_file_id'] == 'video1'
+    assert await storage.users.usernames(1, 99) == ['user1', None], 'usernames в порядке аргументов'
+    assert await storage.users.get(99) is None
+    large_id = 2 ** 40
+    await register(storage, large_id)
+    assert (await storage.users.get(large_id))['id'] == large_id, 'id больше 32 бит'
+
+
+async def check_nearby(storage, settle) -> None:
+    viewer, near, middle, edge, far = 1, 2, 3, 4, 5
+    await register(storage, viewer, offset(0))
+    await register(storage, edge, offset(20))
+    await register(storage, near, offset(1))
+    await register(storage, far, offset(200))
+    await register(storage, middle, offset(5))
+    likers, candidates = await storage.users.feed_batch(viewer, set())
+    assert not likers
+    assert [profile['id'] for profile, _ in candidates] == [near, middle, edge], 'в радиусе, по расстоянию, без себя и дальних'
+    for profile, distance in candidates:
+        exact = main.calculate_distance(*offset(0), profile['latitude'], profile['longitude'])
+        assert distance == pytest.approx(exact, rel=0.01, abs=0.01)
+    assert (await feed_ids(storage, viewer, {near}))[1] == [middle, edge], 'анкеты из очереди исключаются'
+    nowhere = 6
+    await register(storage, nowhere)
+    likers, candidates = await storage.users.feed_batch(nowhere, set())
+    assert candidates and nowhere not in [profile['id'] for profile, _ in candidates]
+    assert all(distance is None for _, distance in candidates), 'без геолокации — случайные анкеты без расстояния'
+
+
+async def check_seen(storage, settle) -> None:
+    viewer, viewed, disliked, liked, fresh = 1, 2, 3, 4, 5
+    await register(storage, viewer, offset(0))
+    for index, user_id in enumerate((viewed, disliked, liked, fresh)):
+        await register(storage, user_id, offset(index + 1))
+    await storage.likes.view(viewer, viewed)
+    await storage.likes.view(viewer, disliked)
+    await storage.likes.dislike(viewer, disliked)
+    await storage.likes.view(viewer, liked)
+    assert await storage.likes.like(viewer, liked) is False
+    assert (await feed_ids(storage, viewer))[1] == [fresh], 'просмотренные, дизлайкнутые и лайкнутые не показываются'
+
+
+async def check_inbox(storage, settle) -> None:
+    liker, target, other = 1, 2, 3
+    await register(storage, liker, offset(0))
+    await register(storage, target, offset(2))
+    await register(storage, other, offset(1))
+    await storage.likes.like(liker, target)
+    await storage.likes.like(liker, target)
+    assert await storage.likes.pending_count(target) == 1, 'повторный лайк не увеличивает счетчик'
+    likers, candidates = await feed_ids(storage, target)
+    assert likers == [liker] and liker not in candidates, 'лайкнувший идет первым и не дублируется в кандидатах'
+    await storage.likes.view(target, liker)
+    await storage.likes.dislike(target, liker)
+    assert await storage.likes.pending_count(target) == 0, 'дизлайк снимает входящий лайк со счетчика'
+    assert (await feed_ids(storage, target))[0] == []
+    await storage.likes.view(liker, other)
+    await storage.likes.dislike(liker, other)
+    await storage.likes.like(other, liker)
+    assert await storage.likes.pending_count(liker) == 0, 'лайк от уже отклоненной анкеты не считается'
+
+
+async def check_mutual(storage, settle) -> None:
+    first, second = 1, 2
+    await register(storage, first, offset(0))
+    await register(storage, second, offset(1))
+    assert await storage.likes.like(first, second) is False
+    assert await storage.likes.pending_count(second) == 1
+    assert await storage.likes.like(second, first) is True, 'встречный лайк дает матч'
+    assert await storage.likes.pending_count(second) == 0, 'матч снимает входящий лайк'
+    forward = await storage.messages.get_match(first, second)
+    backward = await storage.messages.get_match(second, first)
+    assert forward is not None and backward is not None and forward['match_id'] == backward['match_id']
+    assert forward['name'] == f'Name{second}' and forward['unread'] == 0
+    assert await storage.likes.like(second, first) is True, 'повторный лайк после матча'
+    assert len(await storage.messages.list_matches(first, None, 10)) == 1, 'повторный лайк не создает второй матч'
+
+
+async def check_concurrent_likes(storage, settle) -> None:
+    # Встречные лайки одновременно: ровно один из них должен увидеть взаимность, матч — ровно один.
+    pairs = [(index * 2 + 1, index * 2 + 2) for index in range(10)]
+    for first, second in pairs:
+        await register(storage, first, offset(0))
+        await register(storage, second, offset(1))
+    for first, second in pairs:
+        results = await asyncio.gather(storage.likes.like(first, second), storage.likes.like(second, first))
+        assert sorted(results) == [False, True]
+        assert len(await storage.messages.list_matches(first, None, 10)) == 1
+        assert await storage.likes.pending_count(first) == 0 and await storage.likes.pending_count(second) == 0
+
+
+async def check_messages(storage, settle) -> None:
+    user, older_peer, newer_peer = 1, 2, 3
+    for index, user_id in enumerate((user, older_peer, newer_peer)):
+        await register(storage, user_id, offset(index))
+    for peer in (older_peer, newer_peer):
+        await storage.likes.like(user, peer)
+        await storage.likes.like(peer, user)
+    older = (await storage.messages.get_match(user, older_peer))['match_id']
+    newer = (await storage.messages.get_match(user, newer_peer))['match_id']
+    ids = []
+    for sender, text in ((user, 'привет'), (older_peer, 'привет!'), (user, 'как дела?')):
+        ids.append(await storage.messages.send(older, sender, older_peer if sender == user else user, text))
+        await asyncio.sleep(0.002)
+    await storage.messages.send(newer, newer_peer, user, 'hello')
+    assert ids == sorted(ids)
+    page = await storage.messages.history(older, None, 2)
+    assert [row['message'] for row in page] == ['привет!', 'как дела?']
+    assert [row['message'] for row in await storage.messages.history(older, page[0]['id'], 2)] == ['привет']
+    assert all(row['sent_at'] for row in page)
+    assert (await storage.messages.get_match(older_peer, user))['unread'] == 2
+    assert (await storage.messages.get_match(user, older_peer))['unread'] == 1, 'свои сообщения не считаются непрочитанными'
+    await storage.messages.mark_read(older_peer, user)
+    assert (await storage.messages.get_match(older_peer, user))['unread'] == 0
+    matches = await storage.messages.list_matches(user, None, 1)
+    assert [row['peer_id'] for row in matches] == [newer_peer]
+    assert matches[0]['last_message'] == 'hello' and matches[0]['last_sender'] == newer_peer
+    rest = await storage.messages.list_matches(user, (matches[0]['activity_at'], matches[0]['match_id']), 10)
+    assert [row['peer_id'] for row in rest] == [older_peer] and rest[0]['last_message'] == 'как дела?'
+
+
+async def check_delete(storage, settle) -> None:
+    removed, partner, admirer, crush = 1, 2, 3, 4
+    for index, user_id in enumerate((removed, partner, admirer, crush)):
+        await register(storage, user_id, offset(index))
+    await storage.likes.like(removed, partner)
+    await storage.likes.like(partner, removed)
+    match_id = (await storage.messages.get_match(partner, removed))['match_id']
+    await storage.messages.send(match_id, partner, removed, 'пока')
+    await storage.likes.like(admirer, removed)
+    await storage.likes.like(removed, crush)
+    assert await storage.likes.pending_count(crush) == 1
+    await storage.users.delete(removed)
+    await settle()
+    assert await storage.users.get(removed) is None
+    assert await storage.messages.get_match(partner, removed) is None
+    assert await storage.messages.list_matches(partner, None, 10) == []
+    assert await storage.likes.pending_count(crush) == 0, 'лайки удаленной анкеты сняты со счетчиков'
+    assert removed not in (await feed_ids(storage, crush))[0]
+    await register(storage, removed, offset(0))
+    assert await storage.likes.pending_count(removed) == 0, 'новая анкета начинает без входящих лайков'
+    assert await storage.likes.like(removed, admirer) is False, 'лайк старой анкеты не дает матч новой'
+    assert await storage.messages.list_matches(removed, None, 10) == []
+
+
+async def check_reregister(storage, settle) -> None:
+    # Анкета создана заново раньше, чем фоновая очистка дошла до старой.
+    removed, admirer, partner = 1, 2, 3
+    for index, user_id in enumerate((removed, admirer, partner)):
+        await register(storage, user_id, offset(index))
+    await storage.likes.like(admirer, removed)
+    await storage.likes.like(removed, partner)
+    await storage.likes.like(partner, removed)
+    await storage.users.delete(removed)
+    await register(storage, removed, offset(0))
+    assert await storage.likes.pending_count(removed) == 0
+    assert (await feed_ids(storage, removed))[0] == [], 'входящие лайки старой анкеты не показываются'
+    assert await storage.likes.like(removed, admirer) is False, 'лайк старой анкеты не дает матч новой'
+    assert await storage.messages.list_matches(removed, None, 10) == []
+    await settle()
+    assert await storage.likes.like(admirer, removed) is True, 'новый встречный лайк дает матч'
+
+
+async def check_stats(storage, settle) -> None:
+    first, second, third = 1, 2, 3
+    for index, user_id in enumerate((first, second, third)):
+        await register(storage, user_id, offset(index))
+    await storage.users.update_location(first, *offset(0.5))
+    await storage.likes.view(first, third)
+    await storage.likes.dislike(first, third)
+    await storage.likes.like(first, second)
+    assert await storage.likes.like(second, first) is True
+    match_id = (await storage.messages.get_match(first, second))['match_id']
+    await storage.messages.send(match_id, first, second, 'привет')
+    await storage.users.delete(third)
+    day = time.strftime('%Y-%m-%d')
+    await storage.stats.record_active_user(day, first)
+    await storage.stats.record_active_user(day, first)
+    await storage.stats.record_active_user(day, second)
+    await settle()
+    daily, totals = await storage.stats.daily(7)
+    expected = {'registrations': 3, 'deletions': 1, 'active_users': 2, 'likes': 2, 'dislikes': 1, 'matches': 1, 'messages': 1}
+    assert daily == {day: expected}
+    assert {name: value for name, value in totals.items() if value} == {
+        name: value for name, value in expected.items() if name != 'active_users'
+    }, 'общие счетчики без активных пользователей'
+    bucket = main.heatmap_bucket(*CENTER)
+    rows = await storage.stats.heatmap(10)
+    assert [(row['lat_bucket'], row['lon_bucket'], row['registrations']) for row in rows] == [(*bucket, 3)], 'смена геолокации не считается регистрацией'
+    snapshot_totals, geo = await storage.stats.digest_snapshot()
+    assert snapshot_totals == totals and geo == {bucket: 3}
+
+
+async def check_pending_liker(storage, settle) -> None:
+    target, liker, stranger, rejected = 1, 2, 3, 4
+    for index, user_id in enumerate((target, liker, stranger, rejected)):
+        await register(storage, user_id, offset(index))
+    await storage.likes.like(liker, target)
+    await storage.likes.view(target, rejected)
+    await storage.likes.dislike(target, rejected)
+    await storage.likes.like(rejected, target)
+    profile, distance = await storage.users.pending_liker(target, liker)
+    assert profile['id'] == liker and distance == pytest.approx(main.calculate_distance(*offset(0), *offset(1)), rel=0.01)
+    assert await storage.users.pending_liker(target, stranger) is None, 'без лайка'
+    assert await storage.users.pending_liker(target, rejected) is None, 'уже отклоненная анкета'
+    await storage.likes.view(target, liker)
+    await storage.likes.dislike(target, liker)
+    assert await storage.users.pending_liker(target, liker) is None, 'после дизлайка'
+
+
+async def check_like_retention(storage, settle) -> None:
+    liker, target, rejected = 1, 2, 3
+    for index, user_id in enumerate((liker, target, rejected)):
+        await register(storage, user_id, offset(index))
+    await storage.likes.like(liker, target)
+    await storage.likes.view(target, rejected)
+    await storage.likes.dislike(target, rejected)
+    await storage.likes.like(rejected, target)
+    assert await storage.likes.pending_count(target) == 1
+    retention_days = main.LIKE_RETENTION_DAYS
+    main.LIKE_RETENTION_DAYS = -1
+    try:
+        while not await storage.jobs.step({'kind': 'retention', 'payload': {}}):
+            pass
+    finally:
+        main.LIKE_RETENTION_DAYS = retention_days
+    assert await storage.likes.pending_count(target) == 0, 'истекший лайк снят со счетчика'
+    assert (await feed_ids(storage, target))[0] == [], 'истекший лайк не показывается первым'
+
+
+async def check_recurring_jobs(storage, settle) -> None:
+    # Повторяющаяся задача не отбрасывается после JOB_MAX_ATTEMPTS ошибок, в том числе на PostgreSQL,
+    # где набор повторяющихся задач свой.
+    await storage.jobs.ensure_recurring()
+    await storage.jobs.ensure_recurring()
+
+    async def failing_step(job):
+        raise RuntimeError('сбой шага')
+
+    current, main.storage = main.storage, storage
+    storage.jobs.step = failing_step
+    failed = []
+    try:
+        for _ in storage.jobs.recurring:
+            job = await storage.jobs.next_job()
+            assert job is not None and job['kind'] in storage.jobs.recurring and job['id'] not in failed
+            job['attempts'] = main.JOB_MAX_ATTEMPTS
+            await main.JobRunner()._execute(job)
+            failed.append(job['id'])
+    finally:
+        main.storage = current
+        del storage.jobs.step
+    kept = await storage.jobs.next_job()
+    assert kept['id'] == failed[0] and kept['attempts'] == main.JOB_MAX_ATTEMPTS + 1, 'задача осталась в очереди'
+
+
+CHECKS = [check_profiles, check_nearby, check_seen, check_inbox, check_mutual, check_concurrent_likes, check_messages, check_delete,
+          check_reregister, check_stats, check_pending_liker,
+          check_like_retention, check_recurring_jobs]
+
+
+async def settle(storage) -> None:
+    # Фоновая очистка удаленных анкет идет задачами; в проверке подошедшие задачи выполняются сразу.
+    while True:
+        job = await storage.jobs.next_job()
+        if job is None or job['run_after'] > time.time():
+            return
+        while not await storage.jobs.step(job):
+            pass
+        await storage.jobs.finish(job)
+
+
+@pytest.fixture(scope='session')
+def postgres_dsn(tmp_path_factory) -> str:
+    if main.asyncpg is None:
+        pytest.skip('asyncpg не установлен')
+    if main.DATABASE_URL:
+        return main.DATABASE_URL
+    try:
+        import pgserver
+    except ImportError:
+        pytest.skip('нет DATABASE_URL и пакета pgserver')
+    server = pgserver.get_server(str(tmp_path_factory.mktemp('pgdata')), cleanup_mode='stop')
+    return server.get_uri()
+
+
+@pytest.fixture
+def run_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'dating.db'))
+    # Модульные кэши и фоновые задачи привязаны к предыдущей базе и предыдущему event loop.
+    monkeypatch.setattr(main, 'swipes', main.SwipeWriter())
+    monkeypatch.setattr(main, 'jobs', main.JobRunner())
+    main.profile_cache.entries.clear()
+    main._seen_sets.clear()
+    main._feeds.clear()
+    main._feed_invalidated.clear()
+    main.init_db()
+
+    def run(check) -> None:
+        async def scenario():
+            storage = main.SQLiteStorage()
+            await storage.start()
+            try:
+                await check(storage, functools.partial(settle, storage))
+            finally:
+                await storage.stop()
+        asyncio.run(scenario())
+
+    yield run
+    main.shutdown_db_executor()
+    main.close_db_connections()
+
+
+@pytest.fixture
+def run_postgres(request):
+    dsn = request.getfixturevalue('postgres_dsn')
+
+    def run(check) -> None:
+        async def scenario():
+            # Каждая проверка работает в своей схеме, чтобы не задеть данные в базе по DSN.
+            schema = f'conformance_{os.getpid()}_{time.monotonic_ns()}'
+            conn = await main.asyncpg.connect(dsn)
+            await conn.execute(f'CREATE SCHEMA {schema}')
+            try:
+                storage = main.PostgresStorage(dsn, server_settings={'search_path': f'{schema},public'})
+                await storage.start()
+                try:
+                    await check(storage, functools.partial(settle, storage))
+                finally:
+                    await storage.stop()
+            finally:
+                await conn.execute(f'DROP SCHEMA {schema} CASCADE')
+                await conn.close()
+        asyncio.run(scenario())
+
+    return run
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def run_check(request):
+    return request.getfixturevalue(f'run_{request.param}')
+
+
+@pytest.mark.parametrize('check', CHECKS, ids=lambda check: check.__name__[len('check_'):])
+def test_storage_conformance(run_check, check):
+    run_check(check)
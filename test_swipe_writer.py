@@ -0,0 +1,63 @@
+import asyncio
+import sqlite3
+import time
+
+import main
+
+
+def test_flush_error_is_retried(monkeypatch):
+    async def scenario():
+        writer = main.SwipeWriter()
+        calls = []
+
+        async def run_db(func, *args):
+            calls.append(func)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return []
+
+        monkeypatch.setattr(main, 'run_db', run_db)
+        await writer.start()
+        writer.pending = 1
+        writer.wakeup.set()
+        for _ in range(100):
+            if len(calls) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        alive = not writer.task.done()
+        await writer.stop()
+        return calls, alive
+
+    calls, alive = asyncio.run(scenario())
+    assert alive
+    assert calls[:2] == [main.flush_swipes, main.flush_swipes]
+
+
+def test_crossing_likes_from_different_workers(tmp_path, monkeypatch):
+    # Встречные лайки пары в буферах двух воркеров: матч создает тот, кто пишет вторым.
+    monkeypatch.setattr(main, 'DB_PATH', str(tmp_path / 'dating.db'))
+    monkeypatch.setattr(main, 'WORKER_COUNT', 2)
+    main.profile_cache.entries.clear()
+    main.init_db()
+    try:
+        with main.get_db_connection() as conn:
+            conn.executemany('INSERT INTO users (id, username, name, age, bio) VALUES (?, ?, ?, 25, ?)',
+                             [(1, 'first', 'First', ''), (2, None, 'Second', '')])
+        first, second = main.SwipeBuffer(), main.SwipeBuffer()
+        first.likes[(1, 2)] = time.time()
+        second.likes[(2, 1)] = time.time()
+        with main.get_db_connection() as conn:
+            first.flush(conn)
+        with main.get_db_connection() as conn:
+            second.flush(conn)
+        with main.get_db_connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM matches').fetchone()[0] == 1
+            assert conn.execute('SELECT COUNT(*) FROM inbox').fetchone()[0] == 0
+            assert [tuple(row) for row in conn.execute('SELECT user_id, pending FROM inbox_counts ORDER BY user_id')] == [(1, 0), (2, 0)]
+            outbox = [(row['chat_id'], row['kind']) for row in conn.execute('SELECT * FROM outbox ORDER BY id')]
+        assert first.notices == []
+        assert [(item['chat_id'], item['kind']) for item in second.notices] == outbox == [(2, 'sticker'), (2, 'text'), (1, 'sticker'), (1, 'text')]
+        assert '/chat\\_2' in second.notices[3]['payload']['text'] and 'tg://user?id=2' in second.notices[3]['payload']['text']
+        assert 'https://t.me/first' in second.notices[1]['payload']['text']
+    finally:
+        main.close_db_connections()
@@ -0,0 +1,69 @@
+import asyncio
+
+from telegram import Update
+
+import main
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    return Update.de_json({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': 'hi',
+        },
+    }, None)
+
+
+def test_orders_per_user_and_overlaps_users():
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(8)
+        log = []
+        running = 0
+        overlap = 0
+
+        async def handle(user_id: int, index: int, delay: float):
+            nonlocal running, overlap
+            running += 1
+            overlap = max(overlap, running)
+            log.append(('start', user_id, index))
+            await asyncio.sleep(delay)
+            log.append(('end', user_id, index))
+            running -= 1
+
+        tasks = []
+        for index in range(3):
+            for user_id, delay in ((1, 0.03 - index * 0.01), (2, 0.01)):
+                update = make_update(len(tasks) + 1, user_id)
+                tasks.append(asyncio.create_task(processor.process_update(update, handle(user_id, index, delay))))
+        await asyncio.gather(*tasks)
+        return log, overlap, processor.users
+
+    log, overlap, users = asyncio.run(scenario())
+    for user_id in (1, 2):
+        events = [(event, index) for event, user, index in log if user == user_id]
+        assert events == [(event, index) for index in range(3) for event in ('start', 'end')]
+    assert overlap == 2
+    assert users == {}
+
+
+def test_respects_limit():
+    async def scenario():
+        processor = main.UserOrderedUpdateProcessor(2)
+        running = 0
+        peak = 0
+
+        async def handle():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(make_update(user_id, user_id), handle()) for user_id in range(1, 7)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2